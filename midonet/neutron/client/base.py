@@ -55,6 +55,14 @@ class MidonetClientBase(object):
     def create_network_postcommit(self, network):
         pass
 
+    def create_network_bulk_precommit(self, context, networks):
+        for network in networks:
+            self.create_network_precommit(context, network)
+
+    def create_network_bulk_postcommit(self, networks):
+        for network in networks:
+            self.create_network_postcommit(network)
+
     def update_network_precommit(self, context, network_id, network):
         pass
 
@@ -91,6 +99,14 @@ class MidonetClientBase(object):
     def create_port_postcommit(self, port):
         pass
 
+    def create_port_bulk_precommit(self, context, ports):
+        for port in ports:
+            self.create_port_precommit(context, port)
+
+    def create_port_bulk_postcommit(self, ports):
+        for port in ports:
+            self.create_port_postcommit(port)
+
     def update_port_precommit(self, context, port_id, port):
         pass
 
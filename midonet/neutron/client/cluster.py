@@ -14,111 +14,253 @@
 #    under the License.
 
 from midonet.neutron.client import base
+from midonet.neutron.common import doorbell
+from midonet.neutron.common import exceptions as mido_exc
+from midonet.neutron.common import metrics
+from midonet.neutron.common import rate_limit
+from midonet.neutron.db import task_archive
 from midonet.neutron.db import task_db as task
+from midonet.neutron.db import task_jobs
 from midonet.neutron.rpc import topology_client as top
 
+import math
 import neutron.db.api as db
+from neutron import i18n
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+_LI = i18n._LI
+_LE = i18n._LE
 
 
 class MidonetClusterClient(base.MidonetClientBase):
 
     def __init__(self, conf):
         self.conf = conf
+        self._pruner = None
+        self._metrics_reporter = None
+        self._counters_reporter = None
+        self._doorbell = None
+        self._rate_limiter = rate_limit.TenantRateLimiter(
+            conf.task_tenant_rate, conf.task_tenant_burst)
 
     def initialize(self):
-        task.create_config_task(db.get_session(), dict(self.conf))
+        # Shared by the clients of the process, its hook is registered once
+        self._doorbell = doorbell.start_doorbell(
+            self.conf.task_doorbell, self.conf.task_doorbell_address)
+        if self._doorbell is not None and self._doorbell.transactional:
+            task.register_flush_hook(self._doorbell.notify_flushed)
+        elif self._doorbell is not None:
+            task.register_commit_hook(self._doorbell.ring_committed)
+        if not task.create_config_task(db.get_session(), dict(self.conf)):
+            LOG.debug("Configuration unchanged, no config task created")
+        # Run by a single process of all the Neutron servers at a time
+        if self.conf.task_prune_interval > 0:
+            self._pruner = task_jobs.start_job(
+                'prune', self._prune_tasks, self.conf.task_prune_interval)
+        if self.conf.task_metrics_interval > 0:
+            self._metrics_reporter = task_jobs.start_job(
+                'metrics', self._report_metrics,
+                self.conf.task_metrics_interval)
+            # The counters are per process, and reported by all of them
+            self._counters_reporter = task_jobs.start_job(
+                'counters', self._report_counters,
+                self.conf.task_metrics_interval, leased=False)
+
+    def _prune_tasks(self):
+        try:
+            archive = None
+            if self.conf.task_archive_dir:
+                archive = task_archive.TaskArchiveWriter(
+                    self.conf.task_archive_dir,
+                    segment_size=self.conf.task_archive_segment_size)
+            count = task.prune_tasks(
+                db.get_session(),
+                max_age=self.conf.task_retention_age,
+                keep=self.conf.task_retention_count,
+                batch_size=self.conf.task_prune_batch_size,
+                batch_interval=self.conf.task_prune_batch_interval,
+                archive=archive,
+                keep_going=self._pruner and self._pruner.renew)
+            LOG.info(_LI("Pruned %d processed tasks"), count)
+        except Exception:
+            LOG.exception(_LE("Failed to prune processed tasks"))
+
+    def _task_lane(self, context, count, bulk=False):
+        # Lane of the tasks of a change, according to the rate of its tenant.
+        # The tasks of a bulk request are in the bulk lane, but still count
+        # against the rate of the tenant.
+        lane = task.LANE_BULK if bulk else task.LANE_INTERACTIVE
+        tenant_id = context.tenant
+        if tenant_id is None:
+            return lane
+        retry_after = self._rate_limiter.consume(tenant_id, count)
+        if not retry_after:
+            return lane
+        if self.conf.task_tenant_overflow == 'reject':
+            raise mido_exc.TaskRateLimitExceeded(
+                tenant_id=tenant_id, retry_after=int(math.ceil(retry_after)))
+        return task.LANE_BULK
+
+    def _dependencies(self, type, data_type, data):
+        if not self.conf.task_dependencies:
+            return None
+        return task.get_task_dependencies(type, data_type, data)
+
+    def _create_task(self, context, type, data_type, resource_id, data=None):
+        task.create_task(context, type, data_type=data_type,
+                         resource_id=resource_id, data=data,
+                         lane=self._task_lane(context, 1),
+                         depends_on=self._dependencies(type, data_type, data))
+
+    def _create_tasks(self, context, type, data_type, resources, bulk=True):
+        # Tasks of a batch of resources, inserted together at the flush
+        task.create_tasks(context, [
+            {'type': type,
+             'data_type': data_type,
+             'resource_id': resource['id'],
+             'data': resource,
+             'depends_on': self._dependencies(type, data_type, resource)}
+            for resource in resources],
+            lane=self._task_lane(context, len(resources), bulk=bulk))
+
+    def _send_metrics(self, values, prometheus_file):
+        conf = self.conf
+        if conf.task_metrics_statsd_host:
+            metrics.send_statsd(values, conf.task_metrics_statsd_host,
+                                conf.task_metrics_statsd_port,
+                                conf.task_metrics_prefix)
+        if prometheus_file:
+            metrics.write_prometheus_file(prometheus_file, values,
+                                          conf.task_metrics_prefix)
+
+    def _report_metrics(self):
+        try:
+            stats = task.get_task_stats(
+                db.get_session(), rate_window=self.conf.task_metrics_interval)
+            self._send_metrics(metrics.task_stats_metrics(stats),
+                               self.conf.task_metrics_prometheus_file)
+        except Exception:
+            LOG.exception(_LE("Failed to report the task queue metrics"))
+
+    def _report_counters(self):
+        path = self.conf.task_metrics_prometheus_file
+        try:
+            values = metrics.process_metrics(metrics.counter_metrics() +
+                                             self._rate_limiter.metrics())
+            if path:
+                metrics.remove_stale_process_files(path)
+                path = metrics.process_file(path)
+            self._send_metrics(values, path)
+        except Exception:
+            LOG.exception(_LE("Failed to report the task counters"))
 
     def create_network_precommit(self, context, network):
-        task.create_task(context, task.CREATE, data_type=task.NETWORK,
-                         resource_id=network['id'], data=network)
+        self._create_task(context, task.CREATE, data_type=task.NETWORK,
+                          resource_id=network['id'], data=network)
+
+    def create_network_bulk_precommit(self, context, networks):
+        self._create_tasks(context, task.CREATE, task.NETWORK, networks)
 
     def update_network_precommit(self, context, network_id, network):
-        task.create_task(context, task.UPDATE, data_type=task.NETWORK,
-                         resource_id=network_id, data=network)
+        self._create_task(context, task.UPDATE, data_type=task.NETWORK,
+                          resource_id=network_id, data=network)
 
     def delete_network_precommit(self, context, network_id):
-        task.create_task(context, task.DELETE, data_type=task.NETWORK,
-                         resource_id=network_id)
+        self._create_task(context, task.DELETE, data_type=task.NETWORK,
+                          resource_id=network_id)
 
     def create_subnet_precommit(self, context, subnet):
-        task.create_task(context, task.CREATE, data_type=task.SUBNET,
-                         resource_id=subnet['id'], data=subnet)
+        self._create_task(context, task.CREATE, data_type=task.SUBNET,
+                          resource_id=subnet['id'], data=subnet)
 
     def update_subnet_precommit(self, context, subnet_id, subnet):
-        task.create_task(context, task.UPDATE, data_type=task.SUBNET,
-                         resource_id=subnet_id, data=subnet)
+        self._create_task(context, task.UPDATE, data_type=task.SUBNET,
+                          resource_id=subnet_id, data=subnet)
 
     def delete_subnet_precommit(self, context, subnet_id):
-        task.create_task(context, task.DELETE, data_type=task.SUBNET,
-                         resource_id=subnet_id)
+        self._create_task(context, task.DELETE, data_type=task.SUBNET,
+                          resource_id=subnet_id)
 
     def create_port_precommit(self, context, port):
-        task.create_task(context, task.CREATE, data_type=task.PORT,
-                         resource_id=port['id'], data=port)
+        self._create_task(context, task.CREATE, data_type=task.PORT,
+                          resource_id=port['id'], data=port)
+
+    def create_port_bulk_precommit(self, context, ports):
+        self._create_tasks(context, task.CREATE, task.PORT, ports)
 
     def update_port_precommit(self, context, port_id, port):
-        task.create_task(context, task.UPDATE, data_type=task.PORT,
-                         resource_id=port_id, data=port)
+        self._create_task(context, task.UPDATE, data_type=task.PORT,
+                          resource_id=port_id, data=port)
 
     def delete_port_precommit(self, context, port_id):
-        task.create_task(context, task.DELETE, data_type=task.PORT,
-                         resource_id=port_id)
+        self._create_task(context, task.DELETE, data_type=task.PORT,
+                          resource_id=port_id)
 
     def create_router_precommit(self, context, router):
-        task.create_task(context, task.CREATE, data_type=task.ROUTER,
-                         resource_id=router['id'], data=router)
+        self._create_task(context, task.CREATE, data_type=task.ROUTER,
+                          resource_id=router['id'], data=router)
 
     def update_router_precommit(self, context, router_id, router):
-        task.create_task(context, task.UPDATE, data_type=task.ROUTER,
-                         resource_id=router_id, data=router)
+        self._create_task(context, task.UPDATE, data_type=task.ROUTER,
+                          resource_id=router_id, data=router)
 
     def delete_router_precommit(self, context, router_id):
-        task.create_task(context, task.DELETE, data_type=task.ROUTER,
-                         resource_id=router_id)
+        self._create_task(context, task.DELETE, data_type=task.ROUTER,
+                          resource_id=router_id)
 
     def create_floatingip_precommit(self, context, floatingip):
-        task.create_task(context, task.CREATE, data_type=task.FLOATING_IP,
-                         resource_id=floatingip['id'], data=floatingip)
+        self._create_task(context, task.CREATE, data_type=task.FLOATING_IP,
+                          resource_id=floatingip['id'], data=floatingip)
 
     def update_floatingip_precommit(self, context, floatingip_id, floatingip):
-        task.create_task(context, task.UPDATE, data_type=task.FLOATING_IP,
-                         resource_id=floatingip_id, data=floatingip)
+        self._create_task(context, task.UPDATE, data_type=task.FLOATING_IP,
+                          resource_id=floatingip_id, data=floatingip)
 
     def delete_floatingip_precommit(self, context, floatingip_id):
-        task.create_task(context, task.DELETE, data_type=task.FLOATING_IP,
-                         resource_id=floatingip_id)
+        self._create_task(context, task.DELETE, data_type=task.FLOATING_IP,
+                          resource_id=floatingip_id)
 
     def create_security_group_precommit(self, context, security_group):
-        task.create_task(context, task.CREATE, data_type=task.SECURITY_GROUP,
-                         resource_id=security_group['id'], data=security_group)
+        # The rules, including those of a default security group, are
+        # carried in the data of the security group task.
+        self._create_tasks(context, task.CREATE, task.SECURITY_GROUP,
+                           [security_group], bulk=False)
 
     def delete_security_group_precommit(self, context, security_group_id):
-        task.create_task(context, task.DELETE, data_type=task.SECURITY_GROUP,
-                         resource_id=security_group_id)
+        self._create_task(context, task.DELETE, data_type=task.SECURITY_GROUP,
+                          resource_id=security_group_id)
 
     def create_security_group_rule_precommit(self, context,
                                              security_group_rule):
-        task.create_task(context, task.CREATE,
-                         data_type=task.SECURITY_GROUP_RULE,
-                         resource_id=security_group_rule['id'],
-                         data=security_group_rule)
+        self._create_task(context, task.CREATE,
+                          data_type=task.SECURITY_GROUP_RULE,
+                          resource_id=security_group_rule['id'],
+                          data=security_group_rule)
+
+    def create_security_group_rule_bulk_precommit(self, context,
+                                                  security_group_rules):
+        self._create_tasks(context, task.CREATE, task.SECURITY_GROUP_RULE,
+                           security_group_rules)
 
     def delete_security_group_rule_precommit(self, context,
                                              security_group_rule_id):
-        task.create_task(context, task.DELETE,
-                         data_type=task.SECURITY_GROUP_RULE,
-                         resource_id=security_group_rule_id)
+        self._create_task(context, task.DELETE,
+                          data_type=task.SECURITY_GROUP_RULE,
+                          resource_id=security_group_rule_id)
 
     # Agent membership extension
 
     def create_agent_membership_precommit(self, context, agent_membership):
-        task.create_task(context, task.CREATE, data_type=task.AGENT_MEMBERSHIP,
-                         resource_id=agent_membership['id'],
-                         data=agent_membership)
+        self._create_task(context, task.CREATE,
+                          data_type=task.AGENT_MEMBERSHIP,
+                          resource_id=agent_membership['id'],
+                          data=agent_membership)
 
     def delete_agent_membership_precommit(self, context, agent_membership_id):
-        task.create_task(context, task.DELETE, data_type=task.AGENT_MEMBERSHIP,
-                         resource_id=agent_membership_id)
+        self._create_task(context, task.DELETE,
+                          data_type=task.AGENT_MEMBERSHIP,
+                          resource_id=agent_membership_id)
 
     # Agent extension
 
@@ -142,50 +284,52 @@ class MidonetClusterClient(base.MidonetClientBase):
     # LBaaS
 
     def create_vip(self, context, vip):
-        task.create_task(context, task.CREATE, data_type=task.VIP,
-                         resource_id=vip['id'], data=vip)
+        self._create_task(context, task.CREATE, data_type=task.VIP,
+                          resource_id=vip['id'], data=vip)
 
     def update_vip(self, context, vip_id, vip):
-        task.create_task(context, task.UPDATE, data_type=task.VIP,
-                         resource_id=vip_id, data=vip)
+        self._create_task(context, task.UPDATE, data_type=task.VIP,
+                          resource_id=vip_id, data=vip)
 
     def delete_vip(self, context, vip_id):
-        task.create_task(context, task.DELETE, data_type=task.VIP,
-                         resource_id=vip_id)
+        self._create_task(context, task.DELETE, data_type=task.VIP,
+                          resource_id=vip_id)
 
     def create_pool(self, context, pool):
-        task.create_task(context, task.CREATE, data_type=task.POOL,
-                         resource_id=pool['id'], data=pool)
+        self._create_task(context, task.CREATE, data_type=task.POOL,
+                          resource_id=pool['id'], data=pool)
 
     def update_pool(self, context, pool_id, pool):
-        task.create_task(context, task.UPDATE, data_type=task.POOL,
-                         resource_id=pool_id, data=pool)
+        self._create_task(context, task.UPDATE, data_type=task.POOL,
+                          resource_id=pool_id, data=pool)
 
     def delete_pool(self, context, pool_id):
-        task.create_task(context, task.DELETE, data_type=task.POOL,
-                         resource_id=pool_id)
+        self._create_task(context, task.DELETE, data_type=task.POOL,
+                          resource_id=pool_id)
 
     def create_member(self, context, member):
-        task.create_task(context, task.CREATE, data_type=task.MEMBER,
-                         resource_id=member['id'], data=member)
+        self._create_task(context, task.CREATE, data_type=task.MEMBER,
+                          resource_id=member['id'], data=member)
 
     def update_member(self, context, member_id, member):
-        task.create_task(context, task.UPDATE, data_type=task.MEMBER,
-                         resource_id=member_id, data=member)
+        self._create_task(context, task.UPDATE, data_type=task.MEMBER,
+                          resource_id=member_id, data=member)
 
     def delete_member(self, context, member_id):
-        task.create_task(context, task.DELETE, data_type=task.MEMBER,
-                         resource_id=member_id)
+        self._create_task(context, task.DELETE, data_type=task.MEMBER,
+                          resource_id=member_id)
 
     def create_health_monitor(self, context, health_monitor):
-        task.create_task(context, task.CREATE, data_type=task.HEALTH_MONITOR,
-                         resource_id=health_monitor['id'], data=health_monitor)
+        self._create_task(context, task.CREATE,
+                          data_type=task.HEALTH_MONITOR,
+                          resource_id=health_monitor['id'],
+                          data=health_monitor)
 
     def update_health_monitor(self, context, health_monitor_id,
                               health_monitor):
-        task.create_task(context, task.UPDATE, data_type=task.HEALTH_MONITOR,
-                         resource_id=health_monitor_id, data=health_monitor)
+        self._create_task(context, task.UPDATE, data_type=task.HEALTH_MONITOR,
+                          resource_id=health_monitor_id, data=health_monitor)
 
     def delete_health_monitor(self, context, health_monitor_id):
-        task.create_task(context, task.DELETE, data_type=task.HEALTH_MONITOR,
-                         resource_id=health_monitor_id)
+        self._create_task(context, task.DELETE, data_type=task.HEALTH_MONITOR,
+                          resource_id=health_monitor_id)
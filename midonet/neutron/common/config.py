@@ -37,6 +37,125 @@ mido_opts = [
                help=_('Port that the cluster service can be reached on')),
     cfg.StrOpt('client', default='midonet.neutron.client.api.MidonetApiClient',
                help=_('MidoNet client used to access MidoNet data storage.')),
+    cfg.StrOpt('task_data_format', default='json',
+               choices=['json', 'zlib', 'msgpack'],
+               help=_('Format of the data stored in the tasks, json, zlib '
+                      '(compressed JSON) or msgpack.  The cluster must '
+                      'support the chosen format.')),
+    cfg.BoolOpt('task_data_projection', default=False,
+                help=_('Remove from the task data the bookkeeping keys of '
+                       'the Neutron resources that the cluster never reads: '
+                       'the timestamps and the revision number.')),
+    cfg.BoolOpt('task_payload_dedup', default=False,
+                help=_('Store the task data in a table keyed by its hash, '
+                       'shared by all the tasks with the same data.  The '
+                       'cluster must support reading the data from it.')),
+    cfg.IntOpt('task_payload_overflow_size', default=0,
+               help=_('Store the task data longer than this number of '
+                      'characters in the payloads table, as with '
+                      'task_payload_dedup, to keep the tasks table narrow.  '
+                      '0 disables.  The cluster must support reading the '
+                      'data from it.')),
+    cfg.BoolOpt('task_suppress_noop_updates', default=True,
+                help=_('Do not create the UPDATE tasks whose data is the '
+                       'same as the latest data sent to the cluster for the '
+                       'resource.')),
+    cfg.BoolOpt('task_update_delta', default=False,
+                help=_('Store in UPDATE tasks only the top level keys that '
+                       'changed since the previous task of the resource, '
+                       'along with the ID of that base task.')),
+    cfg.IntOpt('task_delta_full_interval', default=10,
+               help=_('Maximum number of consecutive delta UPDATE tasks of '
+                      'a resource before its full data is stored again.')),
+    cfg.FloatOpt('task_delta_max_ratio', default=0.5,
+                 help=_('Full data is stored instead of a delta when the '
+                        'delta is larger than this fraction of it.')),
+    cfg.StrOpt('task_json_serializer', default='auto',
+               choices=['auto', 'json', 'simplejson', 'ujson'],
+               help=_('JSON library encoding the task data: the json '
+                      'module, simplejson or ujson.  auto uses ujson when '
+                      'it is installed, and json otherwise.')),
+    cfg.BoolOpt('task_dependencies', default=False,
+                help=_('Record in each task the IDs of the resources it '
+                       'references, e.g. the network, subnets and security '
+                       'groups of a port, so that the cluster can apply '
+                       'independent tasks concurrently.')),
+    cfg.BoolOpt('task_commit_order', default=False,
+                help=_('Serialize the commits of the transactions creating '
+                       'tasks, so that the task IDs follow the commit order '
+                       'and the cluster never has to wait for gaps in the '
+                       'IDs.  Every Neutron transaction creating tasks then '
+                       'holds a lock on a single row until it commits, '
+                       'which serializes them across all the API workers '
+                       'and servers and bounds the write throughput by the '
+                       'commit latency of the DB.')),
+    cfg.IntOpt('task_prune_interval', default=0,
+               help=_('Interval in seconds between runs of the processed '
+                      'tasks pruner.  A single process of all the Neutron '
+                      'servers runs it at a time.  0 disables the '
+                      'pruner.')),
+    cfg.IntOpt('task_prune_batch_size', default=1000,
+               help=_('Maximum number of tasks deleted per transaction by '
+                      'the pruner.')),
+    cfg.FloatOpt('task_prune_batch_interval', default=0.5,
+                 help=_('Time in seconds the pruner sleeps between two '
+                        'batches.')),
+    cfg.IntOpt('task_retention_age', default=0,
+               help=_('Minimum age in seconds of the processed tasks '
+                      'deleted by the pruner.')),
+    cfg.IntOpt('task_retention_count', default=0,
+               help=_('Number of the latest processed tasks never deleted '
+                      'by the pruner.')),
+    cfg.StrOpt('task_archive_dir',
+               help=_('Directory the pruner archives the processed tasks to '
+                      'before deleting them, in compressed segment files.  '
+                      'The tasks are not archived if unset.  The pruner '
+                      'moves between the Neutron servers, so with more '
+                      'than one server this must be a directory shared by '
+                      'all of them, e.g. on NFS.')),
+    cfg.IntOpt('task_archive_segment_size', default=64 * 1024 * 1024,
+               help=_('Size in bytes beyond which a task archive segment '
+                      'is sealed and a new one started.')),
+    cfg.FloatOpt('task_tenant_rate', default=0,
+                 help=_('Number of tasks per second a tenant can emit '
+                        'through each Neutron server worker.  0 disables '
+                        'the limit.')),
+    cfg.IntOpt('task_tenant_burst', default=100,
+               help=_('Number of tasks a tenant can emit at once beyond '
+                      'its rate.')),
+    cfg.StrOpt('task_tenant_overflow', default='bulk',
+               choices=['bulk', 'reject'],
+               help=_('What happens to the changes of a tenant over its '
+                      'task rate: their tasks go to the bulk lane, applied '
+                      'after the other tenants changes, or the request is '
+                      'rejected with a retry delay.')),
+    cfg.IntOpt('task_metrics_interval', default=0,
+               help=_('Interval in seconds between two reports of the task '
+                      'queue metrics.  0 disables the reports.')),
+    cfg.StrOpt('task_metrics_statsd_host',
+               help=_('Host of the statsd server the task queue metrics '
+                      'are sent to.')),
+    cfg.IntOpt('task_metrics_statsd_port', default=8125,
+               help=_('Port of the statsd server.')),
+    cfg.StrOpt('task_metrics_prometheus_file',
+               help=_('File the task queue metrics are written to in the '
+                      'Prometheus text format, e.g. for the textfile '
+                      'collector of the node exporter.  The counters of '
+                      'each process are written next to it, in a file '
+                      'named after its PID, e.g. midonet.1234.prom for '
+                      'midonet.prom, with a pid label.')),
+    cfg.StrOpt('task_metrics_prefix', default='midonet',
+               help=_('Prefix of the metric names.')),
+    cfg.StrOpt('task_doorbell', default='none',
+               choices=['none', 'udp', 'unix', 'tcp', 'pgnotify'],
+               help=_('How the cluster is told that new tasks were '
+                      'committed: none (the cluster polls the tasks), a '
+                      'UDP, UNIX socket or TCP message, or a PostgreSQL '
+                      'NOTIFY.')),
+    cfg.StrOpt('task_doorbell_address',
+               help=_('Address the task doorbell is sent to: host:port '
+                      'for udp and tcp, a socket path for unix and a '
+                      'channel name for pgnotify.')),
 ]
 
 cfg.CONF.register_opts(mido_opts, "MIDONET")
@@ -0,0 +1,379 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Doorbells telling the task consumer that new tasks were committed.
+
+A doorbell carries the highest committed task ID.  It is a hint only: it
+may be lost or arrive late, and the consumer must still read the tasks
+table to find the tasks to process.
+"""
+
+import os
+import socket
+import threading
+import time
+
+from midonet.neutron.common import metrics
+from neutron import i18n
+from oslo_log import log as logging
+import sqlalchemy as sa
+
+LOG = logging.getLogger(__name__)
+_LW = i18n._LW
+
+NONE = 'none'
+UDP = 'udp'
+UNIX = 'unix'
+TCP = 'tcp'
+PG_NOTIFY = 'pgnotify'
+
+DEFAULT_PORT = 8089
+DEFAULT_UNIX_PATH = '/var/run/midonet/task-doorbell.sock'
+DEFAULT_CHANNEL = 'midonet_tasks'
+
+
+def _parse_address(address):
+    host, _sep, port = (address or '').rpartition(':')
+    if not host:
+        return address or 'localhost', DEFAULT_PORT
+    return host, int(port)
+
+
+def encode_task_id(task_id):
+    return ('%d\n' % task_id).encode('ascii')
+
+
+def decode_task_ids(payload):
+    return [int(line) for line in payload.decode('ascii').split()]
+
+
+class Doorbell(object):
+
+    # Whether the doorbell is rung with notify() in the transaction
+    # committing the tasks, rather than with ring() after the commit
+    transactional = False
+
+    # Minimum number of seconds between two warnings about failed rings
+    warning_interval = 60
+
+    def __init__(self):
+        self._warned_at = None
+        self._failures = 0
+
+    def ring(self, task_id):
+        """Tell the consumer that the tasks up to task_id are committed.
+
+        It must not block the committing thread: the doorbell is a hint
+        and the consumer still polls the tasks.
+        """
+        pass
+
+    def notify(self, session, task_id):
+        """Ring the doorbell in the transaction committing task_id."""
+        pass
+
+    def ring_committed(self, task_id):
+        """Commit hook ringing the doorbell, recording its failures."""
+        try:
+            self.ring(task_id)
+        except Exception as ex:
+            # The cluster still finds the tasks by polling
+            self.failed(ex)
+
+    def notify_flushed(self, session, task_id):
+        """Flush hook ringing the doorbell, recording its failures."""
+        try:
+            # A failed notification must not roll back the tasks
+            with session.begin_nested():
+                self.notify(session, task_id)
+        except Exception as ex:
+            self.failed(ex)
+
+    def failed(self, ex):
+        """Record a failure to ring, logged once per warning interval."""
+        metrics.incr('task_doorbell_failed')
+        self._failures += 1
+        now = time.time()
+        if (self._warned_at is not None and
+                now - self._warned_at < self.warning_interval):
+            return
+        LOG.warning(_LW("Failed to ring the task doorbell %(count)d times, "
+                        "last error: %(ex)s"),
+                    {'count': self._failures, 'ex': ex})
+        self._warned_at = now
+        self._failures = 0
+
+    def close(self):
+        pass
+
+
+class UdpDoorbell(Doorbell):
+
+    def __init__(self, address):
+        super(UdpDoorbell, self).__init__()
+        self.address = _parse_address(address)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+    def ring(self, task_id):
+        self._sock.sendto(encode_task_id(task_id), self.address)
+
+    def close(self):
+        self._sock.close()
+
+
+class UnixDoorbell(Doorbell):
+
+    def __init__(self, address):
+        super(UnixDoorbell, self).__init__()
+        self.address = address or DEFAULT_UNIX_PATH
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # The ring is dropped rather than waited for when the queue of
+        # the consumer is full
+        self._sock.setblocking(False)
+
+    def ring(self, task_id):
+        try:
+            self._sock.sendto(encode_task_id(task_id), self.address)
+        except socket.error:
+            # Nobody is listening, the consumer falls back to polling
+            pass
+
+    def close(self):
+        self._sock.close()
+
+
+class TcpDoorbell(Doorbell):
+    """Doorbell sending the task IDs as lines on a TCP connection.
+
+    The task IDs are sent by a thread of the process, so that connecting
+    to the consumer does not block the committing threads.  The rings
+    pending while the thread is busy are coalesced into the highest task
+    ID.  The connection is opened on the first ring and opened again on
+    the next ring after a failure.
+    """
+
+    def __init__(self, address, timeout=1.0):
+        super(TcpDoorbell, self).__init__()
+        self.address = _parse_address(address)
+        self.timeout = timeout
+        self._sock = None
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def ring(self, task_id):
+        with self._cond:
+            if self._pid != os.getpid():
+                # First ring, or first one in a forked worker
+                self._start()
+            self._pending = max(task_id, self._pending or 0)
+            self._cond.notify()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._sock = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                task_id, self._pending = self._pending, None
+            try:
+                if self._sock is None:
+                    self._sock = socket.create_connection(self.address,
+                                                          self.timeout)
+                self._sock.sendall(encode_task_id(task_id))
+            except socket.error as ex:
+                self._close()
+                self.failed(ex)
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.timeout)
+        self._close()
+
+
+class PgNotifyDoorbell(Doorbell):
+    """Doorbell using the PostgreSQL NOTIFY command of the Neutron DB.
+
+    The NOTIFY is sent in the transaction committing the tasks, and
+    PostgreSQL delivers it when that transaction commits.
+    """
+
+    transactional = True
+
+    def __init__(self, address):
+        super(PgNotifyDoorbell, self).__init__()
+        self.channel = address or DEFAULT_CHANNEL
+
+    def notify(self, session, task_id):
+        session.execute(sa.text('SELECT pg_notify(:channel, :payload)'),
+                        {'channel': self.channel, 'payload': str(task_id)})
+
+
+_DOORBELLS = {
+    UDP: UdpDoorbell,
+    UNIX: UnixDoorbell,
+    TCP: TcpDoorbell,
+    PG_NOTIFY: PgNotifyDoorbell,
+}
+
+
+def get_doorbell(backend, address=None):
+    if backend == NONE:
+        return None
+    return _DOORBELLS[backend](address)
+
+
+_STARTED = {}
+_started_lock = threading.Lock()
+
+
+def start_doorbell(backend, address=None):
+    """Return the doorbell of this process, created at the first call.
+
+    The clients of a process, like those of the core plugin and of the ML2
+    driver, share it and register the same hook, so that a commit rings
+    it once.
+    """
+    if backend == NONE:
+        return None
+    with _started_lock:
+        bell = _STARTED.get((backend, address))
+        if bell is None:
+            bell = _STARTED[(backend, address)] = get_doorbell(backend,
+                                                              address)
+        return bell
+
+
+class DoorbellListener(object):
+    """Local listener standing in for the task consumer.
+
+    It receives the doorbells of the UDP, UNIX and TCP backends in a
+    thread, and records the highest task ID received.
+    """
+
+    def __init__(self, backend, address=None):
+        self.backend = backend
+        self.last_task_id = 0
+        self.count = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        if backend == UDP:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind(_parse_address(address))
+        elif backend == UNIX:
+            address = address or DEFAULT_UNIX_PATH
+            if os.path.exists(address):
+                os.unlink(address)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(address)
+        elif backend == TCP:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(_parse_address(address))
+            self._sock.listen(5)
+        else:
+            raise ValueError(backend)
+        self.address = self._sock.getsockname()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _received(self, payload):
+        ids = decode_task_ids(payload)
+        if not ids:
+            return
+        with self._cond:
+            self.count += len(ids)
+            self.last_task_id = max([self.last_task_id] + ids)
+            self._cond.notify_all()
+
+    def _run(self):
+        try:
+            if self.backend == TCP:
+                while True:
+                    conn, _addr = self._sock.accept()
+                    reader = threading.Thread(target=self._read, args=(conn,))
+                    reader.daemon = True
+                    reader.start()
+            else:
+                while True:
+                    payload = self._sock.recv(4096)
+                    if self._closed:
+                        return
+                    self._received(payload)
+        except socket.error:
+            if not self._closed:
+                LOG.warning(_LW("Doorbell listener stopped"), exc_info=True)
+
+    def _read(self, conn):
+        buf = b''
+        try:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                buf += data
+                lines, _sep, buf = buf.rpartition(b'\n')
+                self._received(lines)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def wait(self, task_id, timeout=None):
+        """Wait until a doorbell for task_id or a later task is received.
+
+        :returns: Whether it was received before the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self.last_task_id < task_id:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self):
+        self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        if self.backend == UNIX:
+            os.unlink(self.address)
@@ -30,3 +30,22 @@ class InvalidMidonetDataState(exc.NeutronException):
     i.e. missing some table that should always be present
     """
     pass
+
+
+class TaskTransactionIncomplete(exc.NeutronException):
+    message = _("Tasks of transaction header %(id)s do not match the header: "
+                "%(count)s tasks read, %(expected)s expected")
+
+
+class TaskRateLimitExceeded(exc.ServiceUnavailable):
+    message = _("Too many changes from tenant %(tenant_id)s, retry after "
+                "%(retry_after)s seconds")
+
+    def __init__(self, **kwargs):
+        self.retry_after = kwargs.get('retry_after')
+        super(TaskRateLimitExceeded, self).__init__(**kwargs)
+
+
+class TaskArchiveOutOfOrder(exc.NeutronException):
+    message = _("Task %(id)s is not archived and older than the last "
+                "archived task %(last_id)s")
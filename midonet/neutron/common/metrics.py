@@ -0,0 +1,181 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Plugin metrics, formatted for statsd or the Prometheus text format."""
+
+import collections
+import errno
+import glob
+import os
+import socket
+import threading
+
+_counters = collections.defaultdict(int)
+_lock = threading.Lock()
+
+# Type and help of the metric families, for the Prometheus text format
+METRIC_FAMILIES = {
+    'task_max_id': ('gauge', 'Highest task ID'),
+    'task_last_processed_id': ('gauge',
+                               'ID of the last task processed by the cluster'),
+    'task_backlog': ('gauge', 'Number of unprocessed tasks'),
+    'task_backlog_by_data_type': ('gauge',
+                                  'Number of unprocessed tasks per data type'),
+    'task_backlog_by_lane': ('gauge', 'Number of unprocessed tasks per lane'),
+    'task_oldest_unprocessed_age_seconds': (
+        'gauge', 'Age of the oldest unprocessed task'),
+    'task_insert_rate': ('gauge', 'Number of tasks created per second'),
+    'task_update_suppressed': ('counter',
+                               'Number of UPDATE tasks not changing the data'),
+    'task_payload_overflow': ('counter',
+                              'Number of payloads whose reference count '
+                              'overflowed'),
+    'task_config_unchanged': ('counter',
+                              'Number of CONFIG tasks not created as the '
+                              'configuration was unchanged'),
+    'task_doorbell_failed': ('counter', 'Number of failed doorbell rings'),
+    'task_tenant_emitted': ('counter',
+                            'Number of tasks of a tenant within its rate'),
+    'task_tenant_limited': ('counter',
+                            'Number of tasks of a tenant over its rate'),
+}
+
+
+def incr(name, value=1):
+    """Increment the process wide counter name by value."""
+    with _lock:
+        _counters[name] += value
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def task_stats_metrics(stats):
+    """Convert the result of task_db.get_task_stats to a list of metrics.
+
+    Each metric is a (name, labels, value) tuple, labels being a dict.  The
+    breakdowns of the backlog have their own names, so that summing the
+    series of a metric never counts a task twice.
+    """
+    metrics = [('task_max_id', {}, stats['max_task_id']),
+               ('task_last_processed_id', {}, stats['last_processed_task_id']),
+               ('task_backlog', {}, stats['backlog']),
+               ('task_oldest_unprocessed_age_seconds', {},
+                stats['oldest_unprocessed_age']),
+               ('task_insert_rate', {}, stats['insert_rate'])]
+    for data_type, count in sorted(stats['backlog_by_data_type'].items()):
+        metrics.append(('task_backlog_by_data_type', {'data_type': data_type},
+                        count))
+    for lane, count in sorted(stats['backlog_by_lane'].items()):
+        metrics.append(('task_backlog_by_lane', {'lane': lane}, count))
+    return metrics
+
+
+def counter_metrics(counters=None):
+    if counters is None:
+        counters = get_counters()
+    return [(name, {}, value) for name, value in sorted(counters.items())]
+
+
+def process_metrics(metrics, pid=None):
+    """Label the metrics of this process with its PID.
+
+    The counters are per process, and the processes of a Neutron server
+    report them separately.
+    """
+    pid = os.getpid() if pid is None else pid
+    return [(name, dict(labels, pid=pid), value)
+            for name, labels, value in metrics]
+
+
+def process_file(path, pid=None):
+    """Return the path of the metrics file of a process.
+
+    The PID is inserted before the extension, e.g. midonet.1234.prom for
+    midonet.prom.
+    """
+    root, ext = os.path.splitext(path)
+    return '%s.%d%s' % (root, os.getpid() if pid is None else pid, ext)
+
+
+def remove_stale_process_files(path):
+    """Remove the metrics files of the processes that are gone."""
+    root, ext = os.path.splitext(path)
+    for name in glob.glob('%s.*%s' % (root, ext)):
+        pid = name[len(root) + 1:len(name) - len(ext)]
+        if not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except OSError as ex:
+            if ex.errno == errno.ESRCH:
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+
+def format_prometheus(metrics, prefix='midonet'):
+    """Format the metrics in the Prometheus text format.
+
+    The series of a metric are grouped after the HELP and TYPE lines of
+    their family, in the order of the first series of each family.
+    """
+    families = collections.OrderedDict()
+    for name, labels, value in metrics:
+        families.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, series in families.items():
+        type_, help_ = METRIC_FAMILIES.get(name, ('untyped', name))
+        lines.append('# HELP %s_%s %s' % (prefix, name, help_))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, type_))
+        for labels, value in series:
+            label_text = ','.join('%s="%s"' % (k, v)
+                                  for k, v in sorted(labels.items()))
+            if label_text:
+                label_text = '{%s}' % label_text
+            lines.append('%s_%s%s %s' % (prefix, name, label_text, value))
+    return '\n'.join(lines) + '\n'
+
+
+def format_statsd(metrics, prefix='midonet'):
+    """Format the metrics as statsd gauges, the labels being name suffixes."""
+    lines = []
+    for name, labels, value in metrics:
+        parts = [prefix, name] + [str(v) for k, v in sorted(labels.items())]
+        lines.append('%s:%s|g' % ('.'.join(parts), value))
+    return lines
+
+
+def send_statsd(metrics, host, port=8125, prefix='midonet'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for line in format_statsd(metrics, prefix):
+            sock.sendto(line.encode('utf-8'), (host, port))
+    finally:
+        sock.close()
+
+
+def write_prometheus_file(path, metrics, prefix='midonet'):
+    """Write the metrics for the node exporter textfile collector.
+
+    The file is replaced atomically so that it is never read half written.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus(metrics, prefix))
+    os.rename(tmp_path, path)
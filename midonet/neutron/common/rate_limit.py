@@ -0,0 +1,127 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-tenant token buckets limiting the rate of task emission."""
+
+import collections
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Bucket of capacity tokens, refilled at rate tokens per second."""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, count, now):
+        """Take count tokens if available.
+
+        More tokens than the capacity are taken as a full bucket.
+
+        :returns: 0 if the tokens were taken, otherwise the number of
+                  seconds until they are available
+        """
+        self.refill(now)
+        count = min(count, self.capacity)
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0
+        return (count - self.tokens) / self.rate
+
+
+class TenantRateLimiter(object):
+    """Token bucket per tenant, with per-tenant emission counters.
+
+    The tasks within the limit of their tenant are counted as emitted, and
+    the others as limited.  The counters of a tenant that emitted no task
+    for idle_time seconds are dropped, its metrics restarting from zero if
+    it comes back.
+
+    :param rate: Tasks per second allowed per tenant.  0 disables the
+                 limit, the emissions being still counted.
+    :param burst: Number of tasks a tenant can emit at once
+    :param idle_time: Seconds after which the counters of a tenant without
+                      emissions are dropped
+    """
+
+    def __init__(self, rate, burst, clock=time.time, idle_time=3600):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.idle_time = idle_time
+        self.emitted = collections.defaultdict(int)
+        self.limited = collections.defaultdict(int)
+        self._buckets = {}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._last_sweep = clock()
+        self._sweep_interval = idle_time
+        if rate > 0:
+            self._sweep_interval = min(idle_time, float(burst) / rate)
+
+    def _sweep(self, now):
+        # A bucket back to full is the same as a new one: drop it so that
+        # the tenants seen once do not stay in memory.
+        for tenant_id, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[tenant_id]
+        for tenant_id, seen in list(self._last_seen.items()):
+            if now - seen >= self.idle_time:
+                del self._last_seen[tenant_id]
+                self.emitted.pop(tenant_id, None)
+                self.limited.pop(tenant_id, None)
+        self._last_sweep = now
+
+    def consume(self, tenant_id, count=1):
+        """Account for count tasks of a tenant.
+
+        :returns: 0 if the tenant is within its limit, otherwise the number
+                  of seconds after which it would be
+        """
+        with self._lock:
+            now = self.clock()
+            if now - self._last_sweep > self._sweep_interval:
+                self._sweep(now)
+            self._last_seen[tenant_id] = now
+            retry_after = 0
+            if self.rate > 0:
+                bucket = self._buckets.get(tenant_id)
+                if bucket is None:
+                    bucket = self._buckets[tenant_id] = TokenBucket(
+                        self.rate, self.burst, now)
+                retry_after = bucket.consume(count, now)
+            if retry_after:
+                self.limited[tenant_id] += count
+            else:
+                self.emitted[tenant_id] += count
+            return retry_after
+
+    def metrics(self):
+        """Return the per-tenant counters as (name, labels, value) tuples."""
+        with self._lock:
+            return ([('task_tenant_emitted', {'tenant_id': t}, n)
+                     for t, n in sorted(self.emitted.items())] +
+                    [('task_tenant_limited', {'tenant_id': t}, n)
+                     for t, n in sorted(self.limited.items())])
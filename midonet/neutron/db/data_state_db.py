@@ -13,12 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 from midonet.neutron.common import exceptions as exc
 from neutron.db import model_base
 import sqlalchemy as sa
+import time
 
 
 DATA_STATE_TABLE = 'midonet_data_state'
+TASK_PROGRESS_TABLE = 'midonet_task_progress'
 
 
 class DataState(model_base.BASEV2):
@@ -31,6 +34,15 @@ class DataState(model_base.BASEV2):
     readonly = sa.Column(sa.Boolean(), nullable=False)
 
 
+class TaskProgress(model_base.BASEV2):
+    """Progress of a task consumer, each consumer writing its own row."""
+    __tablename__ = TASK_PROGRESS_TABLE
+    consumer_id = sa.Column(sa.String(255), primary_key=True)
+    # No foreign key so that the pruner is free to delete the task
+    last_processed_task_id = sa.Column(sa.Integer())
+    updated_at = sa.Column(sa.DateTime(), nullable=False)
+
+
 def get_data_state(session):
     try:
         return session.query(DataState).one()
@@ -42,6 +54,79 @@ def get_data_state(session):
         raise exc.InvalidMidonetDataState(issue)
 
 
+def get_last_processed_task_id(session):
+    """Return the ID of the last task processed by all the consumers.
+
+    It is the lowest of the progress of the consumers recording it in their
+    own row and of the data state, which the MidoNet cluster still writes,
+    read without locking any row.  A consumer that processed no task yet
+    does not hold the pruning back.
+    """
+    ids = [session.query(DataState.last_processed_task_id).scalar(),
+           session.query(sa.func.min(
+               TaskProgress.last_processed_task_id)).scalar()]
+    ids = [i for i in ids if i is not None]
+    return min(ids) if ids else None
+
+
+def set_progress(session, consumer_id, task_id):
+    """Set the ID of the last task processed by a consumer."""
+    table = TaskProgress.__table__
+    values = {'last_processed_task_id': task_id,
+              'updated_at': datetime.datetime.utcnow()}
+    with session.begin(subtransactions=True):
+        result = session.execute(table.update().where(
+            table.c.consumer_id == consumer_id).values(**values))
+        if not result.rowcount:
+            session.execute(table.insert().values(consumer_id=consumer_id,
+                                                  **values))
+
+
+def delete_progress(session, consumer_id):
+    """Forget a consumer, which no longer holds the pruning back."""
+    with session.begin(subtransactions=True):
+        session.query(TaskProgress).filter(
+            TaskProgress.consumer_id == consumer_id).delete()
+
+
+class ProgressRecorder(object):
+    """Record the progress of a consumer, at most every interval seconds.
+
+    The progress is written when interval seconds elapsed or max_tasks
+    tasks were processed since it was last written, and by flush().  A
+    consumer restarting after a crash processes again at most that many
+    tasks.
+
+    :param session: Session in autocommit mode
+    :param consumer_id: Unique name of the consumer
+    """
+
+    def __init__(self, session, consumer_id, interval=0.5, max_tasks=1000,
+                 clock=time.time):
+        self.session = session
+        self.consumer_id = consumer_id
+        self.interval = interval
+        self.max_tasks = max_tasks
+        self.clock = clock
+        self._task_id = None
+        self._pending = 0
+        self._written_at = clock()
+
+    def record(self, task_id, count=1):
+        """Record that the tasks up to task_id, count more, are processed."""
+        self._task_id = task_id
+        self._pending += count
+        if (self._pending >= self.max_tasks or
+                self.clock() - self._written_at >= self.interval):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            set_progress(self.session, self.consumer_id, self._task_id)
+            self._pending = 0
+        self._written_at = self.clock()
+
+
 def set_data_state_readonly(session, val):
     session.query(DataState).update({'readonly': val})
     session.commit()
@@ -0,0 +1,45 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task transactions
+
+Revision ID: 0c7e9d15a2f3
+Revises: 6a1f2c4e7b90
+Create Date: 2015-09-23 09:44:52.871310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0c7e9d15a2f3'
+down_revision = '6a1f2c4e7b90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.create_table(
+        'midonet_task_transactions',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('transaction_id', sa.String(length=40)),
+        sa.Column('tenant_id', sa.String(length=255)),
+        sa.Column('commit_batch', sa.Integer()),
+        sa.Column('task_count', sa.Integer(), nullable=False),
+        sa.Column('first_task_id', sa.Integer(), nullable=False),
+        sa.Column('last_task_id', sa.Integer(), nullable=False),
+        sa.Column('checksum', sa.String(length=40), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False))
+    op.create_index('ix_midonet_task_transactions_first_task_id',
+                    'midonet_task_transactions', ['first_task_id'])
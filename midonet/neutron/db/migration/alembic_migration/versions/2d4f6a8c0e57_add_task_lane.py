@@ -0,0 +1,57 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task lane
+
+The column is nullable with a server default, and on MySQL it is added
+with its index in place without locking the table, like the indexes of
+3db450cfb645, so the migration can be applied while Neutron keeps
+inserting tasks.  On other backends an index that already exists is left
+untouched, so that it can be created beforehand with a non-blocking
+statement using the same name.
+
+Revision ID: 2d4f6a8c0e57
+Revises: b93d5e2a6c14
+Create Date: 2015-09-25 07:02:33.958140
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d4f6a8c0e57'
+down_revision = 'b93d5e2a6c14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TASKS_TABLE = 'midonet_tasks'
+INDEX = 'ix_midonet_tasks_lane'
+INDEX_COLUMNS = ['lane', 'shard_key', 'id']
+
+
+def upgrade():
+
+    bind = op.get_bind()
+    if bind.dialect.name == 'mysql':
+        op.execute("ALTER TABLE %s ADD COLUMN lane SMALLINT NULL DEFAULT 0, "
+                   "ADD INDEX %s (%s), ALGORITHM=INPLACE, LOCK=NONE" %
+                   (TASKS_TABLE, INDEX, ', '.join(INDEX_COLUMNS)))
+        return
+    op.add_column(TASKS_TABLE,
+                  sa.Column('lane', sa.SmallInteger(), nullable=True,
+                            server_default='0'))
+    existing = set(ix['name'] for ix in
+                   sa.inspect(bind).get_indexes(TASKS_TABLE))
+    if INDEX not in existing:
+        op.create_index(INDEX, TASKS_TABLE, INDEX_COLUMNS)
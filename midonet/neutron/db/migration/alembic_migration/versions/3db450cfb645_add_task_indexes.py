@@ -0,0 +1,61 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task indexes
+
+On MySQL the indexes are built in place without locking the table, so the
+migration can be applied while Neutron keeps inserting tasks.  On other
+backends an index that already exists is left untouched, so that it can be
+created beforehand with a non-blocking statement, such as PostgreSQL's
+CREATE INDEX CONCURRENTLY, using the same name.
+
+Revision ID: 3db450cfb645
+Revises: d64a7c4fb643
+Create Date: 2015-09-16 08:41:07.582136
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3db450cfb645'
+down_revision = 'd64a7c4fb643'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TASKS_TABLE = 'midonet_tasks'
+
+INDEXES = [
+    ('ix_midonet_tasks_resource_id', ['resource_id', 'data_type', 'id']),
+    ('ix_midonet_tasks_data_type', ['data_type', 'id']),
+    ('ix_midonet_tasks_tenant_id', ['tenant_id', 'id']),
+    ('ix_midonet_tasks_transaction_id', ['transaction_id', 'id']),
+    ('ix_midonet_tasks_created_at', ['created_at']),
+]
+
+
+def upgrade():
+
+    bind = op.get_bind()
+    existing = set(ix['name'] for ix in
+                   sa.inspect(bind).get_indexes(TASKS_TABLE))
+    for name, columns in INDEXES:
+        if name in existing:
+            continue
+        if bind.dialect.name == 'mysql':
+            op.execute("ALTER TABLE %s ADD INDEX %s (%s), "
+                       "ALGORITHM=INPLACE, LOCK=NONE" %
+                       (TASKS_TABLE, name, ', '.join(columns)))
+        else:
+            op.create_index(name, TASKS_TABLE, columns)
@@ -0,0 +1,37 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task shard key
+
+Revision ID: 5e0b8b4cd3b2
+Revises: 841c1bcf3564
+Create Date: 2015-09-21 08:12:40.519726
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e0b8b4cd3b2'
+down_revision = '841c1bcf3564'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    # Existing tasks get no shard key, which makes them barriers
+    op.add_column('midonet_tasks',
+                  sa.Column('shard_key', sa.Integer()))
+    op.add_column('midonet_task_current',
+                  sa.Column('shard_key', sa.Integer()))
@@ -0,0 +1,39 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task sequence
+
+Revision ID: 6a1f2c4e7b90
+Revises: 5e0b8b4cd3b2
+Create Date: 2015-09-22 05:31:07.104582
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a1f2c4e7b90'
+down_revision = '5e0b8b4cd3b2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    sequence = op.create_table(
+        'midonet_task_sequence',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column('value', sa.Integer(), nullable=False))
+    op.bulk_insert(sequence, [{'id': 1, 'value': 0}])
+    op.add_column('midonet_tasks',
+                  sa.Column('commit_batch', sa.Integer()))
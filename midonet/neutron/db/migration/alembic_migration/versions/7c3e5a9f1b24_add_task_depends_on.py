@@ -0,0 +1,34 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task depends on
+
+Revision ID: 7c3e5a9f1b24
+Revises: e41b7c9a3d68
+Create Date: 2015-09-29 09:47:20.318462
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c3e5a9f1b24'
+down_revision = 'e41b7c9a3d68'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.add_column('midonet_tasks',
+                  sa.Column('depends_on', sa.Text()))
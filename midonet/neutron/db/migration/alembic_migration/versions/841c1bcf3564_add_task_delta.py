@@ -0,0 +1,37 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task delta
+
+Revision ID: 841c1bcf3564
+Revises: a571e0086f0a
+Create Date: 2015-09-18 02:47:15.630178
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '841c1bcf3564'
+down_revision = 'a571e0086f0a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.add_column('midonet_tasks',
+                  sa.Column('base_task_id', sa.Integer()))
+    op.add_column('midonet_task_current',
+                  sa.Column('delta_count', sa.Integer(), nullable=False,
+                            server_default='0'))
@@ -0,0 +1,36 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task data format
+
+Revision ID: a571e0086f0a
+Revises: 3db450cfb645
+Create Date: 2015-09-17 05:22:48.119704
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a571e0086f0a'
+down_revision = '3db450cfb645'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.add_column('midonet_tasks',
+                  sa.Column('data_format', sa.String(length=16)))
+    op.add_column('midonet_task_current',
+                  sa.Column('data_format', sa.String(length=16)))
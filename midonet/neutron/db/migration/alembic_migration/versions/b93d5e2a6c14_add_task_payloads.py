@@ -0,0 +1,41 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task payloads
+
+Revision ID: b93d5e2a6c14
+Revises: 0c7e9d15a2f3
+Create Date: 2015-09-24 03:18:26.402957
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b93d5e2a6c14'
+down_revision = '0c7e9d15a2f3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.create_table(
+        'midonet_task_payloads',
+        sa.Column('hash', sa.String(length=40), primary_key=True),
+        sa.Column('data', sa.Text(length=2 ** 24), nullable=False),
+        sa.Column('data_format', sa.String(length=16)),
+        sa.Column('refcount', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False))
+    op.add_column('midonet_tasks',
+                  sa.Column('payload_hash', sa.String(length=40)))
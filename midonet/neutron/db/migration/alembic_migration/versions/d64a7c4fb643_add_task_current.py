@@ -0,0 +1,50 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task current
+
+Revision ID: d64a7c4fb643
+Revises: 422da2897701
+Create Date: 2015-09-14 10:12:31.402215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd64a7c4fb643'
+down_revision = '422da2897701'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.create_table(
+        'midonet_task_current',
+        sa.Column('data_type', sa.String(length=36), primary_key=True),
+        sa.Column('resource_id', sa.String(length=36), primary_key=True),
+        sa.Column('task_id', sa.Integer(), nullable=False),
+        sa.Column('data', sa.Text(length=2 ** 24)),
+        sa.Column('updated_at', sa.DateTime(), nullable=False))
+
+    # Backfill with the data of the latest task of every resource, unless
+    # that task is a deletion.
+    op.execute("INSERT INTO midonet_task_current "
+               "(data_type, resource_id, task_id, data, updated_at) "
+               "SELECT t.data_type, t.resource_id, t.id, t.data, t.created_at "
+               "FROM midonet_tasks t JOIN "
+               "(SELECT MAX(id) AS id FROM midonet_tasks "
+               "WHERE data_type IS NOT NULL AND resource_id IS NOT NULL "
+               "GROUP BY data_type, resource_id) latest ON t.id = latest.id "
+               "WHERE t.type != 'DELETE'")
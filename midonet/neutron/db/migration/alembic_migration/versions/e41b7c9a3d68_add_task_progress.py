@@ -0,0 +1,37 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task progress
+
+Revision ID: e41b7c9a3d68
+Revises: 2d4f6a8c0e57
+Create Date: 2015-09-28 03:15:42.527304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e41b7c9a3d68'
+down_revision = '2d4f6a8c0e57'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.create_table(
+        'midonet_task_progress',
+        sa.Column('consumer_id', sa.String(255), primary_key=True),
+        sa.Column('last_processed_task_id', sa.Integer()),
+        sa.Column('updated_at', sa.DateTime(), nullable=False))
@@ -0,0 +1,37 @@
+# Copyright 2015 Midokura SARL
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add task leases
+
+Revision ID: f2b8d6e1a935
+Revises: 7c3e5a9f1b24
+Create Date: 2015-10-05 11:26:48.609213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8d6e1a935'
+down_revision = '7c3e5a9f1b24'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+
+    op.create_table(
+        'midonet_task_leases',
+        sa.Column('name', sa.String(64), primary_key=True),
+        sa.Column('holder', sa.String(255), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False))
@@ -0,0 +1,231 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sys
+
+from midonet.neutron.common import config
+from midonet.neutron.common import metrics
+from midonet.neutron.db import task_archive
+from midonet.neutron.db import task_db
+from midonet.neutron.db import task_replay
+from neutron import i18n  # noqa
+from oslo_config import cfg
+from oslo_db import options as db_options
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+
+CONF = cfg.ConfigOpts()
+CONF.register_opts(db_options.database_opts, 'database')
+CONF.register_opts(config.mido_opts, 'MIDONET')
+
+TASK_LIST_FIELDS = ('id', 'type', 'data_type', 'resource_id', 'tenant_id',
+                    'transaction_id', 'created_at')
+
+
+def get_session():
+    engine = sa.create_engine(CONF.database.connection)
+    return orm.sessionmaker(bind=engine, autocommit=True)()
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    return timeutils.normalize_time(timeutils.parse_isotime(value))
+
+
+def task_list(session):
+    """Print the tasks matching the filters, one per line.
+
+    The tasks are streamed from the DB so that very large tables can be
+    listed without loading them in memory.
+    """
+    args = CONF.command
+    tasks = task_db.get_tasks(session,
+                              tenant_id=args.tenant_id,
+                              data_type=args.data_type,
+                              resource_id=args.resource_id,
+                              type=args.type,
+                              created_after=_parse_time(args.since),
+                              created_before=_parse_time(args.until),
+                              after_id=args.after_id,
+                              unprocessed=args.unprocessed,
+                              page_size=args.page_size)
+    out = sys.stdout
+    out.write('\t'.join(TASK_LIST_FIELDS) + '\n')
+    for task in tasks:
+        out.write('\t'.join(str(getattr(task, f)) for f in TASK_LIST_FIELDS))
+        out.write('\n')
+        if args.data:
+            out.write('\t%s\n' % task_db.task_data_to_json(
+                *task_db.get_task_data(session, task)))
+
+
+def task_stats(session):
+    """Print how far the cluster is behind in processing the tasks."""
+    args = CONF.command
+    stats = task_db.get_task_stats(session, rate_window=args.rate_window)
+    if args.format == 'json':
+        out = jsonutils.dumps(stats, sort_keys=True) + '\n'
+    elif args.format == 'prometheus':
+        out = metrics.format_prometheus(metrics.task_stats_metrics(stats))
+    else:
+        out = ''.join('%s\t%s\n' % (name, value) for name, value in
+                      sorted(stats.items()) if not isinstance(value, dict))
+        out += ''.join('backlog[%s]\t%s\n' % item for item in
+                       sorted(stats['backlog_by_data_type'].items()))
+        out += ''.join('backlog[lane=%s]\t%s\n' % item for item in
+                       sorted(stats['backlog_by_lane'].items()))
+    sys.stdout.write(out)
+
+
+def task_archive_list(session):
+    """Print the archived tasks in an ID range, one JSON object per line."""
+    args = CONF.command
+    archive_dir = args.archive_dir or CONF.MIDONET.task_archive_dir
+    if not archive_dir:
+        sys.exit(_('No archive directory given or configured'))
+    reader = task_archive.TaskArchiveReader(archive_dir)
+    out = sys.stdout
+    for record in reader.read(first_id=args.first_id,
+                              last_id=args.last_id):
+        if args.data and record['data'] is not None:
+            record['data'] = jsonutils.loads(task_db.task_data_to_json(
+                record['data_format'], record['data']))
+        out.write(jsonutils.dumps(record, sort_keys=True) + '\n')
+
+
+def task_replay_run(session):
+    """Replay the tasks of this database or of an archive into another one.
+
+    The report of the run is printed at the end.
+    """
+    args = CONF.command
+    if args.archive_dir:
+        records = task_replay.archive_records(args.archive_dir,
+                                              args.first_id, args.last_id)
+    else:
+        after_id = args.first_id - 1 if args.first_id else None
+        records = task_replay.db_records(session, after_id=after_id,
+                                         last_id=args.last_id)
+    engine = sa.create_engine(args.target)
+    replayer = task_replay.TaskReplayer(
+        orm.sessionmaker(bind=engine, autocommit=True),
+        speed=args.speed, concurrency=args.concurrency,
+        rewrite_uuids=not args.keep_uuids,
+        stats_interval=args.stats_interval)
+    report = replayer.replay(records)
+    sys.stdout.write(''.join('%s\t%s\n' % item
+                             for item in sorted(report.items())))
+
+
+def add_command_parsers(subparsers):
+    parser = subparsers.add_parser('task-list', help=_('List the tasks'))
+    parser.add_argument('-u', '--unprocessed', action='store_true',
+                        help=_('Show only the unprocessed tasks'))
+    parser.add_argument('--tenant-id', help=_('Filter by tenant ID'))
+    parser.add_argument('--data-type',
+                        help=_('Filter by data type, e.g. PORT'))
+    parser.add_argument('--resource-id', help=_('Filter by resource ID'))
+    parser.add_argument('--type', help=_('Filter by task type, e.g. CREATE'))
+    parser.add_argument('--since',
+                        help=_('Show tasks created at or after this UTC '
+                               'time (ISO 8601)'))
+    parser.add_argument('--until',
+                        help=_('Show tasks created before this UTC time '
+                               '(ISO 8601)'))
+    parser.add_argument('--after-id', type=int,
+                        help=_('Show tasks with an ID greater than this'))
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help=_('Number of tasks fetched per DB query'))
+    parser.add_argument('--data', action='store_true',
+                        help=_('Also print the task data'))
+    parser.set_defaults(func=task_list)
+
+    parser = subparsers.add_parser(
+        'task-stats', help=_('Show the task queue depth and processing lag'))
+    parser.add_argument('--rate-window', type=int, default=60,
+                        help=_('Period in seconds over which the task insert '
+                               'rate is computed'))
+    parser.add_argument('--format', default='text',
+                        choices=['text', 'json', 'prometheus'],
+                        help=_('Output format'))
+    parser.set_defaults(func=task_stats)
+
+    parser = subparsers.add_parser(
+        'task-archive-list', help=_('List the archived tasks'))
+    parser.add_argument('archive_dir', nargs='?',
+                        help=_('Directory of the task archive, by default '
+                               'the configured task_archive_dir'))
+    parser.add_argument('--first-id', type=int,
+                        help=_('Show tasks with an ID greater than or '
+                               'equal to this'))
+    parser.add_argument('--last-id', type=int,
+                        help=_('Show tasks with an ID less than or equal to '
+                               'this'))
+    parser.add_argument('--data', action='store_true',
+                        help=_('Decode the task data to JSON'))
+    parser.set_defaults(func=task_archive_list)
+
+    parser = subparsers.add_parser(
+        'task-replay', help=_('Replay the tasks into a target database'))
+    parser.add_argument('target',
+                        help=_('Connection URL of the target database'))
+    parser.add_argument('--archive-dir',
+                        help=_('Replay the tasks of this task archive '
+                               'instead of the tasks table'))
+    parser.add_argument('--first-id', type=int,
+                        help=_('Replay tasks with an ID greater than or '
+                               'equal to this'))
+    parser.add_argument('--last-id', type=int,
+                        help=_('Replay tasks with an ID less than or equal '
+                               'to this'))
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help=_('Pace multiplier relative to the recorded '
+                               'pace.  0 replays as fast as possible'))
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help=_('Number of transactions replayed '
+                               'concurrently'))
+    parser.add_argument('--keep-uuids', action='store_true',
+                        help=_('Do not rewrite the UUIDs of the tasks'))
+    parser.add_argument('--stats-interval', type=float, default=1.0,
+                        help=_('Interval in seconds between two samples of '
+                               'the consumer lag of the target'))
+    parser.set_defaults(func=task_replay_run)
+
+
+command_opt = cfg.SubCommandOpt('command',
+                                title='Command',
+                                help=_('Available commands'),
+                                handler=add_command_parsers)
+
+CONF.register_cli_opt(command_opt)
+
+
+def load_config(conf=cfg.CONF):
+    """Load the configuration files of the command line into conf.
+
+    The task modules read the [MIDONET] options of the global
+    configuration, as in the Neutron server.
+    """
+    conf(args=[], project='neutron', default_config_files=CONF.config_file)
+
+
+def main():
+    CONF(project='neutron')
+    load_config()
+    CONF.command.func(get_session())
@@ -0,0 +1,254 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Archive of the processed tasks in compressed append-only segment files.
+
+A segment is named after the ID of its first task and holds blocks of
+tasks in increasing ID order.  Each block is a frame header followed by
+zlib compressed newline delimited JSON, one task per line:
+
+    magic (4 bytes) | data length (4) | first task ID (8) | last task ID (8)
+
+When a segment grows beyond the segment size, it is sealed with an index
+footer, the compressed JSON list of the [first ID, last ID, offset] of its
+blocks, followed by a trailer:
+
+    magic (4 bytes) | index offset (8) | index length (4)
+
+and the next blocks go to a new segment.  Readers use the footer to seek
+to the blocks of an ID range, and scan the frame headers of the segment
+not sealed yet.
+"""
+
+import fcntl
+import glob
+import os
+import struct
+import zlib
+
+from midonet.neutron.common import exceptions as mido_exc
+from oslo_serialization import jsonutils
+
+BLOCK_MAGIC = b'MTB1'
+INDEX_MAGIC = b'MTI1'
+_BLOCK_HEADER = struct.Struct('>4sIqq')
+_TRAILER = struct.Struct('>4sQI')
+
+SEGMENT_PREFIX = 'tasks-'
+SEGMENT_SUFFIX = '.seg'
+_LOCK_FILE = '.lock'
+
+# Task columns saved in the archive
+TASK_FIELDS = ('id', 'type', 'tenant_id', 'data_type', 'resource_id',
+               'transaction_id', 'data_format', 'data', 'base_task_id',
+               'shard_key', 'lane', 'commit_batch', 'depends_on',
+               'created_at')
+
+
+def segment_name(first_id):
+    return '%s%020d%s' % (SEGMENT_PREFIX, first_id, SEGMENT_SUFFIX)
+
+
+def _segment_first_id(path):
+    name = os.path.basename(path)
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def list_segments(directory):
+    """Return the paths of the segments in the directory, in ID order."""
+    return sorted(glob.glob(os.path.join(
+        directory, '%s*%s' % (SEGMENT_PREFIX, SEGMENT_SUFFIX))))
+
+
+def task_record(task, data_format=None, data=None):
+    """Return the archive record of a Task, with the given data if any."""
+    record = dict((f, getattr(task, f)) for f in TASK_FIELDS)
+    if data is not None:
+        record['data_format'] = data_format
+        record['data'] = data
+    if task.created_at is not None:
+        record['created_at'] = task.created_at.isoformat()
+    return record
+
+
+def _read_trailer(f, size):
+    if size < _TRAILER.size:
+        return None
+    f.seek(size - _TRAILER.size)
+    magic, offset, length = _TRAILER.unpack(f.read(_TRAILER.size))
+    if magic != INDEX_MAGIC:
+        return None
+    f.seek(offset)
+    return jsonutils.loads(zlib.decompress(f.read(length)).decode('utf-8'))
+
+
+def _scan_blocks(f, size):
+    """Return the index of the complete blocks of a segment not sealed."""
+    index = []
+    offset = 0
+    while offset + _BLOCK_HEADER.size <= size:
+        f.seek(offset)
+        magic, length, first_id, last_id = _BLOCK_HEADER.unpack(
+            f.read(_BLOCK_HEADER.size))
+        end = offset + _BLOCK_HEADER.size + length
+        if magic != BLOCK_MAGIC or end > size:
+            break
+        index.append([first_id, last_id, offset])
+        offset = end
+    return index, offset
+
+
+def _read_index(f):
+    """Return the block index of a segment and whether it is sealed."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    index = _read_trailer(f, size)
+    if index is not None:
+        return index, True
+    return _scan_blocks(f, size)[0], False
+
+
+class TaskArchiveWriter(object):
+    """Append tasks to the segments of an archive directory.
+
+    Several writers, e.g. the pruners of several Neutron servers, can share
+    a directory: appends are serialized with a lock file, and the tasks
+    already archived are skipped, so a batch archived twice is only stored
+    once.  Appending a task older than the last archived one that is not
+    in the archive raises TaskArchiveOutOfOrder, as it cannot be archived
+    any more.
+
+    :param directory: Archive directory, created if needed
+    :param segment_size: Size in bytes beyond which a segment is sealed
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _seal(self, f, index):
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        data = zlib.compress(jsonutils.dumps(index).encode('utf-8'))
+        f.write(data)
+        f.write(_TRAILER.pack(INDEX_MAGIC, offset, len(data)))
+
+    def _last_segment(self):
+        # Return the open segment, its block index and its size, or Nones
+        # with the last archived task ID if all segments are sealed.
+        segments = list_segments(self.directory)
+        if not segments:
+            return None, None, 0, 0
+        path = segments[-1]
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            index = _read_trailer(f, size)
+            if index is not None:
+                return None, None, 0, index[-1][1] if index else 0
+            index, size = _scan_blocks(f, size)
+        return path, index, size, index[-1][1] if index else 0
+
+    def append(self, records):
+        """Archive task records, given in ID order.
+
+        The records are durably written when this returns.
+
+        :returns: Number of records archived
+        """
+        with open(os.path.join(self.directory, _LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._append(records)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append(self, records):
+        path, index, size, last_id = self._last_segment()
+        older = [r['id'] for r in records if r['id'] <= last_id]
+        if older:
+            archived = set(r['id'] for r in TaskArchiveReader(
+                self.directory).read(older[0], older[-1]))
+            for task_id in older:
+                if task_id not in archived:
+                    raise mido_exc.TaskArchiveOutOfOrder(id=task_id,
+                                                         last_id=last_id)
+        records = [r for r in records if r['id'] > last_id]
+        if not records:
+            return 0
+        if path is None:
+            path = os.path.join(self.directory,
+                                segment_name(records[0]['id']))
+            index = []
+        data = zlib.compress(''.join(
+            jsonutils.dumps(r) + '\n' for r in records).encode('utf-8'))
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            # Drop any partial block left by an interrupted append
+            f.truncate(size)
+            f.seek(size)
+            f.write(_BLOCK_HEADER.pack(BLOCK_MAGIC, len(data),
+                                       records[0]['id'], records[-1]['id']))
+            f.write(data)
+            index.append([records[0]['id'], records[-1]['id'], size])
+            if f.tell() >= self.segment_size:
+                self._seal(f, index)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(records)
+
+
+class TaskArchiveReader(object):
+    """Read the task records of an archive directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read(self, first_id=None, last_id=None):
+        """Yield the task records with an ID in [first_id, last_id].
+
+        The records are yielded in ID order, reading only the segments and
+        blocks that may hold tasks in the range.
+        """
+        segments = list_segments(self.directory)
+        for i, path in enumerate(segments):
+            if last_id is not None and _segment_first_id(path) > last_id:
+                return
+            if (first_id is not None and i + 1 < len(segments) and
+                    _segment_first_id(segments[i + 1]) <= first_id):
+                continue
+            for record in self._read_segment(path, first_id, last_id):
+                yield record
+
+    def _read_segment(self, path, first_id, last_id):
+        with open(path, 'rb') as f:
+            index, _sealed = _read_index(f)
+            for block_first, block_last, offset in index:
+                if first_id is not None and block_last < first_id:
+                    continue
+                if last_id is not None and block_first > last_id:
+                    return
+                f.seek(offset)
+                _magic, length, _first, _last = _BLOCK_HEADER.unpack(
+                    f.read(_BLOCK_HEADER.size))
+                lines = zlib.decompress(f.read(length)).decode('utf-8')
+                for line in lines.splitlines():
+                    record = jsonutils.loads(line)
+                    if first_id is not None and record['id'] < first_id:
+                        continue
+                    if last_id is not None and record['id'] > last_id:
+                        return
+                    yield record
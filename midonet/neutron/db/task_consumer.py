@@ -0,0 +1,277 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Reference consumer of the tasks table.
+
+It shows how the ordering contract of the tasks can be used to apply them
+in parallel, and is used by the tests and benchmarks.  The contract is:
+
+ * Tasks with the same shard key are applied in ID order.
+ * A task without shard key is a barrier: it is applied once all the tasks
+   with a lower ID are applied, and before any task with a higher ID.
+
+The tasks recording their dependencies allow a finer ordering, computed by
+dependency_levels.
+"""
+
+import threading
+
+from midonet.neutron.db import task_db
+from six.moves import queue
+import sqlalchemy as sa
+
+
+class TaskConsumer(object):
+    """Apply the tasks with a pool of workers, one queue per worker.
+
+    :param apply_task: Function applying a task, called with the Task
+    :param workers: Number of workers.  The tasks of a shard always go to
+                    the same worker.
+    :param progress: data_state_db.ProgressRecorder of the consumer
+    """
+
+    def __init__(self, apply_task, workers=1, progress=None):
+        self.apply_task = apply_task
+        self.workers = workers
+        self.progress = progress
+
+    def _record(self, task_id, count):
+        if self.progress is not None and count:
+            self.progress.record(task_id, count)
+
+    def _flush(self):
+        if self.progress is not None:
+            self.progress.flush()
+
+    def _work(self, tasks, errors):
+        while True:
+            task = tasks.get()
+            try:
+                if task is None:
+                    return
+                if not errors:
+                    self.apply_task(task)
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                tasks.task_done()
+
+    def consume(self, session, after_id=0, page_size=1000):
+        """Apply the tasks with an ID greater than after_id.
+
+        :returns: ID of the last applied task
+        """
+        if self.workers == 1:
+            for task in task_db.get_tasks(session, after_id=after_id,
+                                          page_size=page_size):
+                self.apply_task(task)
+                after_id = task.id
+                self._record(after_id, 1)
+            self._flush()
+            return after_id
+
+        queues = [queue.Queue() for _i in range(self.workers)]
+        errors = []
+        threads = [threading.Thread(target=self._work, args=(q, errors))
+                   for q in queues]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Tasks queued since the progress was last recorded.  Being applied
+        # out of order, they are only recorded once the queues are drained.
+        queued = [0]
+
+        def drain():
+            for q in queues:
+                q.join()
+            if errors:
+                raise errors[0]
+            self._record(last_id, queued[0])
+            queued[0] = 0
+
+        last_id = after_id
+        try:
+            for task in task_db.get_tasks(session, after_id=after_id,
+                                          page_size=page_size):
+                if task.shard_key is None:
+                    drain()
+                    self.apply_task(task)
+                    self._record(task.id, 1)
+                else:
+                    queues[task.shard_key % self.workers].put(task)
+                    queued[0] += 1
+                last_id = task.id
+            drain()
+            self._flush()
+        finally:
+            for q in queues:
+                q.put(None)
+            for thread in threads:
+                thread.join()
+        return last_id
+
+
+class LaneConsumer(object):
+    """Apply the interactive lane tasks ahead of the bulk lane tasks.
+
+    An interactive task is applied ahead of the earlier bulk tasks only
+    when none of them has its shard key or is a barrier, so that the
+    ordering contract still holds across the lanes, and in particular the
+    tasks of a resource are always applied in ID order.  The other tasks
+    are applied in ID order, at most bulk_batch bulk tasks per round.
+
+    :param apply_task: Function applying a task, called with the Task
+    :param bulk_batch: Maximum number of bulk tasks applied per round
+    :param progress: data_state_db.ProgressRecorder of the consumer, given
+                     the ID up to which all the tasks are applied
+    """
+
+    def __init__(self, apply_task, bulk_batch=100, after_id=0,
+                 progress=None):
+        self.apply_task = apply_task
+        self.bulk_batch = bulk_batch
+        self.progress = progress
+        # All the tasks up to last_id are applied, plus the ones in
+        # _applied, applied ahead of their turn.
+        self.last_id = after_id
+        self._applied = set()
+
+    def _bulk_before(self, session, task):
+        Task = task_db.Task
+        query = session.query(Task.id).filter(
+            Task.lane == task_db.LANE_BULK,
+            Task.id > self.last_id, Task.id < task.id)
+        if task.shard_key is not None:
+            query = query.filter(sa.or_(Task.shard_key == task.shard_key,
+                                        Task.shard_key.is_(None)))
+        return session.query(query.exists()).scalar()
+
+    def _apply_interactive(self, session, limit):
+        Task = task_db.Task
+        count = 0
+        blocked_shards = set()
+        tasks = session.query(Task).filter(
+            Task.lane == task_db.LANE_INTERACTIVE,
+            Task.id > self.last_id).order_by(Task.id).limit(limit).all()
+        for task in task_db.load_task_data(session, tasks):
+            if task.id in self._applied:
+                continue
+            if task.shard_key is None:
+                if blocked_shards or self._bulk_before(session, task):
+                    # Barrier: nothing after it can go ahead
+                    break
+            elif (task.shard_key in blocked_shards or
+                    self._bulk_before(session, task)):
+                blocked_shards.add(task.shard_key)
+                continue
+            self.apply_task(task)
+            self._applied.add(task.id)
+            count += 1
+        return count
+
+    def _apply_in_order(self, session):
+        count = 0
+        bulk = 0
+        advanced = 0
+        for task in task_db.get_tasks(session, after_id=self.last_id,
+                                      page_size=self.bulk_batch):
+            if task.lane == task_db.LANE_BULK:
+                if bulk == self.bulk_batch:
+                    break
+                bulk += 1
+            if task.id in self._applied:
+                self._applied.discard(task.id)
+            else:
+                self.apply_task(task)
+                count += 1
+            self.last_id = task.id
+            advanced += 1
+        if self.progress is not None and advanced:
+            self.progress.record(self.last_id, advanced)
+        return count
+
+    def run_once(self, session, interactive_batch=1000):
+        """Apply a round of tasks, the interactive ones first.
+
+        :returns: Number of applied tasks
+        """
+        return (self._apply_interactive(session, interactive_batch) +
+                self._apply_in_order(session))
+
+    def consume(self, session):
+        """Apply all the tasks.
+
+        :returns: ID of the last applied task
+        """
+        while self.run_once(session):
+            pass
+        if self.progress is not None:
+            self.progress.flush()
+        return self.last_id
+
+
+def dependency_levels(tasks):
+    """Group tasks in levels of tasks that can be applied concurrently.
+
+    A task writes its resource and reads the resources it depends on.  It
+    is ordered after the earlier tasks writing a resource it reads or
+    writes, and after the earlier tasks reading the resource it writes.  A
+    task without resource ID or recorded dependencies is a barrier.  The
+    levels are applied one after the other, the tasks of a level in any
+    order.
+
+    :param tasks: Window of tasks in ID order, all the tasks before it
+                  being applied
+    :returns: List of the levels, lists of tasks
+    """
+    levels = []
+    last_write = {}
+    last_read = {}
+    # First level after the last barrier
+    floor = 0
+    for task in tasks:
+        reads = task_db.task_dependencies(task)
+        if task.resource_id is None or reads is None:
+            level = len(levels)
+            floor = level + 1
+        else:
+            written = task.resource_id
+            level = max(floor, last_write.get(written, -1) + 1,
+                        last_read.get(written, -1) + 1)
+            for resource_id in reads:
+                level = max(level, last_write.get(resource_id, -1) + 1)
+            last_write[written] = level
+            for resource_id in reads:
+                last_read[resource_id] = max(
+                    last_read.get(resource_id, -1), level)
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(task)
+    return levels
+
+
+def dependency_parallelism(tasks):
+    """Return the parallelism dependency_levels reaches on tasks.
+
+    :returns: dict with the number of tasks and of levels, and the maximum
+              and mean number of tasks per level
+    """
+    widths = [len(level) for level in dependency_levels(tasks)]
+    count = sum(widths)
+    return {'tasks': count,
+            'levels': len(widths),
+            'max_parallelism': max(widths) if widths else 0,
+            'mean_parallelism': float(count) / len(widths) if widths else 0}
@@ -12,14 +12,33 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import collections
 import datetime
+import hashlib
+import json
+from midonet.neutron.common import config  # noqa
+from midonet.neutron.common import exceptions as mido_exc
+from midonet.neutron.common import metrics
 import midonet.neutron.db.data_state_db as ds_db
+from midonet.neutron.db import task_archive
+from neutron.common import exceptions as n_exc
 from neutron.db import model_base
 from neutron import i18n
+from oslo_config import cfg
+from oslo_db import api as oslo_db_api
+from oslo_db import exception as db_exc
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
+from oslo_serialization import msgpackutils
+from oslo_utils import importutils
+import six
 import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy import orm
+import time
 import uuid
+import zlib
 
 CONF_ID = '00000000-0000-0000-0000-000000000001'
 
@@ -47,81 +66,1522 @@ AGENT_MEMBERSHIP = "AGENTMEMBERSHIP"
 OP_IMPORT = 'IMPORT'
 OP_FLUSH = 'FLUSH'
 
+# Task lanes.  Tasks of the interactive lane, created by API requests, may
+# be applied ahead of the bulk lane tasks created by imports, resyncs and
+# mass cleanups, see task_consumer.LaneConsumer.
+LANE_INTERACTIVE = 0
+LANE_BULK = 1
+
+# Task data formats.  Tasks without a format are in JSON.
+JSON_FORMAT = 'json'
+ZLIB_FORMAT = 'zlib'
+MSGPACK_FORMAT = 'msgpack'
+
 
 TASK_STATE_TABLE = 'midonet_task_state'
+TASK_CURRENT_TABLE = 'midonet_task_current'
+TASK_SEQUENCE_TABLE = 'midonet_task_sequence'
+TASK_TRANSACTIONS_TABLE = 'midonet_task_transactions'
+TASK_PAYLOADS_TABLE = 'midonet_task_payloads'
+TASK_LEASES_TABLE = 'midonet_task_leases'
+
+# Key under which the pending tasks of a transaction are kept in session.info
+_TASK_BUFFER_KEY = 'midonet_task_buffers'
+# Key under which the highest task ID being committed is kept
+_COMMITTED_TASK_KEY = 'midonet_committed_task_id'
+
+# Functions called with the highest task ID after each commit of new tasks
+_COMMIT_HOOKS = []
+# Functions called with the session and the highest task ID in each
+# transaction committing new tasks
+_FLUSH_HOOKS = []
 
 LOG = logging.getLogger(__name__)
 _LI = i18n._LI
+_LW = i18n._LW
 
 
 class Task(model_base.BASEV2):
     __tablename__ = 'midonet_tasks'
+    __table_args__ = (
+        sa.Index('ix_midonet_tasks_resource_id',
+                 'resource_id', 'data_type', 'id'),
+        sa.Index('ix_midonet_tasks_data_type', 'data_type', 'id'),
+        sa.Index('ix_midonet_tasks_tenant_id', 'tenant_id', 'id'),
+        sa.Index('ix_midonet_tasks_transaction_id', 'transaction_id', 'id'),
+        sa.Index('ix_midonet_tasks_created_at', 'created_at'),
+        sa.Index('ix_midonet_tasks_lane', 'lane', 'shard_key', 'id'),
+        model_base.BASEV2.__table_args__
+    )
 
     id = sa.Column(sa.Integer(), primary_key=True)
     type = sa.Column(sa.String(length=36))
     tenant_id = sa.Column(sa.String(255))
     data_type = sa.Column(sa.String(length=36))
     data = sa.Column(sa.Text(length=2 ** 24))
+    data_format = sa.Column(sa.String(16))
     resource_id = sa.Column(sa.String(36))
     transaction_id = sa.Column(sa.String(40))
+    # Set when data is only the delta from the data of the base task
+    base_task_id = sa.Column(sa.Integer())
+    # Tasks with the same shard key must be applied in ID order.  Tasks
+    # without shard key are barriers ordered with respect to all the tasks.
+    shard_key = sa.Column(sa.Integer())
+    # Number of the commit that inserted the task, see TaskSequence
+    commit_batch = sa.Column(sa.Integer())
+    # Set when the data is stored in the payloads table instead of data
+    payload_hash = sa.Column(sa.String(40))
+    # Nullable so that the column is added online, but always set through
+    # its defaults
+    lane = sa.Column(sa.SmallInteger(), nullable=True,
+                     default=LANE_INTERACTIVE, server_default='0')
+    # JSON list of the IDs of the resources the task references, see
+    # get_task_dependencies.  NULL when they were not recorded.
+    depends_on = sa.Column(sa.Text())
     created_at = sa.Column(sa.DateTime(), default=datetime.datetime.utcnow)
 
 
-def get_current_task_data(session):
-    data = dict()
-    for task in session.query(Task):
-        if task.data_type not in data:
-            data[task.data_type] = dict()
-        if task.type == DELETE:
-            data[task.data_type].pop(task.resource_id, None)
-        else:
-            data[task.data_type][task.resource_id] = task.data
+class TaskCurrent(model_base.BASEV2):
+    """Latest task data of every resource that has not been deleted.
+
+    The table is kept up to date in the same transaction as the task inserts,
+    so that the current state does not have to be computed by replaying the
+    whole tasks history.
+    """
+    __tablename__ = TASK_CURRENT_TABLE
+
+    data_type = sa.Column(sa.String(length=36), primary_key=True)
+    resource_id = sa.Column(sa.String(36), primary_key=True)
+    task_id = sa.Column(sa.Integer(), nullable=False)
+    data = sa.Column(sa.Text(length=2 ** 24))
+    data_format = sa.Column(sa.String(16))
+    # Number of delta tasks since the last full data task
+    delta_count = sa.Column(sa.Integer(), nullable=False, default=0,
+                            server_default='0')
+    shard_key = sa.Column(sa.Integer())
+    updated_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class TaskSequence(model_base.BASEV2):
+    """Counter of the commits of tasks, in a single row.
+
+    The row is updated before the tasks are inserted and stays locked until
+    the transaction ends.  The transactions inserting tasks therefore
+    commit one after the other, in commit batch order, and their task IDs
+    are allocated in that same order.  A consumer never sees a task
+    committed after a task with a higher ID, and can advance the last
+    processed task ID to the highest ID it has read without waiting for
+    gaps to be filled.
+    """
+    __tablename__ = TASK_SEQUENCE_TABLE
+
+    id = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
+    value = sa.Column(sa.Integer(), nullable=False)
+
+
+class TaskPayload(model_base.BASEV2):
+    """Task data shared by the tasks with byte-identical data.
+
+    The payloads are keyed by the hash of their format and data, and count
+    the tasks referring to them.  A payload is deleted when its last task
+    is pruned.  Without deduplication, only the data longer than the
+    overflow size is stored here.
+    """
+    __tablename__ = TASK_PAYLOADS_TABLE
+
+    hash = sa.Column(sa.String(40), primary_key=True)
+    data = sa.Column(sa.Text(length=2 ** 24), nullable=False)
+    data_format = sa.Column(sa.String(16))
+    refcount = sa.Column(sa.Integer(), nullable=False)
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class TaskTransaction(model_base.BASEV2):
+    """Header of the tasks of a Neutron transaction inserted by a commit.
+
+    The tasks of a header are those with its transaction ID and an ID
+    between first_task_id and last_task_id.  A consumer can fetch them with
+    a single range query, and check that it got them all with the count
+    and the checksum, see get_transaction_tasks.
+    """
+    __tablename__ = TASK_TRANSACTIONS_TABLE
+    __table_args__ = (
+        sa.Index('ix_midonet_task_transactions_first_task_id',
+                 'first_task_id'),
+        model_base.BASEV2.__table_args__
+    )
+
+    id = sa.Column(sa.Integer(), primary_key=True)
+    transaction_id = sa.Column(sa.String(40))
+    tenant_id = sa.Column(sa.String(255))
+    commit_batch = sa.Column(sa.Integer())
+    task_count = sa.Column(sa.Integer(), nullable=False)
+    first_task_id = sa.Column(sa.Integer(), nullable=False)
+    last_task_id = sa.Column(sa.Integer(), nullable=False)
+    checksum = sa.Column(sa.String(40), nullable=False)
+    # Commit time, to be compared with the creation time of the tasks and
+    # with the time the consumer applies them
+    created_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class TaskLease(model_base.BASEV2):
+    """Lease of a background job on the tasks, see acquire_lease.
+
+    The jobs started by every Neutron server process, like the pruner, are
+    only run by the process holding their lease.
+    """
+    __tablename__ = TASK_LEASES_TABLE
+
+    name = sa.Column(sa.String(64), primary_key=True)
+    holder = sa.Column(sa.String(255), nullable=False)
+    expires_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class JsonSerializer(object):
+    """Compact JSON, with the json module or another one with its API.
+
+    The payloads made of plain types are encoded by the C encoder alone,
+    jsonutils.to_primitive being only called for the other objects.
+    """
+
+    def __init__(self, module=json):
+        self.module = module
+
+    def dumps(self, data):
+        return self.module.dumps(data, separators=(',', ':'),
+                                 default=jsonutils.to_primitive)
+
+    def loads(self, text):
+        return self.module.loads(text)
+
+
+class UjsonSerializer(object):
+    """ujson for the plain payloads, JsonSerializer for the others."""
+
+    def __init__(self, module):
+        self.module = module
+        self._fallback = JsonSerializer()
+
+    def dumps(self, data):
+        try:
+            return self.module.dumps(data, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return self._fallback.dumps(data)
+
+    def loads(self, text):
+        return self.module.loads(text)
+
+
+def _load_ujson():
+    module = importutils.try_import('ujson')
+    # ujson 1.x silently encodes unknown objects instead of failing
+    if module is None or int(module.__version__.split('.')[0]) < 2:
+        return None
+    return UjsonSerializer(module)
+
+
+def _load_serializer(name):
+    if name == 'auto':
+        return _load_ujson() or JsonSerializer()
+    if name == 'ujson':
+        serializer = _load_ujson()
+    else:
+        module = importutils.try_import(name)
+        serializer = module and JsonSerializer(module)
+    if serializer is None:
+        raise n_exc.InvalidConfigurationOption(opt_name='task_json_serializer',
+                                               opt_value=name)
+    return serializer
+
+
+_SERIALIZERS = {
+    'json': JsonSerializer(),
+}
+
+
+def register_serializer(name, serializer):
+    """Register a JSON serializer of the task data.
+
+    A serializer is an object with dumps(data) returning JSON text, and
+    loads(text) returning the original data.
+    """
+    _SERIALIZERS[name] = serializer
+
+
+def get_serializer(name=None):
+    """Return the JSON serializer, by default the configured one."""
+    name = name or cfg.CONF.MIDONET.task_json_serializer
+    serializer = _SERIALIZERS.get(name)
+    if serializer is None:
+        serializer = _SERIALIZERS[name] = _load_serializer(name)
+    return serializer
+
+
+class JsonCodec(object):
+    """Plain JSON text, readable by any consumer."""
+
+    def encode(self, data):
+        return get_serializer().dumps(data)
+
+    def decode(self, text):
+        return get_serializer().loads(text)
+
+
+class ZlibCodec(object):
+    """zlib compressed JSON, base64 encoded to fit in the text column."""
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        raw = get_serializer().dumps(data).encode('utf-8')
+        return base64.b64encode(zlib.compress(raw, self.level)).decode('ascii')
+
+    def decode(self, text):
+        raw = zlib.decompress(base64.b64decode(text))
+        return get_serializer().loads(raw.decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    """MessagePack, base64 encoded to fit in the text column."""
+
+    def encode(self, data):
+        return base64.b64encode(msgpackutils.dumps(data)).decode('ascii')
+
+    def decode(self, text):
+        return msgpackutils.loads(base64.b64decode(text))
+
+
+_CODECS = {
+    JSON_FORMAT: JsonCodec(),
+    ZLIB_FORMAT: ZlibCodec(),
+    MSGPACK_FORMAT: MsgpackCodec(),
+}
+
+
+def register_codec(data_format, codec):
+    """Register a codec for a task data format.
+
+    A codec is an object with encode(data) returning the text stored in the
+    task, and decode(text) returning the original data.
+    """
+    _CODECS[data_format] = codec
+
+
+def get_codec(data_format):
+    try:
+        return _CODECS[data_format or JSON_FORMAT]
+    except KeyError:
+        raise n_exc.InvalidConfigurationOption(opt_name='task_data_format',
+                                               opt_value=data_format)
+
+
+def encode_task_data(data, data_format=None):
+    """Encode task data, by default in the configured format.
+
+    :returns: (data_format, text) tuple, with a None format for JSON
+    """
+    if data is None:
+        return None, None
+    if data_format is None:
+        data_format = cfg.CONF.MIDONET.task_data_format
+    text = get_codec(data_format).encode(data)
+    if data_format == JSON_FORMAT:
+        data_format = None
+    return data_format, text
+
+
+def decode_task_data(data_format, text):
+    if text is None:
+        return None
+    return get_codec(data_format).decode(text)
+
+
+def task_data_to_json(data_format, text):
+    """Return the task data as JSON text, whatever its format."""
+    if text is None or data_format in (None, JSON_FORMAT):
+        return text
+    return get_serializer().dumps(decode_task_data(data_format, text))
+
+
+class TaskDataProjection(object):
+    """Keys of the resource dicts of a data type not stored in the tasks.
+
+    :param exclude: Top level keys removed from the data
+    :param nested: dict mapping the keys holding lists of resources of
+                   another data type, like the rules of a security group,
+                   to that data type, whose projection is applied to them
+    """
+
+    def __init__(self, exclude=(), nested=None):
+        self.exclude = frozenset(exclude)
+        self.nested = nested or {}
+
+    def apply(self, data):
+        result = {}
+        for key, value in data.items():
+            if key in self.exclude:
+                continue
+            if key in self.nested and isinstance(value, list):
+                value = [project_task_data(self.nested[key], v)
+                         for v in value]
+            result[key] = value
+        return result
+
+
+# Keys never read by the cluster: the timestamps and the revision number,
+# which change on every update of a resource.  Keys of the resources used
+# by any version of the cluster, like the port bindings, are kept.
+_UNUSED_KEYS = ('created_at', 'updated_at', 'revision_number')
+
+TASK_DATA_PROJECTIONS = {
+    NETWORK: TaskDataProjection(_UNUSED_KEYS),
+    SUBNET: TaskDataProjection(_UNUSED_KEYS),
+    PORT: TaskDataProjection(_UNUSED_KEYS),
+    ROUTER: TaskDataProjection(_UNUSED_KEYS),
+    FLOATING_IP: TaskDataProjection(_UNUSED_KEYS),
+    SECURITY_GROUP: TaskDataProjection(
+        _UNUSED_KEYS,
+        nested={'security_group_rules': SECURITY_GROUP_RULE}),
+    SECURITY_GROUP_RULE: TaskDataProjection(_UNUSED_KEYS),
+    POOL: TaskDataProjection(_UNUSED_KEYS),
+    VIP: TaskDataProjection(_UNUSED_KEYS),
+    HEALTH_MONITOR: TaskDataProjection(_UNUSED_KEYS),
+    MEMBER: TaskDataProjection(_UNUSED_KEYS),
+}
+
+
+def project_task_data(data_type, data):
+    """Return a copy of the data without the keys the cluster never reads.
+
+    The data is returned as is unless the task_data_projection option is on.
+    """
+    projection = TASK_DATA_PROJECTIONS.get(data_type)
+    if (projection is None or not isinstance(data, dict) or
+            not cfg.CONF.MIDONET.task_data_projection):
+        return data
+    return projection.apply(data)
+
+
+# Paths of the keys of the resource dicts of a data type holding the IDs of
+# the resources they reference, '*' standing for all the items of a list.
+TASK_DEPENDENCIES = {
+    NETWORK: (),
+    SUBNET: ('network_id',),
+    # The device of the router interface and gateway ports is their router
+    PORT: ('network_id', 'fixed_ips.*.subnet_id', 'security_groups.*',
+           'device_id'),
+    ROUTER: ('external_gateway_info.network_id',
+             'external_gateway_info.external_fixed_ips.*.subnet_id'),
+    FLOATING_IP: ('floating_network_id', 'router_id', 'port_id'),
+    SECURITY_GROUP: (),
+    SECURITY_GROUP_RULE: ('security_group_id', 'remote_group_id'),
+    POOL: ('subnet_id', 'health_monitors.*'),
+    VIP: ('pool_id', 'subnet_id', 'port_id'),
+    HEALTH_MONITOR: ('pools.*.pool_id',),
+    MEMBER: ('pool_id',),
+    PORT_BINDING: (),
+    AGENT_MEMBERSHIP: (),
+}
+
+
+def _path_values(data, path):
+    key, _sep, rest = path.partition('.')
+    if key == '*':
+        values = data if isinstance(data, list) else ()
+    else:
+        values = (data.get(key),) if isinstance(data, dict) else ()
+    for value in values:
+        if rest:
+            for v in _path_values(value, rest):
+                yield v
+        elif isinstance(value, six.string_types):
+            yield value
+
+
+def get_task_dependencies(type, data_type, data):
+    """Return the sorted IDs of the resources a task references.
+
+    None is returned for the tasks of the data types whose references are
+    not known, which depend on all the other tasks.  A DELETE task gets
+    the references of the last data of its resource when it is flushed.
+    """
+    paths = TASK_DEPENDENCIES.get(data_type)
+    if paths is None:
+        return None
+    if type == DELETE or data is None:
+        return []
+    ids = set()
+    for path in paths:
+        ids.update(_path_values(data, path))
+    return sorted(ids)
+
+
+def task_dependencies(task):
+    """Return the IDs of the resources a Task references, None if unknown."""
+    if task.depends_on is None:
+        return None
+    return jsonutils.loads(task.depends_on)
+
+
+def _fold_task(task, prev):
+    # Task taking the place of prev: it references the resources of both,
+    # and is applied in the lane of the most urgent one.
+    if task.depends_on is None or prev.depends_on is None:
+        task.depends_on = None
+    else:
+        task.depends_on = _encode_dependencies(sorted(
+            set(task_dependencies(task)) | set(task_dependencies(prev))))
+    lanes = [lane for lane in (task.lane, prev.lane) if lane is not None]
+    task.lane = min(lanes) if lanes else None
+
+
+class _TaskBuffer(object):
+    """Tasks created in a transaction, waiting to be inserted at commit.
+
+    Tasks for the same resource within the same Neutron transaction are
+    coalesced as they are added:
+
+     * UPDATE followed by UPDATE becomes the last UPDATE, at the position
+       of the last one
+     * CREATE immediately followed by UPDATE becomes a single CREATE with
+       the new data
+     * CREATE immediately followed by DELETE cancels out
+
+    A coalesced task references the resources that any of its tasks
+    referenced, and is applied in the lane of the most urgent of them.
+
+    A CREATE is not coalesced with a later task when other tasks were added
+    in between, as these may refer to the resource and the data of the
+    later task may refer to them.  Any other sequence is kept as is.
+    """
+
+    def __init__(self):
+        self._tasks = collections.OrderedDict()
+        self._last = {}
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def add(self, task):
+        key = (task.transaction_id, task.data_type, task.resource_id)
+        seq = None
+        if task.id is None and task.resource_id is not None:
+            seq = self._last.get(key)
+        if seq is not None:
+            prev = self._tasks[seq]
+            adjacent = seq == next(reversed(self._tasks))
+            if task.type == UPDATE and prev.type == UPDATE:
+                # The last UPDATE has the whole data of the resource
+                _fold_task(task, prev)
+                del self._tasks[seq]
+            elif adjacent and task.type == UPDATE and prev.type == CREATE:
+                _fold_task(prev, task)
+                prev.data = task.data
+                prev.data_format = task.data_format
+                prev.shard_key = task.shard_key
+                return
+            elif adjacent and task.type == DELETE and prev.type == CREATE:
+                del self._tasks[seq]
+                del self._last[key]
+                return
+        self._seq += 1
+        self._tasks[self._seq] = task
+        self._last[key] = self._seq
+
+    def extend(self, other):
+        for task in other.tasks():
+            self.add(task)
+
+    def tasks(self):
+        return list(self._tasks.values())
+
+
+def _boundary_transaction(transaction):
+    # Subtransactions share the fate of their parent, so buffers are only
+    # kept for the outermost transaction and for savepoints.
+    while not transaction.nested and transaction._parent is not None:
+        transaction = transaction._parent
+    return transaction
+
+
+def _get_task_buffer(session):
+    buffers = session.info.setdefault(_TASK_BUFFER_KEY, {})
+    transaction = _boundary_transaction(session.transaction)
+    if transaction not in buffers:
+        buffers[transaction] = _TaskBuffer()
+    return buffers[transaction]
+
+
+def _add_task(session, task):
+    _get_task_buffer(session).add(task)
+
+
+def get_shard_key(data_type, resource_id=None, data=None):
+    """Return the shard key of a task, or None for a barrier task.
+
+    Networks and their subnets and ports are sharded by network, as the
+    tasks of different networks do not depend on each other.  The tasks
+    of the other resources, like routers, floating IPs and security
+    groups, refer to resources of several networks and are barriers.
+    """
+    if data_type == NETWORK:
+        network_id = resource_id
+    elif data_type in (SUBNET, PORT):
+        network_id = (data or {}).get('network_id')
+    else:
+        return None
+    if not network_id:
+        return None
+    return zlib.crc32(network_id.encode('utf-8')) & 0x7fffffff
+
+
+def _resource_key(task):
+    if task.data_type is None or task.resource_id is None:
+        return None
+    return task.data_type, task.resource_id
+
+
+def _group_by_data_type(keys):
+    by_type = collections.defaultdict(list)
+    for data_type, resource_id in keys:
+        by_type[data_type].append(resource_id)
+    return by_type.items()
+
+
+def _get_current_state(session, keys):
+    # Plain rows rather than entities, so that the identity map never holds
+    # current state rows that the flushes below would make stale.
+    current = {}
+    for data_type, resource_ids in _group_by_data_type(keys):
+        query = session.query(
+            TaskCurrent.resource_id, TaskCurrent.task_id,
+            TaskCurrent.data_format, TaskCurrent.data,
+            TaskCurrent.delta_count, TaskCurrent.shard_key).filter(
+                TaskCurrent.data_type == data_type,
+                TaskCurrent.resource_id.in_(resource_ids))
+        for row in query:
+            current[(data_type, row.resource_id)] = row
+    return current
+
+
+def _current_state_keys(session, keys):
+    existing = set()
+    for data_type, resource_ids in _group_by_data_type(keys):
+        existing.update((data_type, resource_id) for resource_id, in
+                        session.query(TaskCurrent.resource_id).filter(
+                            TaskCurrent.data_type == data_type,
+                            TaskCurrent.resource_id.in_(resource_ids)))
+    return existing
+
+
+def _replace_current_state(session, rows):
+    # The key parameters are prefixed, as the parameters named after the
+    # columns are the values set.
+    table = TaskCurrent.__table__
+    params = []
+    for row in rows:
+        param = dict((k, v) for k, v in row.items()
+                     if k not in ('data_type', 'resource_id'))
+        param['key_data_type'] = row['data_type']
+        param['key_resource_id'] = row['resource_id']
+        params.append(param)
+    return session.execute(table.update().where(sa.and_(
+        table.c.data_type == sa.bindparam('key_data_type'),
+        table.c.resource_id == sa.bindparam('key_resource_id'))), params)
+
+
+def _update_current_state(session, states):
+    # The rows are updated in place, and only the missing ones inserted: a
+    # DELETE and INSERT of the same key by concurrent transactions would
+    # fail on the primary key or deadlock on its gap locks.
+    if not states:
+        return
+    table = TaskCurrent.__table__
+    deleted = [key for key, state in states.items() if state is None]
+    for data_type, resource_ids in _group_by_data_type(deleted):
+        session.execute(table.delete().where(sa.and_(
+            table.c.data_type == data_type,
+            table.c.resource_id.in_(resource_ids))))
+    rows = dict((key, state) for key, state in states.items()
+                if state is not None)
+    if not rows:
+        return
+    existing = _current_state_keys(session, rows)
+    if existing:
+        result = _replace_current_state(
+            session, [rows[key] for key in existing])
+        if result.rowcount < len(existing):
+            # Deleted by a concurrent transaction since
+            existing = _current_state_keys(session, existing)
+    missing = [state for key, state in rows.items() if key not in existing]
+    if not missing:
+        return
+    try:
+        with session.begin_nested():
+            session.execute(table.insert(), missing)
+    except db_exc.DBDuplicateEntry:
+        # Inserted by a concurrent transaction since
+        _replace_current_state(session, missing)
+
+
+def make_delta(old, new):
+    """Return the delta turning the old top level keys into the new ones."""
+    return {'set': dict((k, v) for k, v in new.items()
+                        if k not in old or old[k] != v),
+            'unset': [k for k in old if k not in new]}
+
+
+def apply_delta(base, delta):
+    """Return the data resulting from applying a delta to base data."""
+    data = dict(base)
+    data.update(delta['set'])
+    for key in delta['unset']:
+        data.pop(key, None)
     return data
 
 
-def get_task_list(session, show_unprocessed):
-    tasks = session.query(Task)
-    if show_unprocessed:
-        task_state = session.query(ds_db.DataState).one()
-        lp_id = task_state.last_processed_id
-        if lp_id is not None:
-            tasks = tasks.filter(Task.id > lp_id)
+def _delta_encode(task, base, state):
+    # Turn an UPDATE task into a delta from the base state, unless a full
+    # snapshot is due or the delta is not much smaller than the full data.
+    conf = cfg.CONF.MIDONET
+    if task.data is None or base.delta_count >= conf.task_delta_full_interval:
+        return
+    delta = make_delta(decode_task_data(base.data_format, base.data),
+                       decode_task_data(task.data_format, task.data))
+    _fmt, text = encode_task_data(delta, task.data_format or JSON_FORMAT)
+    if len(text) > conf.task_delta_max_ratio * len(task.data):
+        return
+    task.data = text
+    task.base_task_id = base.task_id
+    state['delta_count'] = base.delta_count + 1
+
+
+def _set_delete_dependencies(task, prev):
+    # A DELETE task references the resources the last data of its resource
+    # referenced, so that they are deleted after it.
+    if prev is None:
+        return
+    if isinstance(prev, dict):
+        data_format, text = prev['data_format'], prev['data']
+    else:
+        data_format, text = prev.data_format, prev.data
+    if text is not None:
+        task.depends_on = _encode_dependencies(get_task_dependencies(
+            UPDATE, task.data_type, decode_task_data(data_format, text)))
+
+
+def _task_row(task, columns):
+    row = {}
+    for column in columns:
+        value = getattr(task, column.key)
+        if value is None and column.default is not None and (
+                column.default.is_scalar):
+            value = column.default.arg
+        row[column.key] = value
+    return row
+
+
+def _insert_tasks(session, tasks):
+    """Insert the tasks and set their IDs.
+
+    The tasks are inserted with one executemany per statement, and the IDs
+    generated by the DB are read back in a single query among the rows
+    above the highest ID before the insert.  With the commit order, the
+    sequence lock is held, so the rows that have the commit batch of the
+    flush are the ones just inserted, numbered in insertion order.
+    Otherwise the rows of concurrent transactions may be interleaved with
+    them: the rows with the transaction IDs of the flush are matched to
+    the tasks in insertion order by resource.
+    """
+    table = Task.__table__
+    columns = [c for c in table.columns if c.key != 'id']
+    explicit = [t for t in tasks if t.id is not None]
+    generated = [t for t in tasks if t.id is None]
+    if generated:
+        floor = session.query(sa.func.max(Task.id)).scalar() or 0
+    if explicit:
+        session.execute(table.insert(),
+                        [_task_row(t, [table.c.id] + columns)
+                         for t in explicit])
+    if not generated:
+        return
+    session.execute(table.insert(),
+                    [_task_row(t, columns) for t in generated])
+    commit_batch = generated[0].commit_batch
+    query = session.query(Task.id, Task.type, Task.data_type,
+                          Task.resource_id).filter(Task.id > floor)
+    if commit_batch is not None:
+        query = query.filter(Task.commit_batch == commit_batch)
+    else:
+        transaction_ids = set(t.transaction_id for t in generated)
+        criteria = []
+        if None in transaction_ids:
+            transaction_ids.discard(None)
+            criteria.append(Task.transaction_id.is_(None))
+        if transaction_ids:
+            criteria.append(Task.transaction_id.in_(transaction_ids))
+        query = query.filter(Task.commit_batch.is_(None), sa.or_(*criteria))
+    if explicit:
+        query = query.filter(~Task.id.in_([t.id for t in explicit]))
+    pending = iter(generated)
+    task = next(pending)
+    for row in query.order_by(Task.id):
+        if (row.type, row.data_type, row.resource_id) != (
+                task.type, task.data_type, task.resource_id):
+            # Inserted by a concurrent transaction
+            continue
+        task.id = row.id
+        task = next(pending, None)
+        if task is None:
+            return
+
+
+def task_checksum(tasks):
+    """Return the checksum of a header's tasks, given in ID order."""
+    digest = hashlib.sha1()
+    for task in tasks:
+        # The data loaded from the payloads table is not part of the row
+        data = task.data if task.payload_hash is None else None
+        for value in (task.id, task.type, task.data_type, task.resource_id,
+                      data, task.payload_hash):
+            digest.update((u'%s\0' % ('' if value is None else value)).encode(
+                'utf-8'))
+    return digest.hexdigest()
+
+
+def _insert_transaction_headers(session, tasks):
+    by_transaction = collections.OrderedDict()
+    for task in tasks:
+        by_transaction.setdefault(task.transaction_id, []).append(task)
+    now = datetime.datetime.utcnow()
+    rows = []
+    for transaction_id, tx_tasks in by_transaction.items():
+        tx_tasks.sort(key=lambda t: t.id)
+        rows.append({'transaction_id': transaction_id,
+                     'tenant_id': tx_tasks[0].tenant_id,
+                     'commit_batch': tx_tasks[0].commit_batch,
+                     'task_count': len(tx_tasks),
+                     'first_task_id': tx_tasks[0].id,
+                     'last_task_id': tx_tasks[-1].id,
+                     'checksum': task_checksum(tx_tasks),
+                     'created_at': now})
+    session.execute(TaskTransaction.__table__.insert(), rows)
+
+
+def payload_hash(data_format, text):
+    return hashlib.sha1(
+        (u'%s\0%s' % (data_format or '', text)).encode('utf-8')).hexdigest()
+
+
+def _store_payloads(session, tasks):
+    # Move the task data to the payloads table, adding a reference to the
+    # payloads already there.  These are locked so that the pruner cannot
+    # delete them before this transaction commits.
+    counts = collections.OrderedDict()
+    payloads = {}
+    for task in tasks:
+        if task.data is None:
+            continue
+        key = payload_hash(task.data_format, task.data)
+        counts[key] = counts.get(key, 0) + 1
+        payloads[key] = (task.data_format, task.data)
+        task.payload_hash = key
+        task.data = None
+    if not counts:
+        return
+    existing = _existing_payloads(session, list(counts))
+    _reference_payloads(session, existing, counts)
+    now = datetime.datetime.utcnow()
+    rows = [{'hash': key,
+             'data_format': payloads[key][0],
+             'data': payloads[key][1],
+             'refcount': count,
+             'created_at': now}
+            for key, count in counts.items() if key not in existing]
+    while rows:
+        try:
+            with session.begin_nested():
+                session.execute(TaskPayload.__table__.insert(), rows)
+            return
+        except db_exc.DBDuplicateEntry:
+            # Some were inserted by a concurrent transaction since: add a
+            # reference to these, and insert the others again.
+            existing = _existing_payloads(session,
+                                          [row['hash'] for row in rows])
+            _reference_payloads(session, existing, counts)
+            rows = [row for row in rows if row['hash'] not in existing]
+
+
+def _existing_payloads(session, hashes):
+    return set(key for key, in session.query(TaskPayload.hash).filter(
+        TaskPayload.hash.in_(hashes)).with_for_update())
+
+
+def _reference_payloads(session, hashes, counts):
+    if not hashes:
+        return
+    table = TaskPayload.__table__
+    session.execute(
+        table.update().where(table.c.hash == sa.bindparam('key')).values(
+            refcount=table.c.refcount + sa.bindparam('count')),
+        [{'key': key, 'count': counts[key]} for key in hashes])
+
+
+def _release_payloads(session, hashes):
+    # Drop a reference to the payloads per hash, one for each deleted task
+    counts = collections.Counter(key for key in hashes if key is not None)
+    if not counts:
+        return
+    table = TaskPayload.__table__
+    session.execute(
+        table.update().where(table.c.hash == sa.bindparam('key')).values(
+            refcount=table.c.refcount - sa.bindparam('count')),
+        [{'key': key, 'count': count} for key, count in counts.items()])
+    session.execute(table.delete().where(sa.and_(
+        table.c.hash.in_(list(counts)), table.c.refcount <= 0)))
+
+
+def get_task_data(session, task):
+    """Return the (data_format, text) of a task, wherever it is stored."""
+    if task.payload_hash is None or task.data is not None:
+        return task.data_format, task.data
+    return session.query(TaskPayload.data_format, TaskPayload.data).filter(
+        TaskPayload.hash == task.payload_hash).one()
+
+
+def load_task_data(session, tasks):
+    """Load the data of the tasks stored in the payloads table.
+
+    The data is set on the tasks as if read from their rows, without
+    marking them modified, so that consumers read task.data wherever it is
+    stored.
+
+    :returns: The tasks
+    """
+    hashes = set(t.payload_hash for t in tasks
+                 if t.payload_hash is not None and t.data is None)
+    if not hashes:
+        return tasks
+    payloads = dict(session.query(TaskPayload.hash, TaskPayload.data).filter(
+        TaskPayload.hash.in_(list(hashes))))
+    for task in tasks:
+        if task.data is None and task.payload_hash in payloads:
+            orm.attributes.set_committed_value(
+                task, 'data', payloads[task.payload_hash])
     return tasks
 
 
-def task_clean(session):
-    task_state = session.query(ds_db.DataState).one()
-    lp_id = task_state.last_processed_id
-    task_state.update({'last_processed_id': None,
-                       'updated_at': datetime.datetime.utcnow()})
-    session.query(Task).filter(Task.id <= lp_id).delete()
-    session.commit()
+def _next_commit_batch(session):
+    table = TaskSequence.__table__
+    where = table.c.id == 1
+    result = session.execute(
+        table.update().where(where).values(value=table.c.value + 1))
+    if not result.rowcount:
+        session.execute(table.insert().values(id=1, value=1))
+    return session.execute(sa.select([table.c.value]).where(where)).scalar()
+
+
+def _is_noop(task, base):
+    # Whether an UPDATE task has the data of the current state
+    if base is None or base.data is None or task.data is None:
+        return False
+    return (decode_task_data(base.data_format, base.data) ==
+            decode_task_data(task.data_format, task.data))
+
+
+def _flush_tasks(session, tasks):
+    if cfg.CONF.MIDONET.task_commit_order:
+        # Flush the pending changes of the transaction first, so that the
+        # sequence is the last lock taken before the commit: a transaction
+        # holding it never waits for rows locked by another one waiting
+        # for it.  Then lock the sequence so that the task IDs and the
+        # current state updates follow the commit order.
+        session.flush()
+        commit_batch = _next_commit_batch(session)
+        for task in tasks:
+            task.commit_batch = commit_batch
+    keys = set()
+    use_delta = cfg.CONF.MIDONET.task_update_delta
+    suppress_noop = cfg.CONF.MIDONET.task_suppress_noop_updates
+    if use_delta or suppress_noop:
+        keys.update(_resource_key(t) for t in tasks if t.type == UPDATE)
+    # DELETE tasks have no data to compute their shard key and dependencies
+    # from
+    keys.update(_resource_key(t) for t in tasks
+                if t.type == DELETE and (
+                    t.depends_on is not None or
+                    t.shard_key is None and t.data_type in (SUBNET, PORT)))
+    keys.discard(None)
+    current = _get_current_state(session, keys) if keys else {}
+
+    latest = collections.OrderedDict()
+    noop = set()
+    for task in tasks:
+        key = _resource_key(task)
+        if key is None:
+            continue
+        # Only the first task of a resource in this flush can be based on
+        # the stored current state.
+        base = current.pop(key, None)
+        if suppress_noop and task.type == UPDATE and _is_noop(task, base):
+            current[key] = base
+            noop.add(id(task))
+            continue
+        if task.type == DELETE and task.shard_key is None:
+            prev = latest[key][0] if key in latest else base
+            if prev is not None:
+                task.shard_key = prev.shard_key
+        if task.type == DELETE and task.depends_on is not None:
+            _set_delete_dependencies(
+                task, latest[key][1] if key in latest else base)
+        state = None
+        if task.type != DELETE:
+            state = {'data_type': task.data_type,
+                     'resource_id': task.resource_id,
+                     'data': task.data,
+                     'data_format': task.data_format,
+                     'delta_count': 0,
+                     'shard_key': task.shard_key,
+                     'updated_at': task.created_at}
+            if use_delta and base is not None and task.type == UPDATE:
+                _delta_encode(task, base, state)
+        latest[key] = (task, state)
+
+    if noop:
+        metrics.incr('task_update_suppressed', len(noop))
+        tasks = [task for task in tasks if id(task) not in noop]
+        if not tasks:
+            return None
+    max_size = cfg.CONF.MIDONET.task_payload_overflow_size
+    if cfg.CONF.MIDONET.task_payload_dedup:
+        _store_payloads(session, tasks)
+    elif max_size > 0:
+        overflow = [task for task in tasks
+                    if task.data is not None and len(task.data) > max_size]
+        if overflow:
+            metrics.incr('task_payload_overflow', len(overflow))
+            _store_payloads(session, overflow)
+    _insert_tasks(session, tasks)
+    _insert_transaction_headers(session, tasks)
+
+    states = collections.OrderedDict()
+    for key, (task, state) in latest.items():
+        if state is not None:
+            state['task_id'] = task.id
+        states[key] = state
+    _update_current_state(session, states)
+    task_id = max(task.id for task in tasks)
+    for hook in list(_FLUSH_HOOKS):
+        hook(session, task_id)
+    return task_id
+
+
+def register_commit_hook(hook):
+    """Register a function called after each commit of new tasks.
+
+    The function is called with the highest committed task ID, after the
+    transaction is committed.  Its errors are logged and ignored.
+    """
+    if hook not in _COMMIT_HOOKS:
+        _COMMIT_HOOKS.append(hook)
+
+
+def unregister_commit_hook(hook):
+    if hook in _COMMIT_HOOKS:
+        _COMMIT_HOOKS.remove(hook)
+
+
+def register_flush_hook(hook):
+    """Register a function called in each transaction committing new tasks.
+
+    The function is called with the session and the highest task ID, after
+    the tasks are inserted and before the transaction is committed.  Its
+    errors fail the commit.
+    """
+    if hook not in _FLUSH_HOOKS:
+        _FLUSH_HOOKS.append(hook)
+
+
+def unregister_flush_hook(hook):
+    if hook in _FLUSH_HOOKS:
+        _FLUSH_HOOKS.remove(hook)
+
+
+@event.listens_for(orm.Session, 'before_commit')
+def _before_commit(session):
+    buffers = session.info.get(_TASK_BUFFER_KEY)
+    if not buffers:
+        return
+    transaction = session.transaction
+    buf = buffers.pop(transaction, None)
+    if buf is None:
+        return
+    if transaction.nested:
+        # Released savepoint: its tasks now belong to the enclosing
+        # transaction, and are coalesced with the tasks already there.
+        parent = _boundary_transaction(transaction._parent)
+        buffers.setdefault(parent, _TaskBuffer()).extend(buf)
+    elif len(buf):
+        task_id = _flush_tasks(session, buf.tasks())
+        if task_id is not None and _COMMIT_HOOKS:
+            session.info[_COMMITTED_TASK_KEY] = task_id
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _after_commit(session):
+    task_id = session.info.pop(_COMMITTED_TASK_KEY, None)
+    if task_id is None:
+        return
+    for hook in list(_COMMIT_HOOKS):
+        try:
+            hook(task_id)
+        except Exception:
+            LOG.warning(_LW("Task commit hook %(hook)r failed for task "
+                            "%(id)s"), {'hook': hook, 'id': task_id},
+                        exc_info=True)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(_COMMITTED_TASK_KEY, None)
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    # Tasks of a rolled back transaction or savepoint are discarded.  After
+    # a commit, the buffer has already been popped in before_commit.
+    buffers = session.info.get(_TASK_BUFFER_KEY)
+    if buffers:
+        buffers.pop(transaction, None)
+
+
+def get_current_task_data(session):
+    """Return the latest JSON data of the live resources by data type."""
+    data = collections.defaultdict(dict)
+    query = session.query(TaskCurrent.data_type, TaskCurrent.resource_id,
+                          TaskCurrent.data_format, TaskCurrent.data)
+    for data_type, resource_id, data_format, text in query:
+        data[data_type][resource_id] = task_data_to_json(data_format, text)
+    return dict(data)
+
+
+def get_tasks(session, tenant_id=None, data_type=None, resource_id=None,
+              type=None, created_after=None, created_before=None,
+              after_id=None, unprocessed=False, page_size=1000):
+    """Generate the tasks matching the given filters in task ID order.
+
+    The tasks are fetched in pages of page_size rows using the task ID as
+    the key, so that the whole result set is never held in memory.  All
+    the filters are applied by the DB.  The data stored in the payloads
+    table is loaded in the tasks.
+
+    :param created_after: Only tasks created at or after this UTC datetime
+    :param created_before: Only tasks created before this UTC datetime
+    :param after_id: Only tasks with an ID greater than this one
+    :param unprocessed: Only tasks not yet processed by the cluster
+    """
+    query = session.query(Task)
+    if tenant_id is not None:
+        query = query.filter(Task.tenant_id == tenant_id)
+    if data_type is not None:
+        query = query.filter(Task.data_type == data_type)
+    if resource_id is not None:
+        query = query.filter(Task.resource_id == resource_id)
+    if type is not None:
+        query = query.filter(Task.type == type)
+    if created_after is not None:
+        query = query.filter(Task.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(Task.created_at < created_before)
+    if unprocessed:
+        lp_id = ds_db.get_last_processed_task_id(session)
+        if lp_id is not None and (after_id is None or lp_id > after_id):
+            after_id = lp_id
+
+    while True:
+        page = query
+        if after_id is not None:
+            page = page.filter(Task.id > after_id)
+        page = load_task_data(
+            session, page.order_by(Task.id).limit(page_size).all())
+        count = 0
+        for task in page:
+            count += 1
+            after_id = task.id
+            yield task
+        if count < page_size:
+            return
+
+
+def get_task_list(session, show_unprocessed):
+    return get_tasks(session, unprocessed=show_unprocessed)
+
+
+def get_task_transactions(session, after_id=0, limit=None):
+    """Return the headers of the tasks after after_id, in task ID order."""
+    query = session.query(TaskTransaction).filter(
+        TaskTransaction.first_task_id > after_id).order_by(
+            TaskTransaction.first_task_id)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def get_transaction_tasks(session, header):
+    """Return the tasks of a transaction header, in ID order.
+
+    :raises: TaskTransactionIncomplete if the tasks read do not match the
+             count or the checksum of the header
+    """
+    tasks = session.query(Task).filter(
+        Task.id.between(header.first_task_id, header.last_task_id),
+        Task.transaction_id == header.transaction_id).order_by(Task.id).all()
+    if (len(tasks) != header.task_count or
+            task_checksum(tasks) != header.checksum):
+        raise mido_exc.TaskTransactionIncomplete(
+            id=header.id, count=len(tasks), expected=header.task_count)
+    return load_task_data(session, tasks)
+
+
+def get_task_stats(session, rate_window=60):
+    """Return how far the cluster is behind in processing the tasks.
+
+    All the queries use the primary key or an index of the tasks table, and
+    only the per data type backlog scans the unprocessed tasks.
+
+    :param rate_window: Period in seconds over which the insert rate is
+                        computed
+    :returns: dict with the following keys:
+        max_task_id: ID of the latest task
+        last_processed_task_id: ID of the last task processed by the cluster
+        backlog: Number of unprocessed tasks
+        backlog_by_data_type: Number of unprocessed tasks by data type
+        backlog_by_lane: Number of unprocessed tasks by lane
+        oldest_unprocessed_age: Age in seconds of the oldest unprocessed
+                                task, 0 if there is none
+        insert_rate: Number of tasks created per second over rate_window
+    """
+    now = datetime.datetime.utcnow()
+    max_id = session.query(sa.func.max(Task.id)).scalar() or 0
+    lp_id = ds_db.get_last_processed_task_id(session) or 0
+    oldest = session.query(Task.created_at).filter(Task.id > lp_id).order_by(
+        Task.id).limit(1).scalar()
+    by_data_type = dict(session.query(
+        Task.data_type, sa.func.count(Task.id)).filter(
+            Task.id > lp_id).group_by(Task.data_type))
+    by_lane = dict(session.query(
+        Task.lane, sa.func.count(Task.id)).filter(
+            Task.id > lp_id).group_by(Task.lane))
+    since = now - datetime.timedelta(seconds=rate_window)
+    inserted = session.query(sa.func.count(Task.id)).filter(
+        Task.created_at >= since).scalar()
+    return {'max_task_id': max_id,
+            'last_processed_task_id': lp_id,
+            'backlog': max(max_id - lp_id, 0),
+            'backlog_by_data_type': by_data_type,
+            'backlog_by_lane': by_lane,
+            'oldest_unprocessed_age': (
+                (now - oldest).total_seconds() if oldest else 0),
+            'insert_rate': float(inserted) / rate_window}
+
+
+def _archive_tasks(session, archive, ids):
+    tasks = session.query(Task).filter(Task.id.in_(ids)).order_by(Task.id)
+    archive.append([task_archive.task_record(t)
+                    for t in load_task_data(session, tasks.all())])
+
+
+class _BatchChanged(Exception):
+    """Rows of a batch being deleted were deleted by another process."""
+
+
+def _lock_batch(session, query, skip_locked=True):
+    # Lock the rows of the batch so that concurrent pruners do not delete,
+    # and release the payloads of, the same tasks.  Where the DB can, they
+    # skip each other's batches rather than waiting for them, unless the
+    # batches must be handled in ID order.
+    dialect = session.get_bind().dialect
+    version = dialect.server_version_info or ()
+    if skip_locked and (
+            (dialect.name == 'postgresql' and version >= (9, 5)) or
+            (dialect.name == 'mysql' and version >= (8, 0) and
+             not getattr(dialect, '_is_mariadb', False))):
+        try:
+            return query.with_for_update(skip_locked=True)
+        except TypeError:
+            # SQLAlchemy before 1.1
+            pass
+    return query.with_for_update()
+
+
+def _delete_tasks(session, criteria, batch_size, batch_interval,
+                  model=Task, archive=None, keep_going=None):
+    # Delete in bounded batches, each in its own transaction, so that locks
+    # on the tasks table are never held for long.
+    deleted = 0
+    columns = [model.id]
+    if model is Task:
+        columns.append(Task.payload_hash)
+    while True:
+        try:
+            with session.begin():
+                # The archive takes the tasks in ID order only: the
+                # pruners wait for each other's batches.
+                rows = _lock_batch(session, session.query(*columns).filter(
+                    *criteria).order_by(model.id).limit(batch_size),
+                    skip_locked=archive is None).all()
+                ids = [row[0] for row in rows]
+                if ids:
+                    if archive is not None:
+                        # Archived before the delete is committed: a batch
+                        # whose delete fails is archived again and skipped,
+                        # and a batch that cannot be archived is not
+                        # deleted.
+                        _archive_tasks(session, archive, ids)
+                    count = session.query(model).filter(
+                        model.id.in_(ids)).delete(synchronize_session=False)
+                    if count != len(ids):
+                        # The payloads of the tasks deleted elsewhere were
+                        # released there: roll back and select again.
+                        raise _BatchChanged()
+                    if model is Task:
+                        _release_payloads(session, [row[1] for row in rows])
+        except _BatchChanged:
+            continue
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            return deleted
+        if keep_going is not None and not keep_going():
+            return deleted
+        if batch_interval:
+            time.sleep(batch_interval)
+
+
+def prune_tasks(session, max_age=None, keep=0, batch_size=1000,
+                batch_interval=0, archive=None, keep_going=None):
+    """Delete the processed tasks that are out of the retention policy.
+
+    The last processed task is never deleted as the data state refers to
+    it.  Deletion is done in batches of batch_size tasks, each committed
+    separately, sleeping batch_interval seconds in between.
+
+    :param session: Session in autocommit mode
+    :param max_age: Keep the tasks younger than this many seconds
+    :param keep: Keep at least this many of the latest processed tasks
+    :param archive: TaskArchiveWriter the tasks are archived to before
+                    being deleted
+    :param keep_going: Function called between batches, the pruning
+                       stopping when it returns False
+    :returns: Number of deleted tasks
+    """
+    lp_id = ds_db.get_last_processed_task_id(session)
+    if lp_id is None:
+        return 0
+    if keep:
+        # ID of the oldest processed task to keep
+        lp_id = session.query(Task.id).filter(Task.id <= lp_id).order_by(
+            Task.id.desc()).offset(keep - 1).limit(1).scalar()
+        if lp_id is None:
+            return 0
+    criteria = [Task.id < lp_id]
+    if max_age:
+        created_before = (datetime.datetime.utcnow() -
+                          datetime.timedelta(seconds=max_age))
+        if archive is None:
+            criteria.append(Task.created_at < created_before)
+        else:
+            # The archive only takes tasks in ID order: stop at the first
+            # young task even if older ones follow it.
+            young_id = session.query(sa.func.min(Task.id)).filter(
+                Task.created_at >= created_before).scalar()
+            if young_id is not None:
+                criteria.append(Task.id < young_id)
+    deleted = _delete_tasks(session, criteria, batch_size, batch_interval,
+                            archive=archive, keep_going=keep_going)
+    # Delete the headers whose tasks have all been deleted
+    first_id = session.query(sa.func.min(Task.id)).scalar()
+    _delete_tasks(session, [TaskTransaction.last_task_id < first_id],
+                  batch_size, batch_interval, model=TaskTransaction,
+                  keep_going=keep_going)
+    return deleted
+
+
+def task_clean(session, batch_size=1000, archive=None):
+    """Delete all the processed tasks and reset the last processed task ID.
+
+    The tasks are only deleted: no task is created, in either lane.
+
+    :param session: Session in autocommit mode
+    :param archive: TaskArchiveWriter the tasks are archived to before
+                    being deleted
+    """
+    lp_id = ds_db.get_last_processed_task_id(session)
+    if lp_id is None:
+        return 0
+    values = {'last_processed_task_id': None,
+              'updated_at': datetime.datetime.utcnow()}
+    with session.begin():
+        # Only the rows holding a progress are updated, and so locked
+        session.query(ds_db.DataState).filter(
+            ds_db.DataState.last_processed_task_id.isnot(None)).update(
+                values, synchronize_session=False)
+        session.query(ds_db.TaskProgress).filter(
+            ds_db.TaskProgress.last_processed_task_id.isnot(None)).update(
+                values, synchronize_session=False)
+    deleted = _delete_tasks(session, [Task.id <= lp_id], batch_size, 0,
+                            archive=archive)
+    _delete_tasks(session, [TaskTransaction.last_task_id <= lp_id],
+                  batch_size, 0, model=TaskTransaction)
+    return deleted
+
+
+def acquire_lease(session, name, holder, duration):
+    """Acquire or renew the lease of a job for duration seconds.
+
+    The lease is granted if it is free, expired or already held by holder.
+
+    :param session: Session in autocommit mode
+    :returns: Whether holder holds the lease
+    """
+    now = datetime.datetime.utcnow()
+    values = {'holder': holder,
+              'expires_at': now + datetime.timedelta(seconds=duration)}
+    table = TaskLease.__table__
+    with session.begin():
+        result = session.execute(table.update().where(sa.and_(
+            table.c.name == name,
+            sa.or_(table.c.holder == holder,
+                   table.c.expires_at < now))).values(**values))
+        if result.rowcount:
+            return True
+        if session.query(TaskLease.name).filter(
+                TaskLease.name == name).first() is not None:
+            return False
+    try:
+        with session.begin():
+            session.execute(table.insert().values(name=name, **values))
+    except db_exc.DBDuplicateEntry:
+        # Acquired by another process first
+        return False
+    return True
+
+
+def _encode_dependencies(depends_on):
+    return None if depends_on is None else jsonutils.dumps(depends_on)
 
 
 def create_task(context, type, task_id=None, data_type=None,
-                resource_id=None, data=None):
+                resource_id=None, data=None, lane=LANE_INTERACTIVE,
+                depends_on=None):
 
+    data_format, text = encode_task_data(project_task_data(data_type, data))
     with context.session.begin(subtransactions=True):
         db = Task(id=task_id,
                   type=type,
                   tenant_id=context.tenant,
                   data_type=data_type,
-                  data=None if data is None else jsonutils.dumps(data),
+                  data=text,
+                  data_format=data_format,
                   resource_id=resource_id,
-                  transaction_id=context.request_id)
-        context.session.add(db)
+                  transaction_id=context.request_id,
+                  shard_key=get_shard_key(data_type, resource_id, data),
+                  lane=lane,
+                  depends_on=_encode_dependencies(depends_on),
+                  created_at=datetime.datetime.utcnow())
+        _add_task(context.session, db)
+
+
+def create_tasks(context, tasks, lane=LANE_INTERACTIVE):
+    """Create several tasks at once.
+
+    Each task is a dict with the 'type', 'data_type', 'resource_id' and
+    'data' keys, and optionally 'depends_on'.  The tasks are inserted
+    together with the other tasks of the transaction when it commits, in a
+    single INSERT batch.
+    """
+    now = datetime.datetime.utcnow()
+    with context.session.begin(subtransactions=True):
+        for t in tasks:
+            data_format, text = encode_task_data(
+                project_task_data(t.get('data_type'), t.get('data')))
+            _add_task(context.session,
+                      Task(type=t['type'],
+                           tenant_id=context.tenant,
+                           data_type=t.get('data_type'),
+                           data=text,
+                           data_format=data_format,
+                           resource_id=t.get('resource_id'),
+                           transaction_id=context.request_id,
+                           shard_key=get_shard_key(t.get('data_type'),
+                                                   t.get('resource_id'),
+                                                   t.get('data')),
+                           lane=lane,
+                           depends_on=_encode_dependencies(
+                               t.get('depends_on')),
+                           created_at=now))
 
 
+def config_hash(data):
+    """Return a digest of config task data, independent of its format."""
+    return hashlib.sha1(
+        jsonutils.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _lock_task_sequence(session):
+    # The transactions creating tasks in commit order take this lock too
+    table = TaskSequence.__table__
+    row = session.execute(sa.select([table.c.id]).where(
+        table.c.id == 1).with_for_update()).first()
+    if row is None:
+        session.execute(table.insert().values(id=1, value=0))
+
+
+@oslo_db_api.wrap_db_retry(max_retries=3, retry_interval=1,
+                           retry_on_request=True,
+                           retry_on_deadlock=True)
 def create_config_task(session, data):
+    """Create a CONFIG task, unless the configuration has not changed.
+
+    The data of the last CONFIG task is compared under the lock of the task
+    sequence, so that of many workers starting at once with the same
+    configuration only one creates a task.
+
+    The task is in the bulk lane: it is a barrier, which the interactive
+    tasks created after it do not go ahead of.
+
+    :returns: Whether a task was created
+    """
     data['id'] = CONF_ID
-    with session.begin(subtransactions=True):
-        db = Task(type=CREATE,
-                  tenant_id=None,
-                  data_type=CONFIG,
-                  data=jsonutils.dumps(data),
-                  resource_id=data['id'],
-                  transaction_id=str(uuid.uuid4()))
-        session.add(db)
+    digest = config_hash(data)
+    try:
+        with session.begin(subtransactions=True):
+            _lock_task_sequence(session)
+            query = session.query(
+                TaskCurrent.data_format, TaskCurrent.data).filter(
+                    TaskCurrent.data_type == CONFIG,
+                    TaskCurrent.resource_id == CONF_ID)
+            current = query.with_for_update().first()
+            if (current is not None and current.data is not None and
+                    config_hash(decode_task_data(*current)) == digest):
+                metrics.incr('task_config_unchanged')
+                return False
+            data_format, text = encode_task_data(data)
+            db = Task(type=CREATE,
+                      tenant_id=None,
+                      data_type=CONFIG,
+                      data=text,
+                      data_format=data_format,
+                      resource_id=data['id'],
+                      transaction_id=str(uuid.uuid4()),
+                      lane=LANE_BULK,
+                      created_at=datetime.datetime.utcnow())
+            _add_task(session, db)
+    except db_exc.DBDuplicateEntry as ex:
+        # Another worker created the sequence row first
+        raise db_exc.RetryRequest(ex)
+    return True
 
 
 def create_port_binding_task(context, port_id, interface_name, host):
@@ -0,0 +1,133 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background jobs on the tasks, run by a single process at a time.
+
+The MidoNet client is initialized by the core plugin or the ML2 driver of
+every Neutron server, and its API and RPC workers are forked from it.  The
+jobs are started in all these processes, but only the process holding the
+lease of a job in the DB runs it, so that for instance a single pruner
+deletes the processed tasks.
+"""
+
+import os
+import socket
+import threading
+
+from midonet.neutron.db import task_db
+from neutron.db import api as db
+from neutron import i18n
+from oslo_log import log as logging
+from oslo_service import loopingcall
+
+LOG = logging.getLogger(__name__)
+_LE = i18n._LE
+_LW = i18n._LW
+
+# Jobs started in this process, by name
+_JOBS = {}
+_jobs_lock = threading.Lock()
+
+
+def process_id():
+    """Return the ID of this process as the holder of job leases."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class TaskJob(object):
+    """Function run periodically by the process holding the job lease.
+
+    The processes running the job loop try to acquire or renew the lease
+    at each interval.  The lease lasts lease_intervals intervals, after
+    which another process takes over the job of a process that died.
+
+    :param leased: False for the jobs run by every process, like the report
+                   of its own metrics
+    """
+
+    def __init__(self, name, func, interval, lease_intervals=3,
+                 session_maker=db.get_session, leased=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.lease_intervals = lease_intervals
+        self.session_maker = session_maker
+        self.leased = leased
+        self._loop = None
+
+    def _acquire(self):
+        try:
+            return task_db.acquire_lease(
+                self.session_maker(), self.name, process_id(),
+                self.interval * self.lease_intervals)
+        except Exception:
+            LOG.exception(_LE("Failed to acquire the lease of the %s job"),
+                          self.name)
+            return False
+
+    def run_once(self):
+        """Run the job if this process holds its lease.
+
+        :returns: Whether the job was run
+        """
+        if self.leased and not self._acquire():
+            return False
+        self.func()
+        return True
+
+    def renew(self):
+        """Renew the lease during a run, e.g. between batches of work.
+
+        A run lasting longer than the lease would otherwise let another
+        process start the job concurrently.
+
+        :returns: Whether this process still holds the lease, the run
+                  stopping otherwise
+        """
+        if not self.leased or self._acquire():
+            return True
+        LOG.warning(_LW("Lost the lease of the %s job, stopping its run"),
+                    self.name)
+        return False
+
+    def start(self):
+        self._loop = loopingcall.FixedIntervalLoopingCall(self.run_once)
+        self._loop.start(interval=self.interval)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+
+def start_job(name, func, interval, leased=True):
+    """Start the loop of a job in this process, unless already started.
+
+    :returns: The TaskJob started in this process under that name
+    """
+    with _jobs_lock:
+        job = _JOBS.get(name)
+        if job is None:
+            job = _JOBS[name] = TaskJob(name, func, interval, leased=leased)
+            job.start()
+        return job
+
+
+def stop_jobs():
+    """Stop the loops of the jobs started in this process."""
+    with _jobs_lock:
+        for job in _JOBS.values():
+            job.stop()
+        _JOBS.clear()
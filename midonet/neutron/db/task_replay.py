@@ -0,0 +1,241 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Replay of recorded tasks into a target database, for capacity testing.
+
+The tasks are read from a tasks table or from a task archive, and created
+again in the target database through the plugin task insert path, one
+transaction per recorded transaction, at the recorded pace scaled by a
+speed multiplier.  The UUIDs they contain are rewritten so that several
+runs do not collide.
+"""
+
+import re
+import threading
+import time
+import uuid
+
+from midonet.neutron.db import task_archive
+from midonet.neutron.db import task_db
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+import six
+from six.moves import queue
+
+_UUID_RE = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                      '[0-9a-f]{12}', re.IGNORECASE)
+
+
+def db_records(session, after_id=None, last_id=None, page_size=1000):
+    """Generate the records of the tasks of a tasks table, in ID order."""
+    for task in task_db.get_tasks(session, after_id=after_id,
+                                  page_size=page_size):
+        if last_id is not None and task.id > last_id:
+            return
+        yield task_archive.task_record(
+            task, *task_db.get_task_data(session, task))
+
+
+def archive_records(directory, first_id=None, last_id=None):
+    """Generate the records of the tasks of a task archive, in ID order."""
+    return task_archive.TaskArchiveReader(directory).read(first_id, last_id)
+
+
+class UuidRewriter(object):
+    """Map each UUID to a new one, the same for the whole run.
+
+    The new UUIDs are derived from the old ones and a namespace, random
+    unless given, so that no mapping needs to be kept.  The ID of the
+    config task is kept.
+    """
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace or uuid.uuid4()
+
+    def _sub(self, match):
+        value = match.group(0)
+        if value == task_db.CONF_ID:
+            return value
+        return str(uuid.uuid5(self.namespace, value.lower()))
+
+    def rewrite(self, value):
+        if isinstance(value, dict):
+            return dict((k, self.rewrite(v)) for k, v in value.items())
+        if isinstance(value, list):
+            return [self.rewrite(v) for v in value]
+        if isinstance(value, six.string_types):
+            return _UUID_RE.sub(self._sub, value)
+        return value
+
+
+class _Context(object):
+
+    def __init__(self, session, tenant, request_id):
+        self.session = session
+        self.tenant = tenant
+        self.request_id = request_id
+
+
+class TaskReplayer(object):
+    """Replay task records into a target database.
+
+    :param session_maker: Function returning a new autocommit session of
+                          the target database
+    :param speed: Pace multiplier, 2 replays twice as fast as recorded and
+                  0 as fast as possible
+    :param concurrency: Number of transactions replayed concurrently.  The
+                        transactions are not ordered across workers.
+    :param rewrite_uuids: Rewrite the UUIDs of the tasks
+    :param stats_interval: Interval in seconds between two samples of the
+                           consumer lag of the target
+    """
+
+    def __init__(self, session_maker, speed=1.0, concurrency=1,
+                 rewrite_uuids=True, stats_interval=1.0):
+        self.session_maker = session_maker
+        self.speed = speed
+        self.concurrency = concurrency
+        self.rewriter = UuidRewriter() if rewrite_uuids else None
+        self.stats_interval = stats_interval
+        # Full data of the resources, for the delta UPDATE tasks
+        self._data = {}
+
+    def _resolve_data(self, record):
+        key = (record['data_type'], record['resource_id'])
+        data = None
+        if record['data'] is not None:
+            data = task_db.decode_task_data(record['data_format'],
+                                            record['data'])
+            if record.get('base_task_id') is not None:
+                data = task_db.apply_delta(self._data.get(key, {}), data)
+        if record['type'] == task_db.DELETE:
+            self._data.pop(key, None)
+        elif isinstance(data, dict):
+            self._data[key] = data
+        return data
+
+    def _transactions(self, records):
+        # Group the records by transaction, resolving their data in ID
+        # order.
+        transaction = []
+        for record in records:
+            record = dict(record, data=self._resolve_data(record))
+            if self.rewriter is not None:
+                record = self.rewriter.rewrite(record)
+            if (transaction and record['transaction_id'] !=
+                    transaction[0]['transaction_id']):
+                yield transaction
+                transaction = []
+            transaction.append(record)
+        if transaction:
+            yield transaction
+
+    def _insert(self, session, transaction):
+        first = transaction[0]
+        context = _Context(session, first['tenant_id'],
+                           first['transaction_id'] or str(uuid.uuid4()))
+        with session.begin():
+            for record in transaction:
+                depends_on = record.get('depends_on')
+                if depends_on is not None:
+                    depends_on = jsonutils.loads(depends_on)
+                task_db.create_task(
+                    context, record['type'], data_type=record['data_type'],
+                    resource_id=record['resource_id'], data=record['data'],
+                    lane=record.get('lane') or task_db.LANE_INTERACTIVE,
+                    depends_on=depends_on)
+
+    def _work(self, transactions, errors):
+        session = self.session_maker()
+        while True:
+            transaction = transactions.get()
+            try:
+                if transaction is None:
+                    return
+                if not errors:
+                    self._insert(session, transaction)
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                transactions.task_done()
+
+    def _sample(self, session, report):
+        stats = task_db.get_task_stats(session)
+        report['max_backlog'] = max(report['max_backlog'], stats['backlog'])
+        report['max_lag'] = max(report['max_lag'],
+                                stats['oldest_unprocessed_age'])
+        report['backlog'] = stats['backlog']
+        report['lag'] = stats['oldest_unprocessed_age']
+
+    def replay(self, records):
+        """Replay the records, given in ID order.
+
+        :returns: Report dict with the number of replayed tasks and
+                  transactions, the insert throughput, and the backlog and
+                  lag of the consumer of the target, at the end and the
+                  maximum sampled.
+        """
+        report = dict(tasks=0, transactions=0, max_backlog=0, max_lag=0)
+        session = self.session_maker()
+        workers = []
+        errors = []
+        transactions = queue.Queue(maxsize=2 * self.concurrency)
+        if self.concurrency > 1:
+            workers = [threading.Thread(target=self._work,
+                                        args=(transactions, errors))
+                       for _i in range(self.concurrency)]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+
+        start = last_sample = time.time()
+        first_time = None
+        try:
+            for transaction in self._transactions(records):
+                created_at = transaction[0]['created_at']
+                if self.speed and created_at:
+                    created_at = timeutils.normalize_time(
+                        timeutils.parse_isotime(created_at))
+                    if first_time is None:
+                        first_time = created_at
+                    delay = (start + (created_at - first_time).total_seconds()
+                             / self.speed - time.time())
+                    if delay > 0:
+                        time.sleep(delay)
+                if errors:
+                    raise errors[0]
+                if workers:
+                    transactions.put(transaction)
+                else:
+                    self._insert(session, transaction)
+                report['tasks'] += len(transaction)
+                report['transactions'] += 1
+                if time.time() - last_sample >= self.stats_interval:
+                    self._sample(session, report)
+                    last_sample = time.time()
+            transactions.join()
+            if errors:
+                raise errors[0]
+        finally:
+            for _worker in workers:
+                transactions.put(None)
+            for worker in workers:
+                worker.join()
+        elapsed = max(time.time() - start, 1e-6)
+        self._sample(session, report)
+        report['elapsed'] = elapsed
+        report['tasks_per_second'] = report['tasks'] / elapsed
+        report['transactions_per_second'] = report['transactions'] / elapsed
+        return report
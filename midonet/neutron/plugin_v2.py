@@ -71,20 +71,10 @@ class MidonetPluginV2(plugin.MidonetMixinBase,
     def create_network(self, context, network):
         LOG.debug('MidonetPluginV2.create_network called: network=%r', network)
 
-        net_data = network['network']
-        tenant_id = self._get_tenant_id_for_create(context, net_data)
-        net_data['tenant_id'] = tenant_id
-        self._ensure_default_security_group(context, tenant_id)
+        self._ensure_default_security_groups(context, [network['network']])
 
         with context.session.begin(subtransactions=True):
-            net = super(MidonetPluginV2, self).create_network(context, network)
-            net_data['id'] = net['id']
-            self._process_l3_create(context, net, net_data)
-            self._create_provider_network(context, net_data)
-            self._extend_provider_network_dict(context, net)
-            if psec.PORTSECURITY in net_data:
-                self._process_network_port_security_create(context, net_data,
-                                                           net)
+            net = self._create_network_db(context, network)
             self.client.create_network_precommit(context, net)
 
         try:
@@ -103,6 +93,56 @@ class MidonetPluginV2(plugin.MidonetMixinBase,
         LOG.debug("MidonetPluginV2.create_network exiting: net=%r", net)
         return net
 
+    def create_network_bulk(self, context, networks):
+        LOG.debug('MidonetPluginV2.create_network_bulk called: '
+                  'networks=%r', networks)
+
+        items = networks['networks']
+        self._ensure_default_security_groups(
+            context, [item['network'] for item in items])
+
+        with context.session.begin(subtransactions=True):
+            nets = [self._create_network_db(context, item) for item in items]
+            self.client.create_network_bulk_precommit(context, nets)
+
+        try:
+            self.client.create_network_bulk_postcommit(nets)
+        except Exception as ex:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_LE("Failed to create bulk networks %(nets)r "
+                              "in Midonet: %(err)s"),
+                          {"nets": nets, "err": ex})
+                for net in nets:
+                    try:
+                        self.delete_network(context, net['id'])
+                    except Exception:
+                        LOG.exception(_LE("Failed to delete network %s"),
+                                      net['id'])
+
+        LOG.debug("MidonetPluginV2.create_network_bulk exiting: nets=%r",
+                  nets)
+        return nets
+
+    def _ensure_default_security_groups(self, context, resources):
+        # The default security group is created in its own transaction
+        tenant_ids = set()
+        for res in resources:
+            res['tenant_id'] = self._get_tenant_id_for_create(context, res)
+            tenant_ids.add(res['tenant_id'])
+        for tenant_id in sorted(tenant_ids):
+            self._ensure_default_security_group(context, tenant_id)
+
+    def _create_network_db(self, context, network):
+        net_data = network['network']
+        net = super(MidonetPluginV2, self).create_network(context, network)
+        net_data['id'] = net['id']
+        self._process_l3_create(context, net, net_data)
+        self._create_provider_network(context, net_data)
+        self._extend_provider_network_dict(context, net)
+        if psec.PORTSECURITY in net_data:
+            self._process_network_port_security_create(context, net_data, net)
+        return net
+
     def get_network(self, context, id, fields=None):
         LOG.debug("MidonetPluginV2.get_network called: id=%(id)r", {'id': id})
 
@@ -225,65 +265,10 @@ class MidonetPluginV2(plugin.MidonetMixinBase,
     def create_port(self, context, port):
         LOG.debug("MidonetPluginV2.create_port called: port=%r", port)
 
-        port_data = port['port']
         # REVISIT(yamamoto): this nested transaction is a workaround
         # for bug #1490917.
         with db_api.autonested_transaction(context.session):
-            # Create a Neutron port
-            new_port = super(MidonetPluginV2, self).create_port(context, port)
-
-            # Do not create a gateway port if it has no IP address assigned as
-            # MidoNet does not yet handle this case.
-            if (new_port.get('device_owner') == n_const.DEVICE_OWNER_ROUTER_GW
-                    and not new_port['fixed_ips']):
-                msg = (_("No IPs assigned to the gateway port for"
-                         " router %s") % port_data['device_id'])
-                raise n_exc.BadRequest(resource='router', msg=msg)
-
-            dhcp_opts = port['port'].get(edo_ext.EXTRADHCPOPTS, [])
-
-            # Make sure that the port created is valid
-            if "id" not in new_port:
-                raise n_exc.BadRequest(resource='port',
-                                       msg="Invalid port created")
-
-            # Update fields
-            port_data.update(new_port)
-
-            port_psec, has_ip = self._determine_port_security_and_has_ip(
-                context, port['port'])
-            port['port'][psec.PORTSECURITY] = port_psec
-            self._process_port_port_security_create(context,
-                                                    port['port'],
-                                                    new_port)
-
-            if port_psec is False:
-                if self._check_update_has_security_groups(port):
-                    raise psec.PortSecurityAndIPRequiredForSecurityGroups()
-                if self._check_update_has_allowed_address_pairs(port):
-                    raise addr_pair.AddressPairAndPortSecurityRequired()
-            else:
-                # Bind security groups to the port
-                self._ensure_default_security_group_on_port(context, port)
-
-            sg_ids = self._get_security_groups_on_port(context, port)
-            self._process_port_create_security_group(context, new_port, sg_ids)
-
-            # Process port bindings
-            self._process_portbindings_create_and_update(context, port_data,
-                                                         new_port)
-            self._process_mido_portbindings_create_and_update(context,
-                                                              port_data,
-                                                              new_port)
-
-            self._process_port_create_extra_dhcp_opts(context, new_port,
-                                                      dhcp_opts)
-
-            new_port[addr_pair.ADDRESS_PAIRS] = (
-                self._process_create_allowed_address_pairs(
-                    context, new_port,
-                    port_data.get(addr_pair.ADDRESS_PAIRS)))
-
+            new_port = self._create_port_db(context, port)
             self.client.create_port_precommit(context, new_port)
 
         try:
@@ -302,6 +287,91 @@ class MidonetPluginV2(plugin.MidonetMixinBase,
         LOG.debug("MidonetPluginV2.create_port exiting: port=%r", new_port)
         return new_port
 
+    def create_port_bulk(self, context, ports):
+        LOG.debug("MidonetPluginV2.create_port_bulk called: ports=%r", ports)
+
+        with db_api.autonested_transaction(context.session):
+            new_ports = [self._create_port_db(context, item)
+                         for item in ports['ports']]
+            self.client.create_port_bulk_precommit(context, new_ports)
+
+        try:
+            self.client.create_port_bulk_postcommit(new_ports)
+        except Exception as ex:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_LE("Failed to create bulk ports %(new_ports)s: "
+                              "%(err)s"),
+                          {"new_ports": new_ports, "err": ex})
+                for new_port in new_ports:
+                    try:
+                        self.delete_port(context, new_port['id'],
+                                         l3_port_check=False)
+                    except Exception:
+                        LOG.exception(_LE("Failed to delete port %s"),
+                                      new_port['id'])
+
+        LOG.debug("MidonetPluginV2.create_port_bulk exiting: ports=%r",
+                  new_ports)
+        return new_ports
+
+    def _create_port_db(self, context, port):
+        port_data = port['port']
+        # Create a Neutron port
+        new_port = super(MidonetPluginV2, self).create_port(context, port)
+
+        # Do not create a gateway port if it has no IP address assigned as
+        # MidoNet does not yet handle this case.
+        if (new_port.get('device_owner') == n_const.DEVICE_OWNER_ROUTER_GW
+                and not new_port['fixed_ips']):
+            msg = (_("No IPs assigned to the gateway port for"
+                     " router %s") % port_data['device_id'])
+            raise n_exc.BadRequest(resource='router', msg=msg)
+
+        dhcp_opts = port['port'].get(edo_ext.EXTRADHCPOPTS, [])
+
+        # Make sure that the port created is valid
+        if "id" not in new_port:
+            raise n_exc.BadRequest(resource='port',
+                                   msg="Invalid port created")
+
+        # Update fields
+        port_data.update(new_port)
+
+        port_psec, has_ip = self._determine_port_security_and_has_ip(
+            context, port['port'])
+        port['port'][psec.PORTSECURITY] = port_psec
+        self._process_port_port_security_create(context,
+                                                port['port'],
+                                                new_port)
+
+        if port_psec is False:
+            if self._check_update_has_security_groups(port):
+                raise psec.PortSecurityAndIPRequiredForSecurityGroups()
+            if self._check_update_has_allowed_address_pairs(port):
+                raise addr_pair.AddressPairAndPortSecurityRequired()
+        else:
+            # Bind security groups to the port
+            self._ensure_default_security_group_on_port(context, port)
+
+        sg_ids = self._get_security_groups_on_port(context, port)
+        self._process_port_create_security_group(context, new_port, sg_ids)
+
+        # Process port bindings
+        self._process_portbindings_create_and_update(context, port_data,
+                                                     new_port)
+        self._process_mido_portbindings_create_and_update(context,
+                                                          port_data,
+                                                          new_port)
+
+        self._process_port_create_extra_dhcp_opts(context, new_port,
+                                                  dhcp_opts)
+
+        new_port[addr_pair.ADDRESS_PAIRS] = (
+            self._process_create_allowed_address_pairs(
+                context, new_port,
+                port_data.get(addr_pair.ADDRESS_PAIRS)))
+        return new_port
+
     def delete_port(self, context, id, l3_port_check=True):
         LOG.debug("MidonetPluginV2.delete_port called: id=%(id)s "
                   "l3_port_check=%(l3_port_check)r",
@@ -0,0 +1,291 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fixtures
+import mock
+import os
+import sqlalchemy as sa
+
+from midonet.neutron.client import base
+from midonet.neutron.client import cluster
+from midonet.neutron.common import exceptions as mido_exc
+from midonet.neutron.common import metrics
+from midonet.neutron.db import task_db as task
+from midonet.neutron.db import task_jobs
+from neutron import context
+from neutron.tests.unit import testlib_api
+from oslo_config import cfg
+from oslo_serialization import jsonutils
+
+
+class _FakeLoopingCall(object):
+
+    started = []
+
+    def __init__(self, func):
+        self.func = func
+
+    def start(self, interval):
+        self.started.append((self.func, interval))
+
+    def stop(self):
+        pass
+
+
+class ClusterClientTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(ClusterClientTestCase, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'oslo_service.loopingcall.FixedIntervalLoopingCall',
+            _FakeLoopingCall))
+        self.addCleanup(task_jobs.stop_jobs)
+        _FakeLoopingCall.started = []
+
+    def _override(self, **kwargs):
+        for name, value in kwargs.items():
+            cfg.CONF.set_override(name, value, 'MIDONET')
+            self.addCleanup(cfg.CONF.clear_override, name, 'MIDONET')
+
+    def _client(self):
+        return cluster.MidonetClusterClient(cfg.CONF.MIDONET)
+
+
+class TestClusterClientJobs(ClusterClientTestCase):
+
+    def test_jobs_started_once_per_process(self):
+        self._override(task_prune_interval=60, task_metrics_interval=10)
+        # The core plugin and the ML2 driver both initialize a client
+        first, second = self._client(), self._client()
+        first.initialize()
+        second.initialize()
+        # The pruner, the queue metrics and the counters of the process
+        self.assertEqual([60, 10, 10],
+                         sorted((i for _f, i in _FakeLoopingCall.started),
+                                reverse=True))
+        self.assertIs(first._pruner, second._pruner)
+        self.assertIs(first._metrics_reporter, second._metrics_reporter)
+
+    def test_jobs_disabled(self):
+        self._override(task_prune_interval=0, task_metrics_interval=0)
+        self._client().initialize()
+        self.assertEqual([], _FakeLoopingCall.started)
+
+
+class TestClusterClientDoorbell(ClusterClientTestCase):
+
+    def test_failed_notify_keeps_tasks(self):
+        self._override(task_doorbell='pgnotify', task_prune_interval=0,
+                       task_metrics_interval=0)
+        client = self._client()
+        client.initialize()
+        self.addCleanup(task.unregister_flush_hook,
+                        client._doorbell.notify_flushed)
+        ctx = context.Context('user', 'tenant')
+        failures = metrics.get_counters().get('task_doorbell_failed', 0)
+        # No pg_notify in SQLite: the NOTIFY fails in its savepoint
+        with ctx.session.begin(subtransactions=True):
+            task.create_task(ctx, task.CREATE, data_type=task.NETWORK,
+                             resource_id='n1', data={'id': 'n1'})
+        self.assertEqual(['n1'], [t.resource_id for t in ctx.session.query(
+            task.Task).filter_by(data_type=task.NETWORK)])
+        self.assertEqual(failures + 1,
+                         metrics.get_counters()['task_doorbell_failed'])
+
+    def test_doorbell_rung_once_per_commit(self):
+        self._override(task_doorbell='udp',
+                       task_doorbell_address='127.0.0.1:1',
+                       task_prune_interval=0, task_metrics_interval=0)
+        # The core plugin and the ML2 driver both initialize a client
+        first, second = self._client(), self._client()
+        first.initialize()
+        second.initialize()
+        self.assertIs(first._doorbell, second._doorbell)
+        self.addCleanup(task.unregister_commit_hook,
+                        first._doorbell.ring_committed)
+        ctx = context.Context('user', 'tenant')
+        with mock.patch.object(first._doorbell, 'ring') as ring:
+            with ctx.session.begin(subtransactions=True):
+                task.create_task(ctx, task.CREATE, data_type=task.NETWORK,
+                                 resource_id='n1', data={'id': 'n1'})
+        self.assertEqual(1, ring.call_count)
+
+
+class TestClusterClientLanes(ClusterClientTestCase):
+
+    def setUp(self):
+        super(TestClusterClientLanes, self).setUp()
+        self._override(task_tenant_rate=0.01, task_tenant_burst=2)
+        self.ctx = context.Context('user', 'tenant')
+
+    def _rules(self, count):
+        return [{'id': 'r%d' % i, 'security_group_id': 'sg1',
+                 'remote_group_id': None} for i in range(count)]
+
+    def test_task_lane_bulk(self):
+        client = self._client()
+        self.assertEqual([task.LANE_INTERACTIVE] * 2 + [task.LANE_BULK],
+                         [client._task_lane(self.ctx, 1) for _i in range(3)])
+        # Tenants are limited separately
+        self.assertEqual(task.LANE_INTERACTIVE, client._task_lane(
+            context.Context('user', 'other'), 1))
+        self.assertEqual(task.LANE_INTERACTIVE, client._task_lane(
+            context.get_admin_context(), 10))
+        self.assertEqual(
+            [('task_tenant_emitted', {'tenant_id': 'other'}, 1),
+             ('task_tenant_emitted', {'tenant_id': 'tenant'}, 2),
+             ('task_tenant_limited', {'tenant_id': 'tenant'}, 1)],
+            client._rate_limiter.metrics())
+
+    def test_task_lane_reject(self):
+        self._override(task_tenant_overflow='reject')
+        client = self._client()
+        self.assertEqual(task.LANE_INTERACTIVE, client._task_lane(self.ctx, 2))
+        ex = self.assertRaises(mido_exc.TaskRateLimitExceeded,
+                               client._task_lane, self.ctx, 1)
+        self.assertIn('from tenant tenant', str(ex))
+        self.assertTrue(0 < ex.retry_after <= 100)
+
+    def _sg_rule_tasks(self):
+        return [(t.type, t.data_type, t.resource_id, t.lane,
+                 task.task_dependencies(t)) for t in self.ctx.session.query(
+                     task.Task).filter_by(
+                         data_type=task.SECURITY_GROUP_RULE).order_by(
+                             task.Task.id)]
+
+    def test_sg_rule_bulk_precommit(self):
+        self._override(task_dependencies=True)
+        client = self._client()
+        with self.ctx.session.begin(subtransactions=True):
+            client.create_security_group_rule_bulk_precommit(
+                self.ctx, self._rules(2))
+        self.assertEqual(
+            [(task.CREATE, task.SECURITY_GROUP_RULE, 'r%d' % i,
+              task.LANE_BULK, ['sg1']) for i in range(2)],
+            self._sg_rule_tasks())
+        # The whole bulk is accounted for at once
+        self.assertEqual(
+            [('task_tenant_emitted', {'tenant_id': 'tenant'}, 2)],
+            client._rate_limiter.metrics())
+
+    def test_bulk_counts_against_rate(self):
+        client = self._client()
+        with self.ctx.session.begin(subtransactions=True):
+            client.create_network_precommit(self.ctx, {'id': 'n1'})
+            client.create_network_bulk_precommit(self.ctx, [{'id': 'n2'}])
+            client.create_network_precommit(self.ctx, {'id': 'n3'})
+        self.assertEqual([(task.CREATE, 'n1', task.LANE_INTERACTIVE),
+                          (task.CREATE, 'n2', task.LANE_BULK),
+                          (task.CREATE, 'n3', task.LANE_BULK)],
+                         self._tasks(task.NETWORK))
+
+    def test_sg_rule_bulk_precommit_reject(self):
+        self._override(task_tenant_overflow='reject')
+        client = self._client()
+        rules = self._rules(3)
+        with self.ctx.session.begin(subtransactions=True):
+            client.create_security_group_rule_bulk_precommit(
+                self.ctx, rules[:2])
+        with self.ctx.session.begin(subtransactions=True):
+            self.assertRaises(
+                mido_exc.TaskRateLimitExceeded,
+                client.create_security_group_rule_bulk_precommit,
+                self.ctx, rules[2:])
+        self.assertEqual(['r0', 'r1'],
+                         [r for _t, _d, r, _l, _o in self._sg_rule_tasks()])
+
+    def _tasks(self, data_type):
+        query = self.ctx.session.query(task.Task).filter_by(
+            data_type=data_type).order_by(task.Task.id)
+        return [(t.type, t.resource_id, t.lane) for t in query]
+
+    def test_network_and_port_bulk_precommit(self):
+        statements = []
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            if statement.startswith('INSERT INTO midonet_tasks'):
+                statements.append(executemany)
+
+        engine = self.ctx.session.get_bind()
+        sa.event.listen(engine, 'before_cursor_execute', before_execute)
+        self.addCleanup(sa.event.remove, engine, 'before_cursor_execute',
+                        before_execute)
+        client = self._client()
+        with self.ctx.session.begin(subtransactions=True):
+            client.create_network_bulk_precommit(
+                self.ctx, [{'id': 'n1'}, {'id': 'n2'}])
+        with self.ctx.session.begin(subtransactions=True):
+            client.create_port_bulk_precommit(
+                self.ctx, [{'id': 'p1', 'network_id': 'n1'},
+                           {'id': 'p2', 'network_id': 'n2'}])
+        self.assertEqual([True, True], statements)
+        self.assertEqual([(task.CREATE, 'n1', task.LANE_BULK),
+                          (task.CREATE, 'n2', task.LANE_BULK)],
+                         self._tasks(task.NETWORK))
+        self.assertEqual([(task.CREATE, 'p1', task.LANE_BULK),
+                          (task.CREATE, 'p2', task.LANE_BULK)],
+                         self._tasks(task.PORT))
+
+    def test_sg_precommit_carries_rules(self):
+        sg = {'id': 'sg1', 'name': 'default',
+              'security_group_rules': self._rules(2)}
+        with self.ctx.session.begin(subtransactions=True):
+            self._client().create_security_group_precommit(self.ctx, sg)
+        self.assertEqual([(task.CREATE, 'sg1', task.LANE_INTERACTIVE)],
+                         self._tasks(task.SECURITY_GROUP))
+        self.assertEqual([], self._sg_rule_tasks())
+        data = task.get_current_task_data(self.ctx.session)
+        self.assertEqual(sg, jsonutils.loads(data[task.SECURITY_GROUP]['sg1']))
+
+    def test_base_bulk_precommit_per_resource(self):
+        client = base.MidonetClientBase()
+        with mock.patch.object(client, 'create_port_precommit') as create:
+            client.create_port_bulk_precommit(self.ctx, [{'id': 'p1'},
+                                                         {'id': 'p2'}])
+        self.assertEqual([mock.call(self.ctx, {'id': 'p1'}),
+                          mock.call(self.ctx, {'id': 'p2'})],
+                         create.call_args_list)
+
+
+class TestClusterClientMetrics(ClusterClientTestCase):
+
+    def setUp(self):
+        super(TestClusterClientMetrics, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'midonet.prom')
+        self._override(task_metrics_prometheus_file=self.path,
+                       task_metrics_interval=10)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_queue_metrics_in_main_file(self):
+        self._client()._report_metrics()
+        text = self._read(self.path)
+        self.assertIn('midonet_task_backlog 0\n', text)
+        self.assertNotIn('pid=', text)
+
+    def test_counters_in_process_file(self):
+        metrics.incr('task_update_suppressed')
+        stale = metrics.process_file(self.path, pid=2 ** 22 + 1)
+        open(stale, 'w').close()
+        self._client()._report_counters()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(stale))
+        text = self._read(metrics.process_file(self.path))
+        self.assertIn('midonet_task_update_suppressed{pid="%d"} ' %
+                      os.getpid(), text)
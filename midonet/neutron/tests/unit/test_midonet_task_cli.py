@@ -0,0 +1,177 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fixtures
+import os
+
+from midonet.neutron.common import config
+from midonet.neutron.db.migration import cli
+from midonet.neutron.db import task_archive
+from midonet.neutron.db import task_db
+from neutron import context
+from neutron.db import model_base
+from neutron.tests.unit import testlib_api
+from oslo_config import cfg
+from oslo_serialization import jsonutils
+import six
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+
+class TestTaskCli(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(TestTaskCli, self).setUp()
+        self.ctx = context.Context('user', 'tenant')
+        self.session = self.ctx.session
+        self.addCleanup(cli.CONF.clear)
+
+    def _parse(self, *argv):
+        cli.CONF(list(argv), project='neutron', default_config_files=[])
+        return cli.CONF.command
+
+    def _run(self, *argv):
+        self._parse(*argv)
+        out = six.StringIO()
+        self.useFixture(fixtures.MonkeyPatch('sys.stdout', out))
+        cli.CONF.command.func(self.session)
+        return out.getvalue()
+
+    def _create_tasks(self):
+        with self.session.begin(subtransactions=True):
+            task_db.create_task(self.ctx, task_db.CREATE,
+                                data_type=task_db.NETWORK, resource_id='n1',
+                                data={'id': 'n1'})
+            task_db.create_task(self.ctx, task_db.CREATE,
+                                data_type=task_db.PORT, resource_id='p1',
+                                data={'id': 'p1', 'network_id': 'n1'})
+        return [t.id for t in self.session.query(task_db.Task).order_by(
+            task_db.Task.id)]
+
+    def test_task_list_args(self):
+        args = self._parse('task-list', '-u', '--data-type', 'PORT',
+                           '--after-id', '3', '--since',
+                           '2015-01-02T03:04:05Z')
+        self.assertTrue(args.unprocessed)
+        self.assertEqual('PORT', args.data_type)
+        self.assertEqual(3, args.after_id)
+        self.assertEqual(1000, args.page_size)
+        self.assertFalse(args.data)
+        self.assertEqual('2015-01-02 03:04:05',
+                         str(cli._parse_time(args.since)))
+
+    def test_task_list_output(self):
+        ids = self._create_tasks()
+        lines = self._run('task-list', '--data-type', 'PORT',
+                          '--data').splitlines()
+        self.assertEqual('\t'.join(cli.TASK_LIST_FIELDS), lines[0])
+        fields = lines[1].split('\t')
+        self.assertEqual([str(ids[1]), task_db.CREATE, task_db.PORT, 'p1',
+                          'tenant', self.ctx.request_id], fields[:6])
+        self.assertEqual({'id': 'p1', 'network_id': 'n1'},
+                         jsonutils.loads(lines[2].strip()))
+        self.assertEqual(3, len(lines))
+
+    def test_task_stats_formats(self):
+        ids = self._create_tasks()
+        text = self._run('task-stats')
+        self.assertIn('backlog\t2\n', text)
+        self.assertIn('backlog[PORT]\t1\n', text)
+        self.assertIn('backlog[lane=0]\t2\n', text)
+        stats = jsonutils.loads(self._run('task-stats', '--format', 'json'))
+        self.assertEqual(ids[-1], stats['max_task_id'])
+        self.assertEqual(2, stats['backlog'])
+        prometheus = self._run('task-stats', '--format', 'prometheus')
+        self.assertIn('midonet_task_backlog 2\n', prometheus)
+        self.assertIn('midonet_task_backlog_by_data_type'
+                      '{data_type="NETWORK"} 1\n', prometheus)
+        self.assertIn('midonet_task_backlog_by_lane{lane="0"} 2\n',
+                      prometheus)
+        self.assertIn('# TYPE midonet_task_backlog gauge\n', prometheus)
+
+    def test_task_stats_invalid_format(self):
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', six.StringIO()))
+        self.assertRaises(SystemExit, self._parse, 'task-stats',
+                          '--format', 'xml')
+
+    def test_task_archive_list(self):
+        ids = self._create_tasks()
+        path = self.useFixture(fixtures.TempDir()).path
+        tasks = self.session.query(task_db.Task).order_by(task_db.Task.id)
+        task_archive.TaskArchiveWriter(path).append(
+            [task_archive.task_record(t) for t in tasks])
+        lines = self._run('task-archive-list', path, '--first-id',
+                          str(ids[1]), '--data').splitlines()
+        self.assertEqual(1, len(lines))
+        record = jsonutils.loads(lines[0])
+        self.assertEqual(ids[1], record['id'])
+        self.assertEqual({'id': 'p1', 'network_id': 'n1'}, record['data'])
+        self.assertEqual([], self._run('task-archive-list', path,
+                                       '--last-id', '0').splitlines())
+
+    def _config_file(self, text):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'neutron.conf')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_config_file(self):
+        archive_dir = self.useFixture(fixtures.TempDir()).path
+        path = self._config_file('[database]\nconnection = sqlite://\n'
+                                 '[MIDONET]\ntask_archive_dir = %s\n'
+                                 'task_data_format = zlib\n' % archive_dir)
+        self._parse('--config-file', path, 'task-stats')
+        self.assertEqual('sqlite://', cli.CONF.database.connection)
+        self.assertEqual(archive_dir, cli.CONF.MIDONET.task_archive_dir)
+        conf = cfg.ConfigOpts()
+        conf.register_opts(config.mido_opts, 'MIDONET')
+        cli.load_config(conf)
+        self.assertEqual('zlib', conf.MIDONET.task_data_format)
+
+    def test_task_archive_list_configured_dir(self):
+        ids = self._create_tasks()
+        archive_dir = self.useFixture(fixtures.TempDir()).path
+        tasks = self.session.query(task_db.Task).order_by(task_db.Task.id)
+        task_archive.TaskArchiveWriter(archive_dir).append(
+            [task_archive.task_record(t) for t in tasks])
+        path = self._config_file('[MIDONET]\ntask_archive_dir = %s\n' %
+                                 archive_dir)
+        lines = self._run('--config-file', path,
+                          'task-archive-list').splitlines()
+        self.assertEqual(ids, [jsonutils.loads(line)['id'] for line in lines])
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', six.StringIO()))
+        self.assertRaises(SystemExit, self._run, 'task-archive-list')
+
+    def test_task_replay(self):
+        self._create_tasks()
+        args = self._parse('task-replay', 'sqlite://')
+        self.assertEqual((1.0, 1, False),
+                         (args.speed, args.concurrency, args.keep_uuids))
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'target.db')
+        target = sa.create_engine('sqlite:///%s' % path)
+        model_base.BASEV2.metadata.create_all(target)
+        report = dict(line.split('\t') for line in self._run(
+            'task-replay', 'sqlite:///%s' % path, '--speed', '0',
+            '--keep-uuids').splitlines())
+        self.assertEqual('2', report['tasks'])
+        self.assertEqual('1', report['transactions'])
+        session = orm.sessionmaker(bind=target)()
+        self.assertEqual(
+            ['n1', 'p1'],
+            [r for r, in session.query(task_db.Task.resource_id).order_by(
+                task_db.Task.id)])
+        session.close()
@@ -0,0 +1,1587 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import fixtures
+import os
+import socket
+import threading
+
+from midonet.neutron.common import doorbell
+from midonet.neutron.common import exceptions as mido_exc
+from midonet.neutron.common import metrics
+from midonet.neutron.common import rate_limit
+from midonet.neutron.db import data_state_db
+from midonet.neutron.db import task_archive
+from midonet.neutron.db import task_consumer
+from midonet.neutron.db import task_db
+from midonet.neutron.db import task_jobs
+from midonet.neutron.db import task_replay
+from neutron.common import exceptions as n_exc
+from neutron import context
+from neutron.tests.unit import testlib_api
+from oslo_config import cfg
+from oslo_serialization import jsonutils
+import sqlalchemy as sa
+
+
+class TaskDbTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(TaskDbTestCase, self).setUp()
+        self.ctx = context.Context('user', 'tenant')
+        self.session = self.ctx.session
+
+    def _create(self, type, data_type=task_db.PORT, resource_id='r1',
+                data=None):
+        task_db.create_task(self.ctx, type, data_type=data_type,
+                            resource_id=resource_id, data=data)
+
+    def _tasks(self):
+        return [(t.type, t.data_type, t.resource_id,
+                 None if t.data is None else jsonutils.loads(t.data))
+                for t in self.session.query(task_db.Task).order_by(
+                    task_db.Task.id)]
+
+    def _task_ids(self):
+        return [t.id for t in self.session.query(task_db.Task).order_by(
+            task_db.Task.id)]
+
+    def _set_last_processed(self, task_id):
+        with self.session.begin(subtransactions=True):
+            self.session.add(data_state_db.DataState(
+                last_processed_task_id=task_id,
+                updated_at=datetime.datetime.utcnow(),
+                readonly=False))
+
+    def _override(self, **kwargs):
+        for name, value in kwargs.items():
+            cfg.CONF.set_override(name, value, 'MIDONET')
+            self.addCleanup(cfg.CONF.clear_override, name, 'MIDONET')
+
+
+class TestTaskCoalescing(TaskDbTestCase):
+
+    def test_tasks_inserted_at_commit(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+            self.assertEqual([], self._tasks())
+        self.assertEqual([(task_db.CREATE, task_db.PORT, 'r1', {'v': 1})],
+                         self._tasks())
+
+    def test_create_update_becomes_create(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+            self._create(task_db.UPDATE, data={'v': 2})
+        self.assertEqual([(task_db.CREATE, task_db.PORT, 'r1', {'v': 2})],
+                         self._tasks())
+
+    def test_update_update_becomes_last_update(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 1})
+            self._create(task_db.UPDATE, data={'v': 2})
+        self.assertEqual([(task_db.UPDATE, task_db.PORT, 'r1', {'v': 2})],
+                         self._tasks())
+
+    def test_create_delete_cancels_out(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+            self._create(task_db.UPDATE, data={'v': 2})
+            self._create(task_db.DELETE)
+        self.assertEqual([], self._tasks())
+
+    def test_update_delete_kept(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 1})
+            self._create(task_db.DELETE)
+        self.assertEqual([(task_db.UPDATE, task_db.PORT, 'r1', {'v': 1}),
+                          (task_db.DELETE, task_db.PORT, 'r1', None)],
+                         self._tasks())
+
+    def test_create_not_coalesced_across_other_tasks(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.NETWORK, 'n1', {'v': 1})
+            self._create(task_db.CREATE, task_db.PORT, 'p1', {'v': 1})
+            self._create(task_db.UPDATE, task_db.NETWORK, 'n1', {'v': 2})
+            self._create(task_db.CREATE, task_db.PORT, 'p2', {'v': 1})
+            self._create(task_db.DELETE, task_db.PORT, 'p1')
+        self.assertEqual([(task_db.CREATE, task_db.NETWORK, 'n1', {'v': 1}),
+                          (task_db.CREATE, task_db.PORT, 'p1', {'v': 1}),
+                          (task_db.UPDATE, task_db.NETWORK, 'n1', {'v': 2}),
+                          (task_db.CREATE, task_db.PORT, 'p2', {'v': 1}),
+                          (task_db.DELETE, task_db.PORT, 'p1', None)],
+                         self._tasks())
+
+    def test_update_moved_after_the_tasks_it_follows(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, task_db.PORT, 'p1',
+                         {'security_groups': []})
+            self._create(task_db.CREATE, task_db.SECURITY_GROUP, 'sg1',
+                         {'id': 'sg1'})
+            self._create(task_db.UPDATE, task_db.PORT, 'p1',
+                         {'security_groups': ['sg1']})
+        self.assertEqual(
+            [(task_db.CREATE, task_db.SECURITY_GROUP, 'sg1', {'id': 'sg1'}),
+             (task_db.UPDATE, task_db.PORT, 'p1',
+              {'security_groups': ['sg1']})],
+            self._tasks())
+
+    def test_rollback_discards_tasks(self):
+        try:
+            with self.session.begin(subtransactions=True):
+                self._create(task_db.CREATE, data={'v': 1})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([], self._tasks())
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r2', data={'v': 1})
+        self.assertEqual(1, len(self._tasks()))
+
+    def test_savepoint_rollback_discards_only_its_tasks(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+            try:
+                with self.session.begin(nested=True):
+                    self._create(task_db.UPDATE, data={'v': 2})
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual([(task_db.CREATE, task_db.PORT, 'r1', {'v': 1})],
+                         self._tasks())
+
+    def test_savepoint_release_coalesces_into_parent(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+            with self.session.begin(nested=True):
+                self._create(task_db.UPDATE, data={'v': 2})
+        self.assertEqual([(task_db.CREATE, task_db.PORT, 'r1', {'v': 2})],
+                         self._tasks())
+
+
+class TestTaskBulkCreate(TaskDbTestCase):
+
+    def _rules(self, count):
+        return [{'type': task_db.CREATE,
+                 'data_type': task_db.SECURITY_GROUP_RULE,
+                 'resource_id': 'rule%03d' % i,
+                 'data': {'id': 'rule%03d' % i}} for i in range(count)]
+
+    def test_create_tasks_single_insert(self):
+        self._test_create_tasks_single_insert(True)
+
+    def test_create_tasks_single_insert_without_commit_order(self):
+        self._test_create_tasks_single_insert(False)
+
+    def _test_create_tasks_single_insert(self, commit_order):
+        self._override(task_commit_order=commit_order)
+        statements = []
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            if statement.startswith('INSERT INTO midonet_tasks'):
+                statements.append(executemany)
+
+        engine = self.session.get_bind()
+        sa.event.listen(engine, 'before_cursor_execute', before_execute)
+        self.addCleanup(sa.event.remove, engine, 'before_cursor_execute',
+                        before_execute)
+        task_db.create_tasks(self.ctx, self._rules(500))
+        self.assertEqual([True], statements)
+
+    def test_create_tasks_ids_and_current_state(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+            task_db.create_tasks(self.ctx, self._rules(3))
+        tasks = self.session.query(task_db.Task).order_by(task_db.Task.id)
+        self.assertEqual(['r1', 'rule000', 'rule001', 'rule002'],
+                         [t.resource_id for t in tasks])
+        current = self.session.query(
+            task_db.TaskCurrent.resource_id, task_db.TaskCurrent.task_id)
+        self.assertEqual(dict((t.resource_id, t.id) for t in tasks),
+                         dict(current))
+
+    def _assert_task_ids(self):
+        tasks = self.session.query(task_db.Task).filter(
+            task_db.Task.resource_id.like('rule%')).order_by(task_db.Task.id)
+        current = self.session.query(
+            task_db.TaskCurrent.resource_id, task_db.TaskCurrent.task_id)
+        self.assertEqual(dict((t.resource_id, t.id) for t in tasks),
+                         dict(current))
+        for header in task_db.get_task_transactions(self.session):
+            task_db.get_transaction_tasks(self.session, header)
+
+    def test_create_tasks_ids_with_concurrent_insert(self):
+        self._test_create_tasks_ids_with_concurrent_insert(True)
+
+    def test_create_tasks_ids_with_concurrent_insert_no_commit_order(self):
+        self._test_create_tasks_ids_with_concurrent_insert(False)
+
+    def _test_create_tasks_ids_with_concurrent_insert(self, commit_order):
+        # Rows with the same transaction ID inserted right after the batch,
+        # as by a concurrent request with the same request ID.
+        self._override(task_commit_order=commit_order)
+
+        def after_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+            if executemany and statement.startswith(
+                    'INSERT INTO midonet_tasks'):
+                cursor.execute(
+                    "INSERT INTO midonet_tasks (type, resource_id, "
+                    "transaction_id, lane) VALUES ('CREATE', 'other', ?, 0)",
+                    (self.ctx.request_id,))
+
+        engine = self.session.get_bind()
+        sa.event.listen(engine, 'after_cursor_execute', after_execute)
+        self.addCleanup(sa.event.remove, engine, 'after_cursor_execute',
+                        after_execute)
+        task_db.create_tasks(self.ctx, self._rules(3))
+        self._assert_task_ids()
+
+    def test_create_tasks_ids_without_commit_order(self):
+        self._override(task_commit_order=False)
+        self.ctx.request_id = None
+        task_db.create_tasks(self.ctx, self._rules(3))
+        task_db.create_tasks(self.ctx, self._rules(5)[3:])
+        self._assert_task_ids()
+
+
+class TestTaskCurrentState(TaskDbTestCase):
+
+    def _current(self):
+        data = task_db.get_current_task_data(self.session)
+        return dict((data_type, dict((r_id, jsonutils.loads(d))
+                                     for r_id, d in res.items()))
+                    for data_type, res in data.items())
+
+    def test_current_state_follows_tasks(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.NETWORK, 'n1', {'v': 1})
+            self._create(task_db.CREATE, task_db.PORT, 'p1', {'v': 1})
+            self._create(task_db.CREATE, task_db.PORT, 'p2', {'v': 1})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, task_db.PORT, 'p1', {'v': 2})
+            self._create(task_db.DELETE, task_db.PORT, 'p2')
+        self.assertEqual({task_db.NETWORK: {'n1': {'v': 1}},
+                          task_db.PORT: {'p1': {'v': 2}}},
+                         self._current())
+
+    def test_current_state_records_latest_task_id(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 2})
+        last_id = self.session.query(sa.func.max(task_db.Task.id)).scalar()
+        current = self.session.query(task_db.TaskCurrent).one()
+        self.assertEqual(last_id, current.task_id)
+
+    def test_current_state_recreated_resource(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 1})
+            self._create(task_db.DELETE)
+            self._create(task_db.CREATE, data={'v': 2})
+        self.assertEqual({task_db.PORT: {'r1': {'v': 2}}}, self._current())
+
+    def _race_current_state_keys(self, keys):
+        # Return the given keys the first time, as if the rows had been
+        # inserted or deleted by a concurrent transaction just after.
+        calls = []
+        current_state_keys = task_db._current_state_keys
+
+        def fake(session, rows):
+            calls.append(rows)
+            if len(calls) == 1:
+                return set(keys)
+            return current_state_keys(session, rows)
+        self.useFixture(fixtures.MonkeyPatch(
+            'midonet.neutron.db.task_db._current_state_keys', fake))
+
+    def test_current_state_inserted_concurrently(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+        self._race_current_state_keys([])
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 2})
+        self.assertEqual({task_db.PORT: {'r1': {'v': 2}}}, self._current())
+
+    def test_current_state_deleted_concurrently(self):
+        self._race_current_state_keys([(task_db.PORT, 'r1')])
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 1})
+        self.assertEqual({task_db.PORT: {'r1': {'v': 1}}}, self._current())
+
+
+class TestTaskList(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskList, self).setUp()
+        with self.session.begin(subtransactions=True):
+            for i in range(5):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i, {})
+            self._create(task_db.CREATE, task_db.NETWORK, 'n1', {})
+        self.ids = self._task_ids()
+
+    def _list(self, **kwargs):
+        return [t.resource_id for t in task_db.get_tasks(self.session,
+                                                         **kwargs)]
+
+    def test_list_pages_in_id_order(self):
+        self.assertEqual(['p0', 'p1', 'p2', 'p3', 'p4', 'n1'],
+                         self._list(page_size=2))
+
+    def test_list_filters(self):
+        self.assertEqual(['n1'], self._list(data_type=task_db.NETWORK))
+        self.assertEqual(['p3'], self._list(resource_id='p3'))
+        self.assertEqual([], self._list(tenant_id='other'))
+        self.assertEqual([], self._list(type=task_db.DELETE))
+        self.assertEqual(['p2', 'p3'],
+                         self._list(data_type=task_db.PORT, page_size=1,
+                                    after_id=self.ids[1],
+                                    created_before=datetime.datetime.max)[:2])
+
+    def test_list_unprocessed(self):
+        self._set_last_processed(self.ids[3])
+        self.assertEqual(['p4', 'n1'], self._list(unprocessed=True))
+
+
+class TestTaskPruning(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskPruning, self).setUp()
+        with self.session.begin(subtransactions=True):
+            for i in range(10):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i, {})
+        self.ids = self._task_ids()
+
+    def test_prune_nothing_processed(self):
+        self.assertEqual(0, task_db.prune_tasks(self.session))
+        self.assertEqual(self.ids, self._task_ids())
+
+    def test_prune_in_batches_keeps_last_processed(self):
+        self._set_last_processed(self.ids[6])
+        self.assertEqual(6, task_db.prune_tasks(self.session, batch_size=4))
+        self.assertEqual(self.ids[6:], self._task_ids())
+
+    def test_prune_stops_when_told(self):
+        self._set_last_processed(self.ids[6])
+        checks = []
+
+        def keep_going():
+            checks.append(1)
+            return False
+
+        self.assertEqual(2, task_db.prune_tasks(self.session, batch_size=2,
+                                                keep_going=keep_going))
+        self.assertEqual(self.ids[2:], self._task_ids())
+        self.assertEqual([1], checks)
+
+    def test_prune_keeps_count(self):
+        self._set_last_processed(self.ids[6])
+        self.assertEqual(4, task_db.prune_tasks(self.session, keep=3))
+        self.assertEqual(self.ids[4:], self._task_ids())
+
+    def test_prune_keeps_young_tasks(self):
+        self._set_last_processed(self.ids[6])
+        self.assertEqual(0, task_db.prune_tasks(self.session, max_age=3600))
+        self.assertEqual(self.ids, self._task_ids())
+
+    def test_task_clean(self):
+        self._set_last_processed(self.ids[6])
+        self.assertEqual(7, task_db.task_clean(self.session))
+        self.assertEqual(self.ids[7:], self._task_ids())
+        self.assertIsNone(
+            data_state_db.get_last_processed_task_id(self.session))
+
+
+class TestTaskStats(TaskDbTestCase):
+
+    def test_stats(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(3):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i, {})
+            self._create(task_db.CREATE, task_db.NETWORK, 'n1', {})
+        ids = self._task_ids()
+        self._set_last_processed(ids[0])
+        stats = task_db.get_task_stats(self.session)
+        self.assertEqual(ids[-1], stats['max_task_id'])
+        self.assertEqual(3, stats['backlog'])
+        self.assertEqual({task_db.PORT: 2, task_db.NETWORK: 1},
+                         stats['backlog_by_data_type'])
+        self.assertEqual(4 / 60.0, stats['insert_rate'])
+        self.assertTrue(0 <= stats['oldest_unprocessed_age'] < 60)
+        text = metrics.format_prometheus(metrics.task_stats_metrics(stats))
+        self.assertIn('midonet_task_backlog 3\n', text)
+        self.assertIn('midonet_task_backlog_by_data_type'
+                      '{data_type="PORT"} 2\n', text)
+        # Every series of a name is a part of the same total
+        self.assertEqual(
+            [3, 3, 3],
+            [sum(v for n, _l, v in metrics.task_stats_metrics(stats)
+                 if n == name) for name in ('task_backlog',
+                                            'task_backlog_by_data_type',
+                                            'task_backlog_by_lane')])
+
+    def test_prometheus_help_and_type(self):
+        text = metrics.format_prometheus(
+            [('task_backlog_by_lane', {'lane': 0}, 2),
+             ('task_doorbell_failed', {}, 1),
+             ('task_backlog_by_lane', {'lane': 1}, 3),
+             ('other', {}, 4)])
+        self.assertEqual(
+            '# HELP midonet_task_backlog_by_lane Number of unprocessed tasks '
+            'per lane\n'
+            '# TYPE midonet_task_backlog_by_lane gauge\n'
+            'midonet_task_backlog_by_lane{lane="0"} 2\n'
+            'midonet_task_backlog_by_lane{lane="1"} 3\n'
+            '# HELP midonet_task_doorbell_failed Number of failed doorbell '
+            'rings\n'
+            '# TYPE midonet_task_doorbell_failed counter\n'
+            'midonet_task_doorbell_failed 1\n'
+            '# HELP midonet_other other\n'
+            '# TYPE midonet_other untyped\n'
+            'midonet_other 4\n', text)
+
+    def test_stats_empty(self):
+        stats = task_db.get_task_stats(self.session)
+        self.assertEqual(0, stats['backlog'])
+        self.assertEqual(0, stats['oldest_unprocessed_age'])
+        self.assertEqual({}, stats['backlog_by_data_type'])
+
+    def test_process_metrics(self):
+        self.assertEqual([('task_update_suppressed', {'pid': 12}, 3)],
+                         metrics.process_metrics(
+                             [('task_update_suppressed', {}, 3)], pid=12))
+        self.assertEqual('/run/midonet.12.prom',
+                         metrics.process_file('/run/midonet.prom', pid=12))
+
+    def test_stale_process_files_removed(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'midonet.prom')
+        live = metrics.process_file(path)
+        # Beyond the default maximum PID of Linux
+        gone = metrics.process_file(path, pid=2 ** 22 + 1)
+        for name in (path, live, gone, path + '.12.tmp'):
+            open(name, 'w').close()
+        metrics.remove_stale_process_files(path)
+        self.assertEqual(
+            sorted([path, live, path + '.12.tmp']),
+            sorted(os.path.join(os.path.dirname(path), name)
+                   for name in os.listdir(os.path.dirname(path))))
+
+
+class TestTaskDoorbell(TaskDbTestCase):
+
+    def _register(self, hook):
+        task_db.register_commit_hook(hook)
+        self.addCleanup(task_db.unregister_commit_hook, hook)
+
+    def _last_id(self):
+        return self.session.query(sa.func.max(task_db.Task.id)).scalar()
+
+    def test_hook_called_after_commit(self):
+        committed = []
+        self._register(committed.append)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1')
+            self._create(task_db.CREATE, resource_id='r2')
+        self.assertEqual([self._last_id()], committed)
+
+    def test_hook_not_called_on_rollback(self):
+        committed = []
+        self._register(committed.append)
+        try:
+            with self.session.begin(subtransactions=True):
+                self._create(task_db.CREATE)
+                raise ValueError()
+        except ValueError:
+            pass
+        with self.session.begin(subtransactions=True):
+            pass
+        self.assertEqual([], committed)
+
+    def _test_doorbell(self, backend, address):
+        listener = doorbell.DoorbellListener(backend, address)
+        self.addCleanup(listener.close)
+        if backend == doorbell.UNIX:
+            address = listener.address
+        else:
+            address = '%s:%d' % listener.address
+        bell = doorbell.get_doorbell(backend, address)
+        self.addCleanup(bell.close)
+        self._register(bell.ring)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE)
+        self.assertTrue(listener.wait(self._last_id(), timeout=5))
+
+    def test_udp_doorbell(self):
+        self._test_doorbell(doorbell.UDP, '127.0.0.1:0')
+
+    def test_unix_doorbell(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'doorbell.sock')
+        self._test_doorbell(doorbell.UNIX, path)
+
+    def test_tcp_doorbell(self):
+        self._test_doorbell(doorbell.TCP, '127.0.0.1:0')
+
+    def test_flush_hook_in_transaction(self):
+        flushed = []
+
+        def hook(session, task_id):
+            flushed.append(task_id)
+            self.assertTrue(session.is_active)
+            # The hook sees the tasks of the committing transaction
+            self.assertEqual(task_id, session.query(
+                sa.func.max(task_db.Task.id)).scalar())
+
+        task_db.register_flush_hook(hook)
+        self.addCleanup(task_db.unregister_flush_hook, hook)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE)
+        self.assertEqual([self._last_id()], flushed)
+
+    def test_tcp_ring_does_not_block(self):
+        connecting = threading.Event()
+        release = threading.Event()
+
+        def create_connection(address, timeout):
+            connecting.set()
+            release.wait(5)
+            raise socket.error('refused')
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'socket.create_connection', create_connection))
+        bell = doorbell.TcpDoorbell('127.0.0.1:1')
+        self.addCleanup(bell.close)
+        failed = threading.Event()
+        bell.failed = lambda ex: failed.set()
+        bell.ring(1)
+        self.assertTrue(connecting.wait(5))
+        # The committing thread is not held by the pending connection
+        bell.ring(2)
+        self.assertFalse(failed.is_set())
+        release.set()
+        self.assertTrue(failed.wait(5))
+
+    def test_failure_warning_rate_limited(self):
+        warnings = []
+        self.useFixture(fixtures.MonkeyPatch(
+            'midonet.neutron.common.doorbell.LOG.warning',
+            lambda msg, args: warnings.append(args['count'])))
+        bell = doorbell.Doorbell()
+        for _i in range(3):
+            bell.failed(socket.error())
+        self.assertEqual([1], warnings)
+        bell._warned_at -= bell.warning_interval
+        bell.failed(socket.error())
+        self.assertEqual([1, 3], warnings)
+
+
+class TestTaskShardKey(TaskDbTestCase):
+
+    def _shard_keys(self):
+        return [(t.data_type, t.type, t.shard_key) for t in
+                self.session.query(task_db.Task).order_by(task_db.Task.id)]
+
+    def test_shard_keys(self):
+        net_key = task_db.get_shard_key(task_db.NETWORK, 'n1')
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.NETWORK, 'n1', {'id': 'n1'})
+            self._create(task_db.CREATE, task_db.PORT, 'p1',
+                         {'id': 'p1', 'network_id': 'n1'})
+            self._create(task_db.CREATE, task_db.ROUTER, 'r1', {'id': 'r1'})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.DELETE, task_db.PORT, 'p1')
+        self.assertIsNotNone(net_key)
+        self.assertEqual([(task_db.NETWORK, task_db.CREATE, net_key),
+                          (task_db.PORT, task_db.CREATE, net_key),
+                          (task_db.ROUTER, task_db.CREATE, None),
+                          (task_db.PORT, task_db.DELETE, net_key)],
+                         self._shard_keys())
+
+    def test_consumer_order(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(20):
+                self._create(task_db.CREATE, task_db.NETWORK, 'n%d' % i, {})
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i,
+                             {'network_id': 'n%d' % i})
+                if i % 5 == 4:
+                    self._create(task_db.CREATE, task_db.ROUTER,
+                                 'r%d' % i, {})
+        applied = []
+        consumer = task_consumer.TaskConsumer(
+            lambda t: applied.append((t.id, t.shard_key)), workers=4)
+        last_id = consumer.consume(self.session)
+        ids = sorted(task_id for task_id, _key in applied)
+        self.assertEqual(ids[-1], last_id)
+        self.assertEqual(44, len(ids))
+        positions = dict((task_id, i) for i, (task_id, _k) in
+                         enumerate(applied))
+        for task_id, key in applied:
+            for other_id, other_key in applied:
+                if other_id < task_id and (key is None or other_key is None
+                                           or key == other_key):
+                    self.assertLess(positions[other_id], positions[task_id])
+
+
+class TestTaskCommitOrder(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskCommitOrder, self).setUp()
+        self._override(task_commit_order=True)
+
+    def _batches(self):
+        return [(t.resource_id, t.commit_batch) for t in
+                self.session.query(task_db.Task).order_by(task_db.Task.id)]
+
+    def test_commit_batches(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1')
+            self._create(task_db.CREATE, resource_id='r2')
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r3')
+        self.assertEqual([('r1', 1), ('r2', 1), ('r3', 2)], self._batches())
+        self.assertEqual(2, self.session.query(
+            task_db.TaskSequence.value).scalar())
+
+    def test_pending_changes_flushed_before_sequence_lock(self):
+        statements = []
+
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            statements.append(statement.split('(')[0].split(' SET')[0])
+
+        engine = self.session.get_bind()
+        sa.event.listen(engine, 'before_cursor_execute', before_execute)
+        self.addCleanup(sa.event.remove, engine, 'before_cursor_execute',
+                        before_execute)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE)
+            self.session.add(data_state_db.DataState(
+                updated_at=datetime.datetime.utcnow(), readonly=False))
+        self.assertLess(
+            statements.index('INSERT INTO midonet_data_state '),
+            statements.index('UPDATE midonet_task_sequence'))
+
+    def test_commit_order_disabled(self):
+        self._override(task_commit_order=False)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE)
+        self.assertEqual([('r1', None)], self._batches())
+
+
+class TestTaskTransactions(TaskDbTestCase):
+
+    def test_transaction_headers(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1', data={'v': 1})
+            self._create(task_db.CREATE, resource_id='r2', data={'v': 2})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.DELETE, resource_id='r1')
+        headers = task_db.get_task_transactions(self.session)
+        self.assertEqual([2, 1], [h.task_count for h in headers])
+        tasks = task_db.get_transaction_tasks(self.session, headers[0])
+        self.assertEqual(['r1', 'r2'], [t.resource_id for t in tasks])
+        self.assertEqual(headers[0].last_task_id, tasks[-1].id)
+        self.assertEqual(
+            headers[1:],
+            task_db.get_task_transactions(self.session, tasks[-1].id))
+
+    def test_incomplete_transaction(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1')
+            self._create(task_db.CREATE, resource_id='r2')
+        header = task_db.get_task_transactions(self.session)[0]
+        with self.session.begin(subtransactions=True):
+            self.session.query(task_db.Task).filter(
+                task_db.Task.id == header.last_task_id).delete()
+        self.assertRaises(mido_exc.TaskTransactionIncomplete,
+                          task_db.get_transaction_tasks, self.session, header)
+
+    def test_prune_headers(self):
+        for i in range(3):
+            with self.session.begin(subtransactions=True):
+                self._create(task_db.CREATE, resource_id='r%d' % i)
+        headers = task_db.get_task_transactions(self.session)
+        self._set_last_processed(headers[1].last_task_id)
+        self.assertEqual(1, task_db.prune_tasks(self.session))
+        self.assertEqual([h.id for h in headers[1:]],
+                         [h.id for h in task_db.get_task_transactions(
+                             self.session)])
+
+
+class TestTaskDataProjection(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskDataProjection, self).setUp()
+        self._override(task_data_projection=True)
+
+    def _stored(self):
+        return jsonutils.loads(self.session.query(task_db.Task.data).one()[0])
+
+    def test_projected_keys(self):
+        unused = set(['created_at', 'updated_at', 'revision_number'])
+        self.assertEqual(
+            dict((data_type, unused) for data_type in (
+                task_db.NETWORK, task_db.SUBNET, task_db.PORT,
+                task_db.ROUTER, task_db.FLOATING_IP, task_db.SECURITY_GROUP,
+                task_db.SECURITY_GROUP_RULE, task_db.POOL, task_db.VIP,
+                task_db.HEALTH_MONITOR, task_db.MEMBER)),
+            dict((data_type, projection.exclude) for data_type, projection
+                 in task_db.TASK_DATA_PROJECTIONS.items()))
+        self.assertEqual(
+            {'security_group_rules': task_db.SECURITY_GROUP_RULE},
+            task_db.TASK_DATA_PROJECTIONS[task_db.SECURITY_GROUP].nested)
+
+    def test_unused_keys_removed(self):
+        port = {'id': 'p1', 'network_id': 'n1', 'created_at': 'now',
+                'revision_number': 2, 'description': 'd',
+                'binding:vif_type': 'midonet', 'binding:host_id': 'h1',
+                'dns_assignment': []}
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.PORT, 'p1', port)
+        self.assertEqual({'id': 'p1', 'network_id': 'n1', 'description': 'd',
+                          'binding:vif_type': 'midonet',
+                          'binding:host_id': 'h1', 'dns_assignment': []},
+                         self._stored())
+        self.assertIn('created_at', port)
+
+    def test_nested_resources(self):
+        sg = {'id': 'sg1', 'updated_at': 'now',
+              'security_group_rules': [{'id': 'r1', 'created_at': 'now'}]}
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.SECURITY_GROUP, 'sg1', sg)
+        self.assertEqual({'id': 'sg1', 'security_group_rules': [{'id': 'r1'}]},
+                         self._stored())
+
+    def test_passthrough_by_default(self):
+        cfg.CONF.clear_override('task_data_projection', 'MIDONET')
+        port = {'id': 'p1', 'created_at': 'now'}
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.PORT, 'p1', port)
+        self.assertEqual(port, self._stored())
+
+
+class TestTaskPayloadDedup(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskPayloadDedup, self).setUp()
+        self._override(task_payload_dedup=True)
+
+    def _payloads(self):
+        return dict(self.session.query(task_db.TaskPayload.hash,
+                                       task_db.TaskPayload.refcount))
+
+    def test_identical_payloads_shared(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1', data={'v': 1})
+            self._create(task_db.CREATE, resource_id='r2', data={'v': 1})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r3', data={'v': 1})
+            self._create(task_db.UPDATE, resource_id='r2', data={'v': 2})
+        tasks = self.session.query(task_db.Task).order_by(task_db.Task.id)
+        self.assertEqual([None] * 4, [t.data for t in tasks])
+        self.assertEqual([{'v': 1}, {'v': 1}, {'v': 1}, {'v': 2}],
+                         [task_db.decode_task_data(
+                             *task_db.get_task_data(self.session, t))
+                          for t in tasks])
+        self.assertEqual([1, 3], sorted(self._payloads().values()))
+        self.assertEqual(
+            {'r1': {'v': 1}, 'r2': {'v': 2}, 'r3': {'v': 1}},
+            dict((r, jsonutils.loads(d)) for r, d in
+                 task_db.get_current_task_data(
+                     self.session)[task_db.PORT].items()))
+
+    def test_payloads_released_by_pruning(self):
+        for i, v in enumerate((1, 1, 2)):
+            with self.session.begin(subtransactions=True):
+                self._create(task_db.CREATE, resource_id='r%d' % i,
+                             data={'v': v})
+        ids = self._task_ids()
+        self._set_last_processed(ids[1])
+        self.assertEqual(1, task_db.prune_tasks(self.session))
+        self.assertEqual([1, 1], sorted(self._payloads().values()))
+        task_db.task_clean(self.session)
+        self.assertEqual([1], list(self._payloads().values()))
+
+    def test_payload_inserted_concurrently(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1', data={'v': 1})
+        existing_payloads = task_db._existing_payloads
+        calls = []
+
+        def fake(session, hashes):
+            # Miss the first time, as if inserted by a concurrent
+            # transaction just after the lookup
+            calls.append(hashes)
+            if len(calls) == 1:
+                return set()
+            return existing_payloads(session, hashes)
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'midonet.neutron.db.task_db._existing_payloads', fake))
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r2', data={'v': 1})
+            self._create(task_db.CREATE, resource_id='r3', data={'v': 2})
+        self.assertEqual(2, len(calls))
+        self.assertEqual([1, 2], sorted(self._payloads().values()))
+        self.assertEqual(['r1', 'r2', 'r3'], [
+            t.resource_id for t in self.session.query(task_db.Task).order_by(
+                task_db.Task.id)])
+
+    def test_overlapping_prunes(self):
+        for i in range(3):
+            with self.session.begin(subtransactions=True):
+                self._create(task_db.CREATE, resource_id='r%d' % i,
+                             data={'v': 1})
+        ids = self._task_ids()
+        self._set_last_processed(ids[2])
+        pruned = []
+
+        class Archive(object):
+            # Another pruner deletes the batch being archived
+            def append(archive, records):
+                if not pruned:
+                    other = context.Context('user', 'tenant').session
+                    pruned.append(task_db.prune_tasks(other))
+
+        self.assertEqual(0, task_db.prune_tasks(self.session,
+                                                archive=Archive()))
+        self.assertEqual([2], pruned)
+        self.assertEqual(ids[2:], self._task_ids())
+        # The references of the pruned tasks are released once
+        self.assertEqual([1], list(self._payloads().values()))
+        task = self.session.query(task_db.Task).one()
+        self.assertEqual({'v': 1}, task_db.decode_task_data(
+            *task_db.get_task_data(self.session, task)))
+
+
+class TestTaskNoopUpdate(TaskDbTestCase):
+
+    def test_noop_update_suppressed(self):
+        counters = metrics.get_counters()
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 1})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 2})
+        self.assertEqual([(task_db.CREATE, task_db.PORT, 'r1', {'v': 1}),
+                          (task_db.UPDATE, task_db.PORT, 'r1', {'v': 2})],
+                         self._tasks())
+        self.assertEqual(
+            counters.get('task_update_suppressed', 0) + 1,
+            metrics.get_counters()['task_update_suppressed'])
+
+    def test_noop_update_emitted_when_disabled(self):
+        self._override(task_suppress_noop_updates=False)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data={'v': 1})
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data={'v': 1})
+        self.assertEqual(2, len(self._tasks()))
+
+
+class TestTaskLanes(TaskDbTestCase):
+
+    def test_interactive_tasks_go_ahead(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(5):
+                task_db.create_task(self.ctx, task_db.CREATE,
+                                    data_type=task_db.NETWORK,
+                                    resource_id='n%d' % i, data={},
+                                    lane=task_db.LANE_BULK)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.NETWORK, 'm1', {})
+            self._create(task_db.CREATE, task_db.PORT, 'pm1',
+                         {'network_id': 'm1'})
+            self._create(task_db.CREATE, task_db.PORT, 'pn0',
+                         {'network_id': 'n0'})
+            self._create(task_db.CREATE, task_db.ROUTER, 'r1', {})
+        applied = []
+        consumer = task_consumer.LaneConsumer(
+            lambda t: applied.append(t.resource_id), bulk_batch=2)
+        self.assertEqual(4, consumer.run_once(self.session))
+        self.assertEqual(['m1', 'pm1', 'n0', 'n1'], applied)
+        last_id = consumer.consume(self.session)
+        self.assertEqual(['m1', 'pm1', 'n0', 'n1', 'pn0', 'n2', 'n3', 'n4',
+                          'r1'], applied)
+        self.assertEqual(
+            self.session.query(sa.func.max(task_db.Task.id)).scalar(),
+            last_id)
+
+    def _lanes(self):
+        return [(t.data_type, t.lane) for t in self.session.query(
+            task_db.Task).order_by(task_db.Task.id)]
+
+    def test_config_task_in_bulk_lane(self):
+        task_db.create_config_task(self.session, {'v': 1})
+        self.assertEqual([(task_db.CONFIG, task_db.LANE_BULK)],
+                         self._lanes())
+
+    def test_task_clean_creates_no_task(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.NETWORK, 'n1', {})
+        self._set_last_processed(self.session.query(
+            sa.func.max(task_db.Task.id)).scalar())
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, task_db.NETWORK, 'n2', {})
+        task_db.task_clean(self.session)
+        self.assertEqual([(task_db.NETWORK, task_db.LANE_INTERACTIVE)],
+                         self._lanes())
+
+
+class TestTaskArchive(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskArchive, self).setUp()
+        self.dir = self.useFixture(fixtures.TempDir()).path
+
+    def _records(self, first_id, last_id):
+        return [{'id': i, 'data': 'd%d' % i}
+                for i in range(first_id, last_id + 1)]
+
+    def test_prune_archives_tasks(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(5):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i,
+                             {'v': i})
+        ids = self._task_ids()
+        self._set_last_processed(ids[3])
+        archive = task_archive.TaskArchiveWriter(self.dir)
+        self.assertEqual(3, task_db.prune_tasks(self.session, batch_size=2,
+                                                archive=archive))
+        records = list(task_archive.TaskArchiveReader(self.dir).read())
+        self.assertEqual(ids[:3], [r['id'] for r in records])
+        self.assertEqual([{'v': i} for i in range(3)],
+                         [task_db.decode_task_data(r['data_format'],
+                                                   r['data'])
+                          for r in records])
+        self.assertEqual(task_db.PORT, records[0]['data_type'])
+        # Already archived tasks are skipped
+        self.assertEqual(0, archive.append(records))
+
+    def test_out_of_order_batch_not_pruned(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(5):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i,
+                             {'v': i})
+        ids = self._task_ids()
+        self._set_last_processed(ids[4])
+        archive = task_archive.TaskArchiveWriter(self.dir)
+        # A later batch archived first, as by a concurrent pruner
+        archive.append([{'id': ids[3]}])
+        self.assertRaises(mido_exc.TaskArchiveOutOfOrder,
+                          task_db.prune_tasks, self.session, batch_size=2,
+                          archive=archive)
+        self.assertEqual(ids, self._task_ids())
+        self.assertEqual([ids[3]], [r['id'] for r in
+                                    task_archive.TaskArchiveReader(
+                                        self.dir).read()])
+
+    def test_append_out_of_order(self):
+        archive = task_archive.TaskArchiveWriter(self.dir)
+        archive.append(self._records(1, 2))
+        archive.append(self._records(5, 6))
+        # Archived again: skipped
+        self.assertEqual(1, archive.append(self._records(5, 7)))
+        self.assertRaises(mido_exc.TaskArchiveOutOfOrder, archive.append,
+                          self._records(3, 4))
+        self.assertEqual([1, 2, 5, 6, 7], [
+            r['id'] for r in task_archive.TaskArchiveReader(
+                self.dir).read()])
+
+    def test_segments_rotated_and_seekable(self):
+        archive = task_archive.TaskArchiveWriter(self.dir, segment_size=200)
+        for first_id in range(1, 50, 5):
+            archive.append(self._records(first_id, first_id + 4))
+        self.assertTrue(len(task_archive.list_segments(self.dir)) > 1)
+        reader = task_archive.TaskArchiveReader(self.dir)
+        self.assertEqual(list(range(1, 51)),
+                         [r['id'] for r in reader.read()])
+        self.assertEqual(list(range(12, 34)),
+                         [r['id'] for r in reader.read(12, 33)])
+        self.assertEqual([], list(reader.read(first_id=51)))
+
+    def test_partial_block_dropped(self):
+        archive = task_archive.TaskArchiveWriter(self.dir)
+        archive.append(self._records(1, 3))
+        path = task_archive.list_segments(self.dir)[-1]
+        with open(path, 'ab') as f:
+            f.write(task_archive.BLOCK_MAGIC + b'\x00\x00')
+        reader = task_archive.TaskArchiveReader(self.dir)
+        self.assertEqual([1, 2, 3], [r['id'] for r in reader.read()])
+        archive.append(self._records(4, 5))
+        self.assertEqual([1, 2, 3, 4, 5], [r['id'] for r in reader.read()])
+
+
+class TestTaskReplay(TaskDbTestCase):
+
+    def test_replay_rewrites_uuids(self):
+        port_id = '11111111-2222-3333-4444-555555555555'
+        net_id = '66666666-7777-8888-9999-000000000000'
+        self._create(task_db.CREATE, task_db.PORT, port_id,
+                     {'id': port_id, 'network_id': net_id, 'name': 'a'})
+        self._create(task_db.UPDATE, task_db.PORT, port_id,
+                     {'id': port_id, 'network_id': net_id, 'name': 'b'})
+        replayer = task_replay.TaskReplayer(lambda: self.session, speed=0)
+        records = list(task_replay.db_records(self.session))
+        report = replayer.replay(records)
+        self.assertEqual(2, report['tasks'])
+        self.assertEqual(1, report['transactions'])
+        # Replayed in one transaction, the UPDATE is coalesced
+        self.assertEqual(3, report['backlog'])
+        tasks = self.session.query(task_db.Task).order_by(
+            task_db.Task.id).all()
+        self.assertEqual(task_db.CREATE, tasks[2].type)
+        self.assertNotEqual(port_id, tasks[2].resource_id)
+        data = jsonutils.loads(tasks[2].data)
+        self.assertEqual(tasks[2].resource_id, data['id'])
+        self.assertNotEqual(net_id, data['network_id'])
+        self.assertEqual('b', data['name'])
+        self.assertNotEqual(tasks[0].shard_key, tasks[2].shard_key)
+
+    def test_replay_pace(self):
+        records = [{'id': i, 'type': task_db.CREATE,
+                    'data_type': task_db.NETWORK, 'resource_id': 'n%d' % i,
+                    'tenant_id': 't', 'transaction_id': 'x%d' % i,
+                    'data_format': None, 'data': None,
+                    'created_at': '2015-01-01T00:00:0%d.000000' % i}
+                   for i in range(3)]
+        replayer = task_replay.TaskReplayer(lambda: self.session, speed=10)
+        report = replayer.replay(records)
+        self.assertEqual(3, report['transactions'])
+        self.assertTrue(report['elapsed'] >= 0.2)
+
+
+class TestTaskRateLimit(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(TestTaskRateLimit, self).setUp()
+        self.now = 1000.0
+        self.limiter = rate_limit.TenantRateLimiter(
+            rate=2, burst=3, clock=lambda: self.now)
+
+    def test_burst_then_rate(self):
+        self.assertEqual([0, 0, 0], [self.limiter.consume('t1')
+                                     for _i in range(3)])
+        self.assertEqual(0.5, self.limiter.consume('t1'))
+        # Other tenants are not affected
+        self.assertEqual(0, self.limiter.consume('t2'))
+        self.now += 0.5
+        self.assertEqual(0, self.limiter.consume('t1'))
+        self.assertEqual(
+            [('task_tenant_emitted', {'tenant_id': 't1'}, 4),
+             ('task_tenant_emitted', {'tenant_id': 't2'}, 1),
+             ('task_tenant_limited', {'tenant_id': 't1'}, 1)],
+            self.limiter.metrics())
+
+    def test_bulk_larger_than_burst(self):
+        self.assertEqual(0, self.limiter.consume('t1', 10))
+        self.assertEqual(1.5, self.limiter.consume('t1', 10))
+
+    def test_full_buckets_swept(self):
+        self.limiter.consume('t1')
+        self.now += 10
+        self.limiter.consume('t2')
+        self.assertEqual(['t2'], list(self.limiter._buckets))
+
+    def test_disabled(self):
+        limiter = rate_limit.TenantRateLimiter(rate=0, burst=1)
+        self.assertEqual(0, limiter.consume('t1', 100))
+        self.assertEqual(100, limiter.emitted['t1'])
+
+    def test_idle_tenants_evicted(self):
+        limiter = rate_limit.TenantRateLimiter(
+            rate=0, burst=1, clock=lambda: self.now, idle_time=60)
+        limiter.consume('t1')
+        self.now += 30
+        limiter.consume('t2')
+        self.now += 40
+        limiter.consume('t2')
+        self.assertEqual([('task_tenant_emitted', {'tenant_id': 't2'}, 2)],
+                         limiter.metrics())
+        self.assertEqual(['t2'], list(limiter._last_seen))
+
+    def test_exception_retry_after(self):
+        ex = mido_exc.TaskRateLimitExceeded(tenant_id='t1', retry_after=3)
+        self.assertEqual(3, ex.retry_after)
+        self.assertIn('retry after 3 seconds', str(ex))
+
+
+class TestTaskProgress(TaskDbTestCase):
+
+    def _progress(self):
+        return dict(self.session.query(
+            data_state_db.TaskProgress.consumer_id,
+            data_state_db.TaskProgress.last_processed_task_id))
+
+    def test_recorder_debounced(self):
+        now = [0.0]
+        recorder = data_state_db.ProgressRecorder(
+            self.session, 'c1', interval=1, max_tasks=3,
+            clock=lambda: now[0])
+        recorder.record(1)
+        recorder.record(2)
+        self.assertEqual({}, self._progress())
+        recorder.record(3)
+        self.assertEqual({'c1': 3}, self._progress())
+        recorder.record(4)
+        now[0] += 1
+        recorder.record(5)
+        self.assertEqual({'c1': 5}, self._progress())
+        recorder.record(6)
+        recorder.flush()
+        self.assertEqual({'c1': 6}, self._progress())
+
+    def test_slowest_consumer_holds_pruning(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(6):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i, {})
+        ids = self._task_ids()
+        self.assertIsNone(
+            data_state_db.get_last_processed_task_id(self.session))
+        consumer = task_consumer.TaskConsumer(
+            lambda task: None, progress=data_state_db.ProgressRecorder(
+                self.session, 'c1'))
+        self.assertEqual(ids[-1], consumer.consume(self.session))
+        data_state_db.set_progress(self.session, 'c2', ids[2])
+        self.assertEqual({'c1': ids[-1], 'c2': ids[2]}, self._progress())
+        self.assertEqual(
+            ids[2], data_state_db.get_last_processed_task_id(self.session))
+        self.assertEqual(2, task_db.prune_tasks(self.session))
+        data_state_db.delete_progress(self.session, 'c2')
+        self.assertEqual(
+            ids[-1], data_state_db.get_last_processed_task_id(self.session))
+        self.assertEqual(4, task_db.task_clean(self.session))
+        self.assertEqual({'c1': None}, self._progress())
+
+    def test_data_state_holds_pruning(self):
+        with self.session.begin(subtransactions=True):
+            for i in range(4):
+                self._create(task_db.CREATE, task_db.PORT, 'p%d' % i, {})
+        ids = self._task_ids()
+        # The cluster recording its position in the data state only
+        self._set_last_processed(ids[1])
+        self.assertEqual(
+            ids[1], data_state_db.get_last_processed_task_id(self.session))
+        # A consumer ahead of the cluster does not release its tasks
+        data_state_db.set_progress(self.session, 'c1', ids[3])
+        self.assertEqual(
+            ids[1], data_state_db.get_last_processed_task_id(self.session))
+        self.assertEqual(ids[1], self.session.query(
+            data_state_db.DataState.last_processed_task_id).scalar())
+        self.assertEqual(1, task_db.prune_tasks(self.session))
+        self.assertEqual(ids[1:], self._task_ids())
+        # Nor does a consumer that processed no task yet
+        data_state_db.set_progress(self.session, 'c2', None)
+        self.assertEqual(
+            ids[1], data_state_db.get_last_processed_task_id(self.session))
+        # The lowest position holds the pruning, wherever it is recorded
+        with self.session.begin(subtransactions=True):
+            self.session.query(data_state_db.DataState).update(
+                {'last_processed_task_id': ids[3]})
+        data_state_db.set_progress(self.session, 'c1', ids[2])
+        self.assertEqual(
+            ids[2], data_state_db.get_last_processed_task_id(self.session))
+        self.assertEqual(1, task_db.prune_tasks(self.session))
+        self.assertEqual(ids[2:], self._task_ids())
+
+
+class TestTaskConfig(TaskDbTestCase):
+
+    def _config_tasks(self):
+        return [jsonutils.loads(t.data)['v'] for t in self.session.query(
+            task_db.Task).filter(task_db.Task.data_type == task_db.CONFIG)]
+
+    def test_unchanged_config_not_emitted(self):
+        self.assertTrue(task_db.create_config_task(self.session, {'v': 1}))
+        self.assertFalse(task_db.create_config_task(self.session, {'v': 1}))
+        self.assertTrue(task_db.create_config_task(self.session, {'v': 2}))
+        self.assertFalse(task_db.create_config_task(self.session, {'v': 2}))
+        self.assertEqual([1, 2], self._config_tasks())
+
+    def test_unchanged_config_other_format(self):
+        task_db.create_config_task(self.session, {'v': 1, 'l': ['a']})
+        self._override(task_data_format=task_db.ZLIB_FORMAT)
+        self.assertFalse(task_db.create_config_task(
+            self.session, {'v': 1, 'l': ('a',)}))
+
+
+class TestTaskDependencies(TaskDbTestCase):
+
+    def _create(self, type, data_type=task_db.PORT, resource_id='r1',
+                data=None):
+        task_db.create_task(
+            self.ctx, type, data_type=data_type, resource_id=resource_id,
+            data=data, depends_on=task_db.get_task_dependencies(
+                type, data_type, data))
+
+    def test_get_dependencies(self):
+        port = {'id': 'p1', 'network_id': 'n1',
+                'fixed_ips': [{'subnet_id': 's2'}, {'subnet_id': 's1'}],
+                'security_groups': ['sg1']}
+        self.assertEqual(['n1', 's1', 's2', 'sg1'],
+                         task_db.get_task_dependencies(
+                             task_db.CREATE, task_db.PORT, port))
+        self.assertEqual(['p1', 'r1', 'x1'], task_db.get_task_dependencies(
+            task_db.UPDATE, task_db.FLOATING_IP,
+            {'floating_network_id': 'x1', 'router_id': 'r1',
+             'port_id': 'p1'}))
+        self.assertEqual([], task_db.get_task_dependencies(
+            task_db.CREATE, task_db.NETWORK, {'id': 'n1'}))
+        self.assertIsNone(task_db.get_task_dependencies(
+            task_db.CREATE, task_db.CONFIG, {}))
+
+    def test_router_port_depends_on_router(self):
+        self.assertEqual(['n1', 'r1'], task_db.get_task_dependencies(
+            task_db.CREATE, task_db.PORT,
+            {'id': 'p1', 'network_id': 'n1', 'device_id': 'r1',
+             'device_owner': 'network:router_interface'}))
+
+    def test_coalesced_dependencies(self):
+        port = {'id': 'p1', 'security_groups': ['sg1']}
+        with self.session.begin(subtransactions=True):
+            for type, data, lane in (
+                    (task_db.CREATE, port, task_db.LANE_BULK),
+                    (task_db.UPDATE, dict(port, network_id='n1',
+                                          security_groups=[]),
+                     task_db.LANE_INTERACTIVE),
+                    (task_db.UPDATE, dict(port, network_id='n1',
+                                          device_id='r1'),
+                     task_db.LANE_BULK)):
+                task_db.create_task(
+                    self.ctx, type, data_type=task_db.PORT,
+                    resource_id='p1', data=data, lane=lane,
+                    depends_on=task_db.get_task_dependencies(
+                        type, task_db.PORT, data))
+        task = self.session.query(task_db.Task).one()
+        self.assertEqual(task_db.CREATE, task.type)
+        self.assertEqual(['n1', 'r1', 'sg1'],
+                         task_db.task_dependencies(task))
+        self.assertEqual(task_db.LANE_INTERACTIVE, task.lane)
+        self.assertEqual(task_db.get_shard_key(task_db.PORT, 'p1',
+                                               {'network_id': 'n1'}),
+                         task.shard_key)
+
+    def test_coalesced_unknown_dependencies(self):
+        with self.session.begin(subtransactions=True):
+            task_db.create_task(self.ctx, task_db.UPDATE,
+                                data_type=task_db.PORT, resource_id='p1',
+                                data={'id': 'p1', 'network_id': 'n1'})
+            self._create(task_db.UPDATE, task_db.PORT, 'p1',
+                         {'id': 'p1', 'network_id': 'n1'})
+        task = self.session.query(task_db.Task).one()
+        self.assertIsNone(task_db.task_dependencies(task))
+
+    def test_delete_inherits_dependencies(self):
+        self._create(task_db.CREATE, task_db.PORT, 'p1',
+                     {'id': 'p1', 'network_id': 'n1'})
+        self._create(task_db.DELETE, task_db.PORT, 'p1')
+        self._create(task_db.DELETE, task_db.NETWORK, 'n1')
+        tasks = self.session.query(task_db.Task).order_by(
+            task_db.Task.id).all()
+        self.assertEqual([['n1'], ['n1'], []],
+                         [task_db.task_dependencies(t) for t in tasks])
+
+    def test_dependency_levels(self):
+        self._create(task_db.CREATE, task_db.NETWORK, 'n1', {'id': 'n1'})
+        self._create(task_db.CREATE, task_db.NETWORK, 'n2', {'id': 'n2'})
+        for port_id, net_id in (('p1', 'n1'), ('p2', 'n1'), ('p3', 'n2')):
+            self._create(task_db.CREATE, task_db.PORT, port_id,
+                         {'id': port_id, 'network_id': net_id})
+        self._create(task_db.UPDATE, task_db.NETWORK, 'n1',
+                     {'id': 'n1', 'name': 'a'})
+        task_db.create_config_task(self.session, {'v': 1})
+        self._create(task_db.DELETE, task_db.PORT, 'p3')
+        tasks = self.session.query(task_db.Task).order_by(
+            task_db.Task.id).all()
+        levels = task_consumer.dependency_levels(tasks)
+        self.assertEqual([['n1', 'n2'], ['p1', 'p2', 'p3'], ['n1'],
+                          [task_db.CONF_ID], ['p3']],
+                         [[t.resource_id for t in level]
+                          for level in levels])
+        self.assertEqual({'tasks': 8, 'levels': 5, 'max_parallelism': 3,
+                          'mean_parallelism': 1.6},
+                         task_consumer.dependency_parallelism(tasks))
+
+
+class TestTaskPayloadOverflow(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskPayloadOverflow, self).setUp()
+        self._override(task_payload_overflow_size=100)
+        self.big = {'routes': ['10.0.%d.0/24' % i for i in range(20)]}
+
+    def _payloads(self):
+        return dict(self.session.query(task_db.TaskPayload.hash,
+                                       task_db.TaskPayload.refcount))
+
+    def test_large_payloads_stored_apart(self):
+        counters = metrics.get_counters()
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r1', data={'v': 1})
+            self._create(task_db.CREATE, resource_id='r2', data=self.big)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, resource_id='r3', data=self.big)
+        rows = self.session.query(task_db.Task.data,
+                                  task_db.Task.payload_hash).order_by(
+            task_db.Task.id).all()
+        self.assertIsNotNone(rows[0][0])
+        self.assertIsNone(rows[0][1])
+        self.assertEqual([(None, rows[1][1])] * 2, rows[1:])
+        self.assertEqual({rows[1][1]: 2}, self._payloads())
+        self.assertEqual(
+            counters.get('task_payload_overflow', 0) + 2,
+            metrics.get_counters()['task_payload_overflow'])
+
+        self.session.expunge_all()
+        self.assertEqual([{'v': 1}, self.big, self.big],
+                         [jsonutils.loads(t.data)
+                          for t in task_db.get_tasks(self.session)])
+        self.assertEqual(
+            self.big,
+            jsonutils.loads(task_db.get_current_task_data(
+                self.session)[task_db.PORT]['r2']))
+        header = task_db.get_task_transactions(self.session)[0]
+        self.assertEqual(
+            [{'v': 1}, self.big],
+            [jsonutils.loads(t.data)
+             for t in task_db.get_transaction_tasks(self.session, header)])
+        # The loaded data is not written back to the task rows
+        self.session.flush()
+        self.assertIsNone(self.session.query(task_db.Task.data).filter(
+            task_db.Task.resource_id == 'r2').scalar())
+
+    def test_overflow_disabled(self):
+        self._override(task_payload_overflow_size=0)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data=self.big)
+        self.assertEqual([(task_db.CREATE, task_db.PORT, 'r1', self.big)],
+                         self._tasks())
+        self.assertEqual({}, self._payloads())
+
+    def test_lane_consumer_reads_overflow(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data=self.big)
+        self.session.expunge_all()
+        applied = []
+        task_consumer.LaneConsumer(
+            lambda t: applied.append(jsonutils.loads(t.data))).consume(
+            self.session)
+        self.assertEqual([self.big], applied)
+
+
+class _FakeLoopingCall(object):
+
+    started = []
+
+    def __init__(self, func):
+        self.func = func
+
+    def start(self, interval):
+        self.started.append((self.func, interval))
+
+    def stop(self):
+        pass
+
+
+class TestTaskJobs(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskJobs, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'oslo_service.loopingcall.FixedIntervalLoopingCall',
+            _FakeLoopingCall))
+        self.addCleanup(task_jobs.stop_jobs)
+        _FakeLoopingCall.started = []
+        self.runs = []
+
+    def _job(self):
+        return task_jobs.TaskJob('prune', lambda: self.runs.append(1), 10,
+                                 session_maker=lambda: self.session)
+
+    def _as_process(self, holder):
+        self.useFixture(fixtures.MonkeyPatch(
+            'midonet.neutron.db.task_jobs.process_id', lambda: holder))
+
+    def test_job_started_once_per_process(self):
+        job = task_jobs.start_job('prune', self.runs.append, 10)
+        # e.g. by both the core plugin and the ML2 driver
+        self.assertIs(job, task_jobs.start_job('prune', self.runs.append,
+                                               10))
+        task_jobs.start_job('metrics', self.runs.append, 5)
+        self.assertEqual([(job.run_once, 10)],
+                         [s for s in _FakeLoopingCall.started
+                          if s[0] == job.run_once])
+        self.assertEqual(2, len(_FakeLoopingCall.started))
+
+    def test_job_run_by_one_process(self):
+        first, second = self._job(), self._job()
+        self._as_process('host1:1')
+        self.assertTrue(first.run_once())
+        self._as_process('host2:1')
+        self.assertFalse(second.run_once())
+        self._as_process('host1:1')
+        self.assertTrue(first.run_once())
+        self.assertEqual([1, 1], self.runs)
+
+    def test_job_taken_over_when_lease_expires(self):
+        first, second = self._job(), self._job()
+        self._as_process('host1:1')
+        self.assertTrue(first.run_once())
+        with self.session.begin():
+            self.session.query(task_db.TaskLease).update(
+                {'expires_at': datetime.datetime.utcnow() -
+                 datetime.timedelta(seconds=1)})
+        self._as_process('host2:1')
+        self.assertTrue(second.run_once())
+        self._as_process('host1:1')
+        self.assertFalse(first.run_once())
+        self.assertEqual('host2:1', self.session.query(
+            task_db.TaskLease.holder).scalar())
+
+    def test_lease_renewed_during_run(self):
+        renewed = []
+
+        def run():
+            renewed.append(job.renew())
+            # Taken over by another process, e.g. after a run longer than
+            # the lease
+            with self.session.begin():
+                self.session.query(task_db.TaskLease).update(
+                    {'holder': 'host2:1'})
+            renewed.append(job.renew())
+
+        job = task_jobs.TaskJob('prune', run, 10,
+                                session_maker=lambda: self.session)
+        self._as_process('host1:1')
+        self.assertTrue(job.run_once())
+        self.assertEqual([True, False], renewed)
+
+    def test_unleased_job_always_renewed(self):
+        job = task_jobs.TaskJob('counters', None, 10, leased=False)
+        self.assertTrue(job.renew())
+        self.assertEqual(0, self.session.query(task_db.TaskLease).count())
+
+
+class TestTaskDataFormat(TaskDbTestCase):
+
+    def _test_format(self, data_format):
+        self._override(task_data_format=data_format)
+        data = {'id': 'r1', 'name': 'port' * 100, 'fixed_ips': [{'a': 1}]}
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data=data)
+        task = self.session.query(task_db.Task).one()
+        self.assertEqual(data, task_db.decode_task_data(task.data_format,
+                                                        task.data))
+        self.assertEqual(
+            {task_db.PORT: {'r1': data}},
+            dict((k, dict((r, jsonutils.loads(d)) for r, d in v.items()))
+                 for k, v in task_db.get_current_task_data(
+                     self.session).items()))
+        return task
+
+    def test_json_format(self):
+        task = self._test_format(task_db.JSON_FORMAT)
+        self.assertIsNone(task.data_format)
+
+    def test_zlib_format(self):
+        task = self._test_format(task_db.ZLIB_FORMAT)
+        self.assertEqual(task_db.ZLIB_FORMAT, task.data_format)
+        self.assertLess(len(task.data), 400)
+
+    def test_msgpack_format(self):
+        task = self._test_format(task_db.MSGPACK_FORMAT)
+        self.assertEqual(task_db.MSGPACK_FORMAT, task.data_format)
+
+
+class _FakeUjson(object):
+
+    def dumps(self, data, escape_forward_slashes=True):
+        if not isinstance(data, dict):
+            raise TypeError(data)
+        return 'fast'
+
+
+class TestTaskSerializer(testlib_api.SqlTestCase):
+
+    def test_compact_json(self):
+        when = datetime.datetime(2015, 1, 2, 3, 4, 5)
+        serializer = task_db.get_serializer('json')
+        text = serializer.dumps({'a': [1, 'b'], 't': when})
+        self.assertEqual('{"a":[1,"b"],"t":"2015-01-02T03:04:05.000000"}',
+                         text)
+        self.assertEqual([1, 'b'], serializer.loads(text)['a'])
+
+    def test_ujson_falls_back_on_other_types(self):
+        serializer = task_db.UjsonSerializer(_FakeUjson())
+        self.assertEqual('fast', serializer.dumps({'a': 1}))
+        self.assertEqual('[1,2]', serializer.dumps((1, 2)))
+
+    def test_unknown_serializer(self):
+        self.assertRaises(n_exc.InvalidConfigurationOption,
+                          task_db.get_serializer, 'no_such_json_module')
+
+
+class TestTaskDelta(TaskDbTestCase):
+
+    def setUp(self):
+        super(TestTaskDelta, self).setUp()
+        self._override(task_update_delta=True, task_delta_full_interval=2)
+        self.data = {'id': 'r1', 'name': 'port', 'device_id': 'x' * 200,
+                     'admin_state_up': True}
+
+    def _update(self, **changes):
+        self.data = dict(self.data, **changes)
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.UPDATE, data=self.data)
+        return self.session.query(task_db.Task).order_by(
+            task_db.Task.id.desc()).first()
+
+    def test_delta_round_trip(self):
+        old = {'a': 1, 'b': 2, 'c': 3}
+        new = {'a': 1, 'b': 4, 'd': 5}
+        delta = task_db.make_delta(old, new)
+        self.assertEqual({'set': {'b': 4, 'd': 5}, 'unset': ['c']}, delta)
+        self.assertEqual(new, task_db.apply_delta(old, delta))
+
+    def test_update_stored_as_delta(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data=self.data)
+        base = self.session.query(task_db.Task).one()
+        task = self._update(name='renamed')
+        self.assertEqual(base.id, task.base_task_id)
+        self.assertEqual({'set': {'name': 'renamed'}, 'unset': []},
+                         jsonutils.loads(task.data))
+        self.assertEqual(
+            self.data, jsonutils.loads(task_db.get_current_task_data(
+                self.session)[task_db.PORT]['r1']))
+
+    def test_full_data_stored_periodically(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data=self.data)
+        self.assertIsNotNone(self._update(name='a').base_task_id)
+        self.assertIsNotNone(self._update(name='b').base_task_id)
+        task = self._update(name='c')
+        self.assertIsNone(task.base_task_id)
+        self.assertEqual(self.data, jsonutils.loads(task.data))
+        self.assertIsNotNone(self._update(name='d').base_task_id)
+
+    def test_full_data_stored_for_large_delta(self):
+        with self.session.begin(subtransactions=True):
+            self._create(task_db.CREATE, data=self.data)
+        task = self._update(device_id='y' * 200)
+        self.assertIsNone(task.base_task_id)
@@ -0,0 +1,194 @@
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Helpers shared by the task pipeline benchmarks."""
+
+from __future__ import print_function
+
+import datetime
+import random
+import time
+import uuid
+
+from midonet.neutron.db import task_db
+
+
+DATA_TYPES = [(task_db.PORT, 60), (task_db.NETWORK, 8), (task_db.SUBNET, 8),
+              (task_db.SECURITY_GROUP_RULE, 12), (task_db.ROUTER, 4),
+              (task_db.FLOATING_IP, 6), (task_db.SECURITY_GROUP, 2)]
+
+
+def best_of(fn, repeat=3):
+    """Run fn repeat times and return the best wall clock time in seconds."""
+    best = None
+    for _i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def weighted_choice(rand, choices):
+    total = sum(w for _c, w in choices)
+    r = rand.uniform(0, total)
+    for choice, weight in choices:
+        r -= weight
+        if r <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def generate_task_rows(count, resources=None, tenants=1000, seed=0,
+                       data=None):
+    """Generate dicts of midonet_tasks columns that look like production.
+
+    Each resource gets a CREATE, a few UPDATEs and in most cases a DELETE,
+    transactions carry one to three tasks, and creation times span 30
+    days.
+    """
+    rand = random.Random(seed)
+    resources = resources or max(count // 5, 1)
+    tenant_ids = [str(uuid.UUID(int=rand.getrandbits(128)))
+                  for _i in range(tenants)]
+    live = []
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    step = datetime.timedelta(days=30) / max(count, 1)
+    tx_id = None
+    tx_left = 0
+    created = 0
+    for i in range(count):
+        if tx_left == 0:
+            tx_id = str(uuid.UUID(int=rand.getrandbits(128)))
+            tx_left = rand.randint(1, 3)
+        tx_left -= 1
+        if live and (created >= resources or rand.random() < 0.6):
+            idx = rand.randrange(len(live))
+            data_type, resource_id, tenant_id = live[idx]
+            if rand.random() < 0.25:
+                task_type = task_db.DELETE
+                live[idx] = live[-1]
+                live.pop()
+            else:
+                task_type = task_db.UPDATE
+        else:
+            data_type = weighted_choice(rand, DATA_TYPES)
+            resource_id = str(uuid.UUID(int=rand.getrandbits(128)))
+            tenant_id = rand.choice(tenant_ids)
+            task_type = task_db.CREATE
+            live.append((data_type, resource_id, tenant_id))
+            created += 1
+        yield {'type': task_type,
+               'data_type': data_type,
+               'resource_id': resource_id,
+               'tenant_id': tenant_id,
+               'transaction_id': tx_id,
+               'created_at': start + step * i,
+               'data': (None if task_type == task_db.DELETE else
+                        data or '{"id": "%s"}' % resource_id)}
+
+
+def _uuid(rand):
+    return str(uuid.UUID(int=rand.getrandbits(128)))
+
+
+def _mac(rand):
+    return 'fa:16:3e:%02x:%02x:%02x' % tuple(rand.randrange(256)
+                                             for _i in range(3))
+
+
+def _ip(rand, prefix='10.0'):
+    return '%s.%d.%d' % (prefix, rand.randrange(256), rand.randrange(1, 255))
+
+
+def network_payload(rand):
+    return {'id': _uuid(rand), 'tenant_id': _uuid(rand).replace('-', ''),
+            'name': 'net-%d' % rand.randrange(10000), 'admin_state_up': True,
+            'status': 'ACTIVE', 'shared': False, 'router:external': False,
+            'subnets': [_uuid(rand) for _i in range(2)], 'mtu': 0,
+            'port_security_enabled': True, 'provider:network_type': None,
+            'description': '', 'created_at': '2015-09-17T05:22:48',
+            'updated_at': '2015-09-17T05:22:48'}
+
+
+def port_payload(rand, address_pairs=0, dhcp_opts=0):
+    return {'id': _uuid(rand), 'tenant_id': _uuid(rand).replace('-', ''),
+            'network_id': _uuid(rand), 'name': '', 'admin_state_up': True,
+            'status': 'ACTIVE', 'mac_address': _mac(rand),
+            'device_id': _uuid(rand), 'device_owner': 'compute:nova',
+            'fixed_ips': [{'subnet_id': _uuid(rand),
+                           'ip_address': _ip(rand)}],
+            'security_groups': [_uuid(rand)],
+            'allowed_address_pairs': [
+                {'ip_address': _ip(rand, '192.168'),
+                 'mac_address': _mac(rand)} for _i in range(address_pairs)],
+            'extra_dhcp_opts': [
+                {'opt_name': 'opt-%d' % i, 'opt_value': _ip(rand),
+                 'ip_version': 4} for i in range(dhcp_opts)],
+            'port_security_enabled': True,
+            'binding:host_id': 'compute-%d' % rand.randrange(100),
+            'binding:profile': {'interface_name': 'tap' + _uuid(rand)[:11]},
+            'binding:vif_type': 'midonet',
+            'binding:vif_details': {'port_filter': True},
+            'binding:vnic_type': 'normal', 'description': '',
+            'created_at': '2015-09-17T05:22:48',
+            'updated_at': '2015-09-17T05:22:48'}
+
+
+def router_payload(rand, routes=0):
+    return {'id': _uuid(rand), 'tenant_id': _uuid(rand).replace('-', ''),
+            'name': 'router-%d' % rand.randrange(10000),
+            'admin_state_up': True, 'status': 'ACTIVE',
+            'external_gateway_info': {
+                'network_id': _uuid(rand), 'enable_snat': True,
+                'external_fixed_ips': [{'subnet_id': _uuid(rand),
+                                        'ip_address': _ip(rand, '172.16')}]},
+            'routes': [{'destination': '%s/24' % _ip(rand, '10.%d' % i),
+                        'nexthop': _ip(rand)} for i in range(routes)],
+            'gw_port_id': _uuid(rand), 'description': ''}
+
+
+def security_group_payload(rand, rules=0):
+    sg_id = _uuid(rand)
+    tenant_id = _uuid(rand).replace('-', '')
+    return {'id': sg_id, 'tenant_id': tenant_id, 'name': 'default',
+            'description': 'Default security group',
+            'security_group_rules': [
+                {'id': _uuid(rand), 'tenant_id': tenant_id,
+                 'security_group_id': sg_id, 'direction': 'ingress',
+                 'ethertype': 'IPv4', 'protocol': 'tcp',
+                 'port_range_min': 1000 + i, 'port_range_max': 1000 + i,
+                 'remote_ip_prefix': '%s/32' % _ip(rand),
+                 'remote_group_id': None} for i in range(rules)]}
+
+
+def sample_payloads(seed=0):
+    """Representative task payloads, from typical to very large ones."""
+    rand = random.Random(seed)
+    return [('network', network_payload(rand)),
+            ('port', port_payload(rand)),
+            ('port, 20 pairs + 10 opts', port_payload(rand, 20, 10)),
+            ('router', router_payload(rand)),
+            ('router, 500 routes', router_payload(rand, 500)),
+            ('security group, 50 rules', security_group_payload(rand, 50))]
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(x)) for x in col) for col in zip(headers, *rows)]
+    fmt = '  '.join('%%-%ds' % w for w in widths)
+    print(fmt % tuple(headers))
+    for row in rows:
+        print(fmt % tuple(row))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Size and throughput of the task data codecs on realistic payloads.
+
+    python tools/benchmarks/task_codecs.py [--iterations N]
+"""
+
+from __future__ import print_function
+
+import argparse
+
+import bench_util
+from midonet.neutron.db import task_db
+
+
+FORMATS = [task_db.JSON_FORMAT, task_db.ZLIB_FORMAT, task_db.MSGPACK_FORMAT]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = []
+    for name, payload in bench_util.sample_payloads():
+        json_size = None
+        for data_format in FORMATS:
+            codec = task_db.get_codec(data_format)
+            text = codec.encode(payload)
+            json_size = json_size or len(text)
+
+            def encode():
+                for _i in range(args.iterations):
+                    codec.encode(payload)
+
+            def decode():
+                for _i in range(args.iterations):
+                    codec.decode(text)
+
+            enc = bench_util.best_of(encode)
+            dec = bench_util.best_of(decode)
+            rows.append((name, data_format, len(text),
+                         '%.2f' % (float(len(text)) / json_size),
+                         '%.0f' % (args.iterations / enc),
+                         '%.0f' % (args.iterations / dec)))
+    bench_util.print_table(['payload', 'format', 'bytes', 'ratio',
+                            'encode/s', 'decode/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Safe parallelism of the task workload with shard keys and dependencies.
+
+Tenants building and tearing down topologies, networks with subnets,
+security groups and rules, routers, ports and floating IPs, produce a
+workload whose tasks are interleaved.  The tasks are grouped in levels of
+independent tasks by window, either with the shard keys or with the
+recorded dependencies, and the number of levels and tasks per level are
+compared.
+
+    python tools/benchmarks/task_dependencies.py --tenants 50
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import uuid
+
+from oslo_serialization import jsonutils
+
+import bench_util
+from midonet.neutron.db import task_consumer
+from midonet.neutron.db import task_db
+
+
+def _uuid(rand):
+    return str(uuid.UUID(int=rand.getrandbits(128)))
+
+
+def tenant_workload(rand, ext_net_id, ports):
+    """Generate the (type, data_type, data) of the changes of a tenant."""
+    net = {'id': _uuid(rand)}
+    subnet = {'id': _uuid(rand), 'network_id': net['id']}
+    sg = {'id': _uuid(rand)}
+    rules = [{'id': _uuid(rand), 'security_group_id': sg['id'],
+              'remote_group_id': sg['id'] if i == 0 else None}
+             for i in range(4)]
+    router = {'id': _uuid(rand),
+              'external_gateway_info': {'network_id': ext_net_id}}
+    changes = [(task_db.CREATE, task_db.NETWORK, net),
+               (task_db.CREATE, task_db.SUBNET, subnet),
+               (task_db.CREATE, task_db.SECURITY_GROUP, sg)]
+    changes += [(task_db.CREATE, task_db.SECURITY_GROUP_RULE, rule)
+                for rule in rules]
+    changes.append((task_db.CREATE, task_db.ROUTER, router))
+    fips = []
+    port_list = []
+    for _i in range(ports):
+        port = {'id': _uuid(rand), 'network_id': net['id'],
+                'fixed_ips': [{'subnet_id': subnet['id']}],
+                'security_groups': [sg['id']]}
+        port_list.append(port)
+        changes.append((task_db.CREATE, task_db.PORT, port))
+        changes.append((task_db.UPDATE, task_db.PORT, port))
+        if rand.random() < 0.3:
+            fip = {'id': _uuid(rand), 'floating_network_id': ext_net_id,
+                   'router_id': router['id'], 'port_id': port['id']}
+            changes.append((task_db.CREATE, task_db.FLOATING_IP, fip))
+            fips.append(fip)
+    deleted = [(task_db.FLOATING_IP, fip) for fip in fips]
+    deleted += [(task_db.PORT, port) for port in port_list]
+    deleted += [(task_db.ROUTER, router), (task_db.SUBNET, subnet),
+                (task_db.NETWORK, net)]
+    changes += [(task_db.DELETE, data_type, data)
+                for data_type, data in deleted]
+    return changes
+
+
+def generate_tasks(tenants, ports, seed=0):
+    rand = random.Random(seed)
+    ext_net_id = _uuid(rand)
+    queues = [tenant_workload(rand, ext_net_id, ports)
+              for _i in range(tenants)]
+    tasks = []
+    while queues:
+        queue = rand.choice(queues)
+        task_type, data_type, data = queue.pop(0)
+        if not queue:
+            queues.remove(queue)
+        # A DELETE task gets the references of the last data of its
+        # resource when flushed
+        depends_on = task_db.get_task_dependencies(
+            task_db.UPDATE if task_type == task_db.DELETE else task_type,
+            data_type, data)
+        tasks.append(task_db.Task(
+            id=len(tasks) + 1, type=task_type, data_type=data_type,
+            resource_id=data['id'],
+            shard_key=task_db.get_shard_key(data_type, data['id'], data),
+            depends_on=jsonutils.dumps(depends_on)))
+    return tasks
+
+
+def shard_levels(tasks):
+    """Levels of independent tasks according to the shard keys only."""
+    levels = []
+    last = {}
+    floor = 0
+    for task in tasks:
+        if task.shard_key is None:
+            level = len(levels)
+            floor = level + 1
+        else:
+            level = max(floor, last.get(task.shard_key, -1) + 1)
+            last[task.shard_key] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(task)
+    return levels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tenants', type=int, default=50)
+    parser.add_argument('--ports', type=int, default=10,
+                        help='Ports per tenant')
+    parser.add_argument('--windows', default='100,1000,0',
+                        help='Window sizes, 0 for the whole workload')
+    args = parser.parse_args()
+
+    tasks = generate_tasks(args.tenants, args.ports)
+    schedulers = [('shard key', shard_levels),
+                  ('dependencies', task_consumer.dependency_levels)]
+    rows = []
+    for window in [int(w) for w in args.windows.split(',')]:
+        size = window or len(tasks)
+        for name, levels_of in schedulers:
+            widths = []
+            for start in range(0, len(tasks), size):
+                widths += [len(level)
+                           for level in levels_of(tasks[start:start + size])]
+            rows.append((window or 'all', name, len(widths),
+                         '%.1f' % (float(len(tasks)) / len(widths)),
+                         max(widths)))
+    print('%d tasks' % len(tasks))
+    bench_util.print_table(['window', 'ordering', 'levels', 'mean width',
+                            'max width'], rows)
+
+
+if __name__ == '__main__':
+    main()
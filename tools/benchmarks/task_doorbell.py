@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""End to end task latency of a polling consumer with and without doorbell.
+
+A producer thread commits tasks at random intervals while a consumer thread
+reads the new tasks, either polling the table at a fixed interval or
+waking up on the doorbell with the same interval as a fallback.  The
+latency is the time from the commit to the consumer reading the task.
+
+    python tools/benchmarks/task_doorbell.py --tasks 200 --poll-interval 1 \\
+        --connection sqlite:////tmp/bench.db
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+import bench_util
+from midonet.neutron.common import doorbell
+from midonet.neutron.db import task_db
+
+
+class Context(object):
+
+    def __init__(self, session):
+        self.session = session
+        self.tenant = 'bench'
+        self.request_id = str(uuid.uuid4())
+
+
+def produce(session_maker, count, gap):
+    rand = random.Random(0)
+    session = session_maker()
+    for i in range(count):
+        time.sleep(rand.uniform(0, 2 * gap))
+        context = Context(session)
+        with session.begin():
+            task_db.create_task(context, task_db.CREATE,
+                                data_type=task_db.PORT,
+                                resource_id=str(uuid.uuid4()), data={})
+
+
+def consume(session_maker, count, poll_interval, listener, commit_times):
+    session = session_maker()
+    latencies = []
+    queries = 0
+    last_id = 0
+    while len(latencies) < count:
+        if listener is None:
+            time.sleep(poll_interval)
+        else:
+            listener.wait(last_id + 1, timeout=poll_interval)
+        with session.begin():
+            ids = [task_id for task_id, in session.query(
+                task_db.Task.id).filter(task_db.Task.id > last_id).order_by(
+                    task_db.Task.id)]
+        queries += 1
+        now = time.time()
+        for task_id in ids:
+            latencies.append(now - commit_times[task_id])
+        if ids:
+            last_id = ids[-1]
+    return latencies, queries
+
+
+TABLES = [task_db.Task.__table__, task_db.TaskCurrent.__table__,
+          task_db.TaskSequence.__table__, task_db.TaskTransaction.__table__]
+
+
+def run(engine, args, backend):
+    for table in TABLES:
+        table.drop(engine, checkfirst=True)
+        table.create(engine)
+    session_maker = orm.sessionmaker(bind=engine, autocommit=True)
+
+    commit_times = {}
+
+    def record(task_id):
+        commit_times[task_id] = time.time()
+
+    task_db.register_commit_hook(record)
+    listener = bell = None
+    if backend != doorbell.NONE:
+        address = '127.0.0.1:0'
+        if backend == doorbell.UNIX:
+            address = os.path.join(tempfile.mkdtemp(), 'doorbell.sock')
+        listener = doorbell.DoorbellListener(backend, address)
+        if backend != doorbell.UNIX:
+            address = '%s:%d' % listener.address
+        bell = doorbell.get_doorbell(backend, address)
+        task_db.register_commit_hook(bell.ring)
+
+    producer = threading.Thread(
+        target=produce, args=(session_maker, args.tasks, args.gap))
+    producer.start()
+    start = time.time()
+    latencies, queries = consume(session_maker, args.tasks,
+                                 args.poll_interval, listener, commit_times)
+    elapsed = time.time() - start
+    producer.join()
+
+    task_db.unregister_commit_hook(record)
+    if bell is not None:
+        task_db.unregister_commit_hook(bell.ring)
+        bell.close()
+        listener.close()
+    latencies.sort()
+    return (backend, '%.1f' % (1000 * sum(latencies) / len(latencies)),
+            '%.1f' % (1000 * latencies[len(latencies) // 2]),
+            '%.1f' % (1000 * latencies[int(len(latencies) * 0.99)]),
+            '%.1f' % (queries / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connection')
+    parser.add_argument('--tasks', type=int, default=100)
+    parser.add_argument('--gap', type=float, default=0.05,
+                        help='Mean time in seconds between two commits')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--backends', default='none,udp,unix,tcp')
+    args = parser.parse_args()
+
+    connection = args.connection
+    if connection is None:
+        connection = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(),
+                                                   'bench.db')
+    engine = sa.create_engine(connection)
+    rows = [run(engine, args, backend)
+            for backend in args.backends.split(',')]
+    for table in TABLES:
+        table.drop(engine)
+    bench_util.print_table(['doorbell', 'mean ms', 'p50 ms', 'p99 ms',
+                            'queries/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
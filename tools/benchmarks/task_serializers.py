@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Throughput of the JSON serializers of the task data.
+
+The serializers are compared with jsonutils on realistic payloads.  The
+ones whose library is not installed are skipped.
+
+    python tools/benchmarks/task_serializers.py [--iterations N]
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from oslo_serialization import jsonutils
+
+import bench_util
+from midonet.neutron.db import task_db
+
+
+class JsonutilsSerializer(object):
+
+    def dumps(self, data):
+        return jsonutils.dumps(data)
+
+    def loads(self, text):
+        return jsonutils.loads(text)
+
+
+def serializers():
+    yield 'jsonutils', JsonutilsSerializer()
+    for name in ('json', 'simplejson', 'ujson'):
+        try:
+            yield name, task_db.get_serializer(name)
+        except Exception:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = []
+    for name, payload in bench_util.sample_payloads():
+        baseline = None
+        for serializer_name, serializer in serializers():
+            text = serializer.dumps(payload)
+
+            def encode():
+                for _i in range(args.iterations):
+                    serializer.dumps(payload)
+
+            def decode():
+                for _i in range(args.iterations):
+                    serializer.loads(text)
+
+            enc = bench_util.best_of(encode)
+            dec = bench_util.best_of(decode)
+            baseline = baseline or enc
+            rows.append((name, serializer_name, len(text),
+                         '%.0f' % (args.iterations / enc),
+                         '%.2f' % (baseline / enc),
+                         '%.0f' % (args.iterations / dec)))
+    bench_util.print_table(['payload', 'serializer', 'bytes', 'encode/s',
+                            'speed-up', 'decode/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Midokura SARL.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Throughput of the reference task consumer by number of workers.
+
+A tasks table is filled with generated rows sharded like the plugin does,
+and consumed with an increasing number of workers.  Applying a task is
+simulated by a sleep, standing for the writes of the cluster to its
+storage.
+
+    python tools/benchmarks/task_shards.py --rows 5000 --apply-ms 1
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+import bench_util
+from midonet.neutron.db import task_consumer
+from midonet.neutron.db import task_db
+
+
+def fill(engine, rows, networks):
+    rand = random.Random(0)
+    network_of = {}
+    batch = []
+    for row in bench_util.generate_task_rows(rows):
+        data_type = row['data_type']
+        if data_type in (task_db.PORT, task_db.SUBNET):
+            network_id = network_of.setdefault(
+                row['resource_id'], 'net-%d' % rand.randrange(networks))
+            row['shard_key'] = task_db.get_shard_key(
+                data_type, row['resource_id'], {'network_id': network_id})
+        else:
+            row['shard_key'] = task_db.get_shard_key(data_type,
+                                                     row['resource_id'])
+        batch.append(row)
+    engine.execute(task_db.Task.__table__.insert(), batch)
+    return sum(1 for row in batch if row['shard_key'] is None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connection', default='sqlite://')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--networks', type=int, default=100)
+    parser.add_argument('--apply-ms', type=float, default=1.0)
+    parser.add_argument('--workers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    engine = sa.create_engine(args.connection)
+    task_db.Task.__table__.create(engine)
+    try:
+        barriers = fill(engine, args.rows, args.networks)
+        session = orm.sessionmaker(bind=engine, autocommit=True)()
+
+        def apply_task(task):
+            time.sleep(args.apply_ms / 1000.0)
+
+        rows = []
+        baseline = None
+        for workers in [int(w) for w in args.workers.split(',')]:
+            consumer = task_consumer.TaskConsumer(apply_task, workers)
+            start = time.time()
+            consumer.consume(session)
+            elapsed = time.time() - start
+            baseline = baseline or elapsed
+            rows.append((workers, '%.0f' % (args.rows / elapsed),
+                         '%.2f' % (baseline / elapsed)))
+    finally:
+        task_db.Task.__table__.drop(engine)
+    print('%d tasks, %d barriers' % (args.rows, barriers))
+    bench_util.print_table(['workers', 'tasks/s', 'speed-up'], rows)
+
+
+if __name__ == '__main__':
+    main()